@@ -4,45 +4,83 @@
 # - Поддержка языков общая (user_languages.json).
 # - Код не запускает polling — main.py должен запускать оба бота.
 import asyncio
+import csv
+import gzip
+import io
 import json
 import logging
 import os
-from datetime import datetime
+import tempfile
+from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
 
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram import types, F
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.enums import ParseMode
-from aiogram.client.default import DefaultBotProperties
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile, FSInputFile, MessageOriginChannel
+from aiogram.enums import ChatMemberStatus
 
+import bots
+import broadcasts
+import channels
 import config
-import database as db
+from repository import BACKEND_NAME, backend as db
+import entitlements
+from fsm_storage import CompactMemoryStorage
+import leader
+import loop_monitor
+from log_pipeline import LogContextMiddleware
+import tracing
+import maintenance
+import performance
+import throttling
+import update_scheduler
+from update_scheduler import OrderedDispatcher, UpdateScheduler
+from rate_queue import RateLimitedQueue
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 ADMIN_BOT_TOKEN = getattr(config, "ADMIN_BOT_TOKEN", None)
 USER_BOT_TOKEN = getattr(config, "USER_BOT_TOKEN", None)
 
-try:
-    PRIVATE_CHANNEL_ID = int(config.PRIVATE_CHANNEL_ID) if config.PRIVATE_CHANNEL_ID is not None else None
-except Exception:
-    PRIVATE_CHANNEL_ID = None
-
 ADMIN_IDS: List[int] = getattr(config, "ADMIN_USER_IDS", []) or []
 
 if ADMIN_BOT_TOKEN is None or USER_BOT_TOKEN is None:
     raise RuntimeError("ADMIN_BOT_TOKEN и USER_BOT_TOKEN должны быть заданы в config.py")
 
-# Инициализация ботов (aiogram >=3.7)
-bot = Bot(token=ADMIN_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-user_sender_bot = Bot(token=USER_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+# Боты и общая HTTP-сессия — из реестра bots.py (один Bot на токен)
+get_bot = bots.admin
+get_user_sender_bot = bots.user
+
+
+def __getattr__(name: str):
+    # обратная совместимость: `from admin_bot import bot`
+    if name == "bot":
+        return get_bot()
+    if name == "user_sender_bot":
+        return get_user_sender_bot()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+storage = CompactMemoryStorage()
+# Апдейты одного пользователя — строго по очереди, разных — параллельно до лимита
+dp = OrderedDispatcher(
+    storage=storage,
+    scheduler=UpdateScheduler("admin_bot", getattr(config, "UPDATE_CONCURRENCY", 64)),
+)
+# update_id/user_id текущего апдейта попадают в каждую запись лога
+dp.update.outer_middleware(LogContextMiddleware())
+# Трассировка апдейтов (БД и Bot API как дочерние спаны), только если включена
+if tracing.TRACE_ENABLED:
+    dp.update.outer_middleware(tracing.TracingMiddleware())
+
+# Очередь уведомлений пользователям (инвайты, отказы) с ограничением скорости;
+# вызовы в сами каналы идут через пулы channels.pool(chat_id)
+notify_queue = RateLimitedQueue("notify", getattr(config, "CHANNEL_API_RATE", 20))
+
+# Ссылки на фоновые задачи, чтобы их не собрал GC
+_background_tasks: set = set()
 
 # Общий файл языковых настроек (используется и user_bot.py)
 LANG_FILE = "user_languages.json"
@@ -54,7 +92,7 @@ def load_langs() -> Dict[str, str]:
             with open(LANG_FILE, "r", encoding="utf-8") as f:
                 return json.load(f)
         except Exception as e:
-            logger.warning(f"Не удалось загрузить {LANG_FILE}: {e}")
+            logger.warning("Не удалось загрузить %s: %s", LANG_FILE, e)
     return {}
 
 
@@ -63,10 +101,18 @@ def save_langs(m: Dict[str, str]):
         with open(LANG_FILE, "w", encoding="utf-8") as f:
             json.dump(m, f, ensure_ascii=False, indent=2)
     except Exception as e:
-        logger.warning(f"Не удалось сохранить {LANG_FILE}: {e}")
+        logger.warning("Не удалось сохранить %s: %s", LANG_FILE, e)
+
+
+# Языки читаются с диска при первом обращении, а не при импорте
+_user_langs: Optional[Dict[str, str]] = None
 
 
-user_langs: Dict[str, str] = load_langs()
+def get_langs() -> Dict[str, str]:
+    global _user_langs
+    if _user_langs is None:
+        _user_langs = load_langs()
+    return _user_langs
 
 # Переводы (минимальный набор; user_bot содержит полный набор)
 translations = {
@@ -86,7 +132,7 @@ translations = {
         "choose_lang": "Выберите язык / Choose language / اختر اللغة / Tilni tanlang:",
         "no_services": "❌ Услуги временно недоступны.",
         "service_added": "✅ Услуга добавлена.",
-        "broadcast_prompt": "Введите текст для рассылки всем пользователям:",
+        "broadcast_prompt": "Отправьте сообщение для рассылки (текст, фото, видео, документ):",
         "dm_prompt": "Выберите пользователя для отправки сообщения:",
     },
     "en": {
@@ -105,7 +151,7 @@ translations = {
         "choose_lang": "Выберите язык / Choose language / اختر اللغة / Tilni tanlang:",
         "no_services": "❌ Services are temporarily unavailable.",
         "service_added": "✅ Service added.",
-        "broadcast_prompt": "Enter text to broadcast to all users:",
+        "broadcast_prompt": "Send the message to broadcast (text, photo, video, document):",
         "dm_prompt": "Choose a user to send a message to:",
     },
     "ar": {
@@ -124,7 +170,7 @@ translations = {
         "choose_lang": "Выберите язык / Choose language / اختر اللغة / Tilni tanlang:",
         "no_services": "❌ الخدمات غير متاحة مؤقتاً.",
         "service_added": "✅ تم إضافة الخدمة.",
-        "broadcast_prompt": "أدخل النص لإرساله إلى جميع المستخدمين:",
+        "broadcast_prompt": "أرسل الرسالة المراد بثها (نص، صورة، فيديو، مستند):",
         "dm_prompt": "اختر مستخدمًا لإرسال رسالة له:",
     },
     "uz": {
@@ -143,14 +189,14 @@ translations = {
         "choose_lang": "Выберите язык / Choose language / اختر اللغة / Tilni tanlang:",
         "no_services": "❌ Xizmatlar vaqtincha mavjud emas.",
         "service_added": "✅ Xizmat qo'shildi.",
-        "broadcast_prompt": "Barcha foydalanuvchilarga yuboriladigan matnni kiriting:",
+        "broadcast_prompt": "Tarqatiladigan xabarni yuboring (matn, rasm, video, hujjat):",
         "dm_prompt": "Kimga xabar yuborishni tanlang:",
     }
 }
 
 
 def get_user_lang(user_id: int) -> str:
-    lang = user_langs.get(str(user_id))
+    lang = get_langs().get(str(user_id))
     if lang in translations:
         return lang
     return "ru"
@@ -194,18 +240,26 @@ class SearchUser(StatesGroup):
 
 class Broadcast(StatesGroup):
     waiting_for_message = State()
+    waiting_for_time = State()
 
 
 class DirectMessage(StatesGroup):
     waiting_for_message = State()
 
 
+class BulkOperation(StatesGroup):
+    waiting_for_file = State()
+
+
 # ---------------- Keyboards ----------------
 def admin_main_keyboard(user_id: int) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💼 Управление услугами", callback_data="manage_services")],
         [InlineKeyboardButton(text="🧾 Управление пользователями", callback_data="manage_users")],
-        [InlineKeyboardButton(text="🔧 Диагностика канала", callback_data="diagnostics")],
+        [InlineKeyboardButton(text="🕒 Заявки на покупку", callback_data="pending_queue")],
+        [InlineKeyboardButton(text="📊 Статистика", callback_data="statistics")],
+        [InlineKeyboardButton(text="📡 Каналы", callback_data="channels_menu")],
+        [InlineKeyboardButton(text="🔧 Диагностика каналов", callback_data="diagnostics")],
         [InlineKeyboardButton(text="🌐 Язык", callback_data="lang_menu")],
     ])
     return kb
@@ -215,8 +269,10 @@ def manage_users_keyboard(user_id: int) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔎 Поиск пользователя", callback_data="search_user"),
          InlineKeyboardButton(text="📋 Список (пагинация)", callback_data="users_stats")],
-        [InlineKeyboardButton(text="✉️ Рассылка всем", callback_data="broadcast_all"),
+        [InlineKeyboardButton(text="✉️ Рассылка", callback_data="broadcast_all"),
          InlineKeyboardButton(text="👤 Сообщение пользователю", callback_data="direct_message")],
+        [InlineKeyboardButton(text="📥 Массовые операции (CSV)", callback_data="bulk_ops"),
+         InlineKeyboardButton(text="📤 Экспорт", callback_data="export_menu")],
         [InlineKeyboardButton(text="🏠 Назад", callback_data="admin_menu")]
     ])
     return kb
@@ -290,8 +346,8 @@ async def set_lang(callback: types.CallbackQuery):
     if code not in translations:
         await callback.answer("Unsupported language", show_alert=True)
         return
-    user_langs[str(callback.from_user.id)] = code
-    save_langs(user_langs)
+    get_langs()[str(callback.from_user.id)] = code
+    save_langs(get_langs())
     await callback.answer()
     await callback.message.edit_text(tr(callback.from_user.id, "lang_set", lang=code), reply_markup=admin_main_keyboard(callback.from_user.id))
 
@@ -356,24 +412,44 @@ async def search_user_query(message: types.Message, state: FSMContext):
         await message.answer("Доступ запрещён")
         return
     query = message.text.strip().lstrip('@')
+    await state.clear()
+    # запрос сохраняем, чтобы повторить поиск с архивом одной кнопкой
+    await state.update_data(last_search=query)
+    text, kb = await search_results_view(message.from_user.id, query, include_archived=False)
+    await message.answer(text, reply_markup=kb)
+
+
+async def search_results_view(admin_id: int, query: str, include_archived: bool):
     try:
-        results = await db.search_users_by_username(query, limit=50)
+        results = await db.search_users_by_username(query, limit=50, include_archived=include_archived)
     except Exception:
         results = []
-    if not results:
-        await message.answer(tr(message.from_user.id, "no_users"), reply_markup=manage_users_keyboard(message.from_user.id))
-        await state.clear()
-        return
     buttons = []
     for u in results:
         username = u.get('username') or f"id{u.get('user_id')}"
-        status = "✅" if u.get('is_active') else "❌"
+        status = "📦" if u.get('archived') else ("✅" if u.get('is_active') else "❌")
         display = f"{status} @{username} (ID {u.get('user_id')})"
         buttons.append([InlineKeyboardButton(text=display, callback_data=f"userprofile_{u['user_id']}")])
+    if not include_archived:
+        buttons.append([InlineKeyboardButton(text="📦 Искать и в архиве", callback_data="search_archived")])
     buttons.append([InlineKeyboardButton(text="🏠 Назад", callback_data="manage_users")])
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await message.answer("Выберите пользователя:", reply_markup=kb)
-    await state.clear()
+    text = "Выберите пользователя:" if results else tr(admin_id, "no_users")
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.callback_query(F.data == "search_archived")
+async def search_user_archived(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    query = (await state.get_data()).get("last_search")
+    if query is None:
+        await callback.message.edit_text(tr(callback.from_user.id, "search_user_prompt"))
+        await state.set_state(SearchUser.waiting_for_query)
+        return
+    text, kb = await search_results_view(callback.from_user.id, query, include_archived=True)
+    await callback.message.edit_text(text, reply_markup=kb)
 
 
 @dp.callback_query(F.data == "users_stats")
@@ -382,15 +458,16 @@ async def users_stats(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Доступ запрещён")
         return
     await callback.answer()
-    await state.update_data(users_offset=0)
+    await state.update_data(users_offset=0, users_archived=False)
     await send_users_page(callback.message, state, edit=True)
 
 
 async def send_users_page(message: types.Message, state: FSMContext, edit: bool = False):
     data = await state.get_data()
     offset = data.get("users_offset", 0)
+    include_archived = data.get("users_archived", False)
     try:
-        page = await db.get_users_paginated(offset=offset, limit=10)
+        page = await db.get_users_paginated(offset=offset, limit=10, include_archived=include_archived)
     except Exception:
         page = []
     if not page:
@@ -405,12 +482,14 @@ async def send_users_page(message: types.Message, state: FSMContext, edit: bool
     buttons = []
     for u in page:
         username = u.get('username') or f"id{u.get('user_id')}"
-        status = "✅" if u.get('is_active') else "❌"
+        status = "📦" if u.get('archived') else ("✅" if u.get('is_active') else "❌")
         end = u.get('subscription_end') or "—"
         lines.append(f"{status} @{username} (ID {u.get('user_id')}) — до {end}")
         buttons.append([InlineKeyboardButton(text=f"{status} @{username}", callback_data=f"userprofile_{u['user_id']}")])
     buttons.append([InlineKeyboardButton(text="⬅️ Предыдущая", callback_data="users_prev"),
                     InlineKeyboardButton(text="➡️ Следующая", callback_data="users_next")])
+    archive_label = "📦 Скрыть архив" if include_archived else "📦 Показать архив"
+    buttons.append([InlineKeyboardButton(text=archive_label, callback_data="users_toggle_archived")])
     buttons.append([InlineKeyboardButton(text="🏠 Назад", callback_data="manage_users")])
     kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     text = "\n".join(lines)
@@ -436,6 +515,17 @@ async def users_pagination(callback: types.CallbackQuery, state: FSMContext):
     await send_users_page(callback.message, state, edit=True)
 
 
+@dp.callback_query(F.data == "users_toggle_archived")
+async def users_toggle_archived(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    data = await state.get_data()
+    await state.update_data(users_offset=0, users_archived=not data.get("users_archived", False))
+    await send_users_page(callback.message, state, edit=True)
+
+
 @dp.callback_query(F.data.startswith("userprofile_"))
 async def show_user_profile(callback: types.CallbackQuery, state: FSMContext):
     if not await is_admin(callback.from_user.id):
@@ -480,9 +570,9 @@ async def show_user_profile(callback: types.CallbackQuery, state: FSMContext):
     photo_id = user.get('photo_file_id')
     if photo_id:
         try:
-            await bot.send_photo(callback.from_user.id, photo_id, caption=f"Фото @{username}")
+            await get_bot().send_photo(callback.from_user.id, photo_id, caption=f"Фото @{username}")
         except Exception as e:
-            logger.warning(f"Не удалось отправить фото админу: {e}")
+            logger.warning("Не удалось отправить фото админу: %s", e)
 
 
 @dp.callback_query(F.data.startswith("admin_show_phone_"))
@@ -530,10 +620,10 @@ async def admin_show_photo(callback: types.CallbackQuery):
         await callback.answer("Фото не найдено", show_alert=True)
         return
     try:
-        await bot.send_photo(callback.from_user.id, photo_id, caption=f"Фото @{user.get('username') or user_id}")
+        await get_bot().send_photo(callback.from_user.id, photo_id, caption=f"Фото @{user.get('username') or user_id}")
         await callback.answer(tr(callback.from_user.id, "showing_photo"), show_alert=True)
     except Exception as e:
-        logger.warning(f"Не удалось отправить фото админу: {e}")
+        logger.warning("Не удалось отправить фото админу: %s", e)
         await callback.answer("Не удалось отправить фото (ошибка).", show_alert=True)
 
 
@@ -548,20 +638,16 @@ async def admin_remove_channel(callback: types.CallbackQuery):
     except Exception:
         await callback.message.edit_text("Ошибка ID", reply_markup=manage_users_keyboard(callback.from_user.id))
         return
-    if PRIVATE_CHANNEL_ID is None:
-        await callback.message.edit_text("⚠️ PRIVATE_CHANNEL_ID не задан в config. Невозможно удалить из канала.")
+    if not channels.registered():
+        await callback.message.edit_text("⚠️ Каналы не настроены. Невозможно удалить из канала.")
+        return
+    errors = await remove_from_channels(user_id)
+    if errors:
+        await callback.message.edit_text(
+            "⚠️ Не удалось удалить из каналов:\n" + "\n".join(errors),
+            reply_markup=manage_users_keyboard(callback.from_user.id)
+        )
         return
-    try:
-        await bot.ban_chat_member(chat_id=PRIVATE_CHANNEL_ID, user_id=user_id)
-        await asyncio.sleep(0.3)
-        await bot.unban_chat_member(chat_id=PRIVATE_CHANNEL_ID, user_id=user_id)
-    except Exception as e:
-        logger.warning(f"Не удалось удалить пользователя из канала: {e}")
-    try:
-        if hasattr(db, "mark_user_removed_from_channel"):
-            await db.mark_user_removed_from_channel(user_id)
-    except Exception:
-        logger.debug("mark_user_removed_from_channel отсутствует или не сработала")
     await callback.message.edit_text(tr(callback.from_user.id, "removed_channel"), reply_markup=manage_users_keyboard(callback.from_user.id))
 
 
@@ -584,13 +670,8 @@ async def admin_delete_user(callback: types.CallbackQuery):
         await callback.message.edit_text(tr(callback.from_user.id, "user_not_found"), reply_markup=manage_users_keyboard(callback.from_user.id))
         return
 
-    if PRIVATE_CHANNEL_ID is not None:
-        try:
-            await bot.ban_chat_member(chat_id=PRIVATE_CHANNEL_ID, user_id=user_id)
-            await asyncio.sleep(0.3)
-            await bot.unban_chat_member(chat_id=PRIVATE_CHANNEL_ID, user_id=user_id)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить пользователя из канала при удалении из БД: {e}")
+    for error in await remove_from_channels(user_id):
+        logger.warning("Не удалось удалить пользователя из канала при удалении из БД: %s", error)
     try:
         if hasattr(db, "delete_user"):
             await db.delete_user(user_id)
@@ -603,15 +684,360 @@ async def admin_delete_user(callback: types.CallbackQuery):
         await callback.message.edit_text(f"❌ Не удалось удалить пользователя: {e}", reply_markup=manage_users_keyboard(callback.from_user.id))
 
 
+# ---------------- Массовые операции (CSV) ----------------
+BULK_ACTIONS = {"extend", "deactivate", "remove"}
+BULK_UNITS = {"minutes", "days", "months"}
+BULK_HELP = (
+    "📥 <b>Массовые операции</b>\n\n"
+    "Отправьте CSV-файл со строками:\n"
+    "<code>user_id,action,amount,unit</code>\n\n"
+    "action:\n"
+    "• <code>extend</code> — продлить на amount единиц (unit: minutes/days/months, по умолчанию days)\n"
+    "• <code>deactivate</code> — отключить подписку и удалить из канала\n"
+    "• <code>remove</code> — только удалить из канала\n\n"
+    "Строка заголовка необязательна."
+)
+
+
+def parse_bulk_csv(text: str):
+    """Разбирает CSV массовых операций. Возвращает (operations, errors)."""
+    operations = []
+    errors = []
+    for line_no, row in enumerate(csv.reader(io.StringIO(text)), start=1):
+        row = [cell.strip() for cell in row]
+        if not row or not any(row):
+            continue
+        if line_no == 1 and row[0].lower() == "user_id":
+            continue
+        try:
+            user_id = int(row[0])
+        except ValueError:
+            errors.append((line_no, row[0], "", "неверный user_id"))
+            continue
+        action = (row[1].lower() if len(row) > 1 else "")
+        if action not in BULK_ACTIONS:
+            errors.append((line_no, user_id, action, "неизвестное действие"))
+            continue
+        amount, unit = 0, "days"
+        if action == "extend":
+            try:
+                amount = int(row[2])
+                if amount <= 0:
+                    raise ValueError
+            except (IndexError, ValueError):
+                errors.append((line_no, user_id, action, "amount должен быть положительным числом"))
+                continue
+            if len(row) > 3 and row[3]:
+                unit = row[3].lower()
+            if unit not in BULK_UNITS:
+                errors.append((line_no, user_id, action, "неизвестная единица"))
+                continue
+        operations.append((line_no, user_id, action, amount, unit))
+    return operations, errors
+
+
+def _bulk_report(errors: list) -> BufferedInputFile:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["line", "user_id", "action", "error"])
+    writer.writerows(errors)
+    return BufferedInputFile(buf.getvalue().encode("utf-8-sig"), filename="bulk_report.csv")
+
+
+@dp.callback_query(F.data == "bulk_ops")
+async def bulk_ops_start(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    await callback.message.edit_text(BULK_HELP)
+    await state.set_state(BulkOperation.waiting_for_file)
+
+
+@dp.message(BulkOperation.waiting_for_file, F.document)
+async def bulk_ops_file(message: types.Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        await message.answer("Доступ запрещён")
+        return
+    await state.clear()
+    try:
+        buf = await get_bot().download(message.document)
+        text = buf.read().decode("utf-8-sig")
+    except Exception as e:
+        logger.warning("Не удалось скачать CSV: %s", e)
+        await message.answer(f"❌ Не удалось прочитать файл: {e}", reply_markup=manage_users_keyboard(message.from_user.id))
+        return
+
+    operations, errors = parse_bulk_csv(text)
+    status = await message.answer(f"⏳ Строк к применению: {len(operations)}, ошибок разбора: {len(errors)}")
+
+    extensions = [(user_id, amount, unit) for _, user_id, action, amount, unit in operations if action == "extend"]
+    deactivations = [user_id for _, user_id, action, _, _ in operations if action == "deactivate"]
+    try:
+        await db.bulk_update_subscriptions(extensions, deactivations)
+    except Exception as e:
+        logger.exception("Ошибка массового обновления подписок")
+        await status.edit_text(f"❌ Транзакция отменена, изменения не применены: {e}")
+        return
+
+    removals = [(line_no, user_id, action) for line_no, user_id, action, _, _ in operations if action in ("deactivate", "remove")]
+    await status.edit_text(
+        f"✅ БД обновлена: продлено {len(extensions)}, отключено {len(deactivations)}.\n"
+        f"⏳ Удаление из каналов: 0/{len(removals)}"
+    )
+    task = asyncio.create_task(_finish_bulk_removals(message, status, removals, errors))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _finish_bulk_removals(message: types.Message, status: types.Message, removals: list, errors: list):
+    removed = []
+    if removals and not channels.registered():
+        errors.extend((line_no, user_id, action, "каналы не настроены") for line_no, user_id, action in removals)
+        removals = []
+    # каналы обрабатываются параллельно, каждый своим пулом; тех, кого точно нет в канале, не трогаем
+    lines = {}
+    for line_no, user_id, action in removals:
+        lines.setdefault(user_id, []).append((line_no, action))
+    done = 0
+    async for user_id, failures in channels.remove_users(get_bot(), list(lines)):
+        if failures:
+            errors.extend((line_no, user_id, action, f"канал {'; '.join(failures)}") for line_no, action in lines[user_id])
+        else:
+            removed.append(user_id)
+        done += 1
+        if done % 100 == 0:
+            try:
+                await status.edit_text(f"⏳ Удаление из каналов: {done}/{len(lines)}")
+            except Exception:
+                pass
+    if removed:
+        try:
+            await db.mark_users_removed_from_channel(removed)
+        except Exception:
+            logger.exception("Не удалось отметить удаление из канала")
+    summary = f"✅ Массовая операция завершена. Удалено из каналов: {len(removed)}, ошибок: {len(errors)}"
+    try:
+        await status.edit_text(summary)
+    except Exception:
+        pass
+    if errors:
+        await message.answer_document(_bulk_report(errors), caption="Отчёт об ошибках")
+    await message.answer(tr(message.from_user.id, "manage_users_menu"), reply_markup=manage_users_keyboard(message.from_user.id))
+
+
+@dp.message(BulkOperation.waiting_for_file)
+async def bulk_ops_no_file(message: types.Message):
+    await message.answer("Пришлите CSV-файл документом.")
+
+
+# ---------------- Экспорт пользователей ----------------
+EXPORT_FIELDS = [
+    "user_id", "username", "phone_number", "language", "subscription_end", "is_active",
+    "added_to_channel", "purchases", "last_purchase_at", "last_purchase_status", "last_service",
+    "last_service_price",
+]
+EXPORT_HELP = (
+    "📤 <b>Экспорт пользователей</b>\n\n"
+    "Команда: <code>/export [csv|jsonl] [active] [expiring=N] [lang=ru]</code>\n"
+    "• <code>active</code> — только активные подписки\n"
+    "• <code>expiring=N</code> — истекают в ближайшие N дней\n"
+    "• <code>lang=xx</code> — язык пользователя\n"
+    "Без <code>active</code>/<code>expiring</code> в выгрузку входят и пользователи из архива.\n\n"
+    "Файл сжимается gzip. Или выберите готовый вариант:"
+)
+
+
+def export_menu_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="CSV — все", callback_data="export_csv"),
+         InlineKeyboardButton(text="CSV — активные", callback_data="export_csv_active")],
+        [InlineKeyboardButton(text="JSONL — все", callback_data="export_jsonl")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="manage_users")]
+    ])
+
+
+def parse_export_args(args: str):
+    """'/export jsonl active expiring=7 lang=ru' -> (fmt, filters). ValueError при ошибке."""
+    fmt = "csv"
+    filters: Dict[str, Any] = {"active_only": False, "expiring_within_days": None, "lang": None}
+    for token in (args or "").split():
+        token = token.lower()
+        if token in ("csv", "jsonl"):
+            fmt = token
+        elif token == "active":
+            filters["active_only"] = True
+        elif token.startswith("expiring="):
+            filters["expiring_within_days"] = int(token.split("=", 1)[1])
+        elif token.startswith("lang="):
+            filters["lang"] = token.split("=", 1)[1]
+        else:
+            raise ValueError(f"неизвестный параметр: {token}")
+    return fmt, filters
+
+
+def _write_export_chunk(fh, fmt: str, rows: List[Dict[str, Any]]):
+    if fmt == "csv":
+        csv.DictWriter(fh, fieldnames=EXPORT_FIELDS).writerows(rows)
+    else:
+        fh.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+
+async def export_users_file(fmt: str, filters: Dict[str, Any]):
+    """Пишет выгрузку во временный .gz файл порциями. Возвращает (path, rows)."""
+    fd, path = tempfile.mkstemp(prefix="users_export_", suffix=f".{fmt}.gz")
+    os.close(fd)
+    total = 0
+    try:
+        fh = gzip.open(path, "wt", encoding="utf-8", newline="")
+        try:
+            if fmt == "csv":
+                csv.DictWriter(fh, fieldnames=EXPORT_FIELDS).writeheader()
+            async for chunk in db.iter_users_export(
+                active_only=filters["active_only"],
+                expiring_within_days=filters["expiring_within_days"],
+                language=filters["lang"],
+            ):
+                # сжатие и запись — вне event loop
+                await asyncio.to_thread(_write_export_chunk, fh, fmt, chunk)
+                total += len(chunk)
+        finally:
+            await asyncio.to_thread(fh.close)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, total
+
+
+async def send_users_export(chat_id: int, fmt: str, filters: Dict[str, Any]):
+    status = await get_bot().send_message(chat_id, "⏳ Готовлю выгрузку...")
+    try:
+        path, total = await export_users_file(fmt, filters)
+    except Exception as e:
+        logger.exception("Ошибка экспорта пользователей")
+        await status.edit_text(f"❌ Ошибка экспорта: {e}")
+        return
+    try:
+        filename = f"users_{datetime.now():%Y%m%d_%H%M%S}.{fmt}.gz"
+        await get_bot().send_document(chat_id, FSInputFile(path, filename=filename), caption=f"📤 Пользователей: {total}")
+        await status.delete()
+    except Exception as e:
+        logger.warning("Не удалось отправить выгрузку: %s", e)
+        await status.edit_text(f"❌ Не удалось отправить файл: {e}")
+    finally:
+        os.remove(path)
+
+
+@dp.message(Command("export"))
+async def export_command(message: types.Message, command: CommandObject):
+    if not await is_admin(message.from_user.id):
+        await message.answer("Доступ запрещён")
+        return
+    try:
+        fmt, filters = parse_export_args(command.args)
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{EXPORT_HELP}", reply_markup=export_menu_kb())
+        return
+    await send_users_export(message.chat.id, fmt, filters)
+
+
+@dp.callback_query(F.data == "export_menu")
+async def export_menu(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    await callback.message.edit_text(EXPORT_HELP, reply_markup=export_menu_kb())
+
+
+@dp.callback_query(F.data.in_({"export_csv", "export_csv_active", "export_jsonl"}))
+async def export_preset(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    fmt, filters = parse_export_args(callback.data.replace("export_", "").replace("_", " "))
+    await send_users_export(callback.message.chat.id, fmt, filters)
+
+
 # ---------------- Broadcast / DM (перенесены в управление пользователями) ----------------
+def broadcast_segments_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="👥 Все пользователи", callback_data="bc_seg:all")],
+        [InlineKeyboardButton(text="✅ Активные подписчики", callback_data="bc_seg:active")],
+        [InlineKeyboardButton(text="⌛ Истёкшие за 7 дн.", callback_data="bc_seg:expired:7"),
+         InlineKeyboardButton(text="⌛ За 30 дн.", callback_data="bc_seg:expired:30")],
+        [InlineKeyboardButton(text="🆕 Без покупок", callback_data="bc_seg:never_purchased")],
+        [InlineKeyboardButton(text="🌐 По языку", callback_data="bc_lang"),
+         InlineKeyboardButton(text="💼 По услуге", callback_data="bc_svc")],
+        [InlineKeyboardButton(text="📋 Запланированные", callback_data="bc_list")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="manage_users")]
+    ])
+
+
+def broadcast_time_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🚀 Отправить сейчас", callback_data="bc_when:0")],
+        [InlineKeyboardButton(text="Через 1 ч", callback_data="bc_when:3600"),
+         InlineKeyboardButton(text="Через 3 ч", callback_data="bc_when:10800")],
+        [InlineKeyboardButton(text="Завтра в 10:00", callback_data="bc_when:tomorrow")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_all")]
+    ])
+
+
 @dp.callback_query(F.data == "broadcast_all")
 async def broadcast_all_start(callback: types.CallbackQuery, state: FSMContext):
     if not await is_admin(callback.from_user.id):
         await callback.answer("Доступ запрещён")
         return
     await callback.answer()
-    await callback.message.edit_text(tr(callback.from_user.id, "broadcast_prompt"))
+    await state.clear()
+    await callback.message.edit_text("✉️ <b>Рассылка</b>\n\nВыберите аудиторию:", reply_markup=broadcast_segments_kb())
+
+
+@dp.callback_query(F.data == "bc_lang")
+async def broadcast_choose_language(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🇷🇺 Рус", callback_data="bc_seg:language:ru"),
+         InlineKeyboardButton(text="🇬🇧 En", callback_data="bc_seg:language:en")],
+        [InlineKeyboardButton(text="🇦🇪 ع", callback_data="bc_seg:language:ar"),
+         InlineKeyboardButton(text="🇺🇿 Uz", callback_data="bc_seg:language:uz")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="broadcast_all")]
+    ])
+    await callback.message.edit_text("🌐 Язык получателей:", reply_markup=kb)
+
+
+@dp.callback_query(F.data == "bc_svc")
+async def broadcast_choose_service(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    services = await db.get_services()
+    rows = [[InlineKeyboardButton(text=s["name"], callback_data=f"bc_seg:service:{s['id']}")] for s in services]
+    rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="broadcast_all")])
+    await callback.message.edit_text("💼 Активные подписчики услуги:", reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+
+
+@dp.callback_query(F.data.startswith("bc_seg:"))
+async def broadcast_segment_selected(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    _, segment, *rest = callback.data.split(":")
+    arg = rest[0] if rest else None
+    count = await db.count_segment(segment, arg)
+    await state.update_data(bc_segment=segment, bc_arg=arg, bc_count=count)
     await state.set_state(Broadcast.waiting_for_message)
+    await callback.message.edit_text(
+        f"{tr(callback.from_user.id, 'broadcast_prompt')}\n\n"
+        f"🎯 {broadcasts.segment_label(segment, arg)}: {count} получателей"
+    )
 
 
 @dp.message(Broadcast.waiting_for_message)
@@ -619,21 +1045,110 @@ async def broadcast_send(message: types.Message, state: FSMContext):
     if not await is_admin(message.from_user.id):
         await message.answer("Доступ запрещён")
         return
-    text = message.text or ""
-    try:
-        users = await db.get_all_users()
-    except Exception:
-        users = []
-    sent = 0
-    for u in users:
-        try:
-            await user_sender_bot.send_message(u['user_id'], text, disable_notification=getattr(config, "SILENT_MODE", False))
-            sent += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            logger.warning(f"Не удалось отправить рассылку {u.get('user_id')}: {e}")
-    await message.answer(f"✅ Рассылка завершена. Отправлено: {sent}", reply_markup=manage_users_keyboard(message.from_user.id))
+    if broadcasts.BROADCAST_STORAGE_CHAT_ID is not None:
+        # one copy in the storage chat; the user bot copies it from there to every recipient
+        stored = await get_bot().copy_message(broadcasts.BROADCAST_STORAGE_CHAT_ID, message.chat.id, message.message_id)
+        await state.update_data(bc_text=None, bc_message_id=stored.message_id)
+    elif message.text:
+        await state.update_data(bc_text=message.html_text, bc_message_id=None)
+    else:
+        await message.answer("⚠️ Для рассылки фото, видео и файлов задайте BROADCAST_STORAGE_CHAT_ID в config. Отправьте текст:")
+        return
+    await state.set_state(Broadcast.waiting_for_time)
+    await message.answer(
+        "🕒 Когда отправить? Выберите вариант или пришлите дату и время в формате ДД.ММ.ГГГГ ЧЧ:ММ",
+        reply_markup=broadcast_time_kb()
+    )
+
+
+async def schedule_broadcast(admin_id: int, state: FSMContext, when: datetime) -> str:
+    data = await state.get_data()
+    broadcast_id = await db.create_broadcast(
+        data["bc_segment"], data["bc_arg"], when, admin_id,
+        text=data.get("bc_text"),
+        source_chat_id=broadcasts.BROADCAST_STORAGE_CHAT_ID if data.get("bc_message_id") else None,
+        source_message_id=data.get("bc_message_id"),
+    )
     await state.clear()
+    if when <= datetime.now():
+        broadcasts.wake_up()
+    return (
+        f"✅ Рассылка #{broadcast_id} запланирована на {when.strftime('%d.%m.%Y %H:%M')}\n"
+        f"🎯 {broadcasts.segment_label(data['bc_segment'], data['bc_arg'])}: {data['bc_count']} получателей"
+    )
+
+
+@dp.callback_query(Broadcast.waiting_for_time, F.data.startswith("bc_when:"))
+async def broadcast_time_selected(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    choice = callback.data.split(":", 1)[1]
+    now = datetime.now()
+    if choice == "tomorrow":
+        when = (now + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+    else:
+        when = now + timedelta(seconds=int(choice))
+    text = await schedule_broadcast(callback.from_user.id, state, when)
+    await callback.message.edit_text(text, reply_markup=manage_users_keyboard(callback.from_user.id))
+
+
+@dp.message(Broadcast.waiting_for_time)
+async def broadcast_time_entered(message: types.Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        await message.answer("Доступ запрещён")
+        return
+    try:
+        when = datetime.strptime((message.text or "").strip(), "%d.%m.%Y %H:%M")
+    except ValueError:
+        await message.answer("❌ Формат: ДД.ММ.ГГГГ ЧЧ:ММ, например 25.12.2025 18:30", reply_markup=broadcast_time_kb())
+        return
+    text = await schedule_broadcast(message.from_user.id, state, when)
+    await message.answer(text, reply_markup=manage_users_keyboard(message.from_user.id))
+
+
+BROADCAST_STATUS_ICONS = {"scheduled": "🕒", "sending": "📤", "done": "✅", "cancelled": "✖️"}
+
+
+async def show_broadcast_list(message: types.Message):
+    items = await db.get_broadcasts(limit=10)
+    lines = ["📋 <b>Рассылки</b>"]
+    rows = []
+    for b in items:
+        when = datetime.fromisoformat(b["scheduled_at"]).strftime("%d.%m %H:%M")
+        lines.append(
+            f"{BROADCAST_STATUS_ICONS.get(b['status'], '')} #{b['id']} {when} — "
+            f"{broadcasts.segment_label(b['segment'], b['segment_arg'])}, отправлено {b['sent']}, ошибок {b['failed']}"
+        )
+        if b["status"] in ("scheduled", "sending"):
+            rows.append([InlineKeyboardButton(text=f"✖️ Отменить #{b['id']}", callback_data=f"bc_cancel:{b['id']}")])
+    if not items:
+        lines.append("Рассылок пока нет.")
+    rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="broadcast_all")])
+    await message.edit_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+
+
+@dp.callback_query(F.data == "bc_list")
+async def broadcast_list(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    await show_broadcast_list(callback.message)
+
+
+@dp.callback_query(F.data.startswith("bc_cancel:"))
+async def broadcast_cancel(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    broadcast_id = int(callback.data.split(":", 1)[1])
+    if await db.finish_broadcast(broadcast_id, "cancelled"):
+        await callback.answer(f"Рассылка #{broadcast_id} отменена")
+    else:
+        await callback.answer("Рассылка уже завершена", show_alert=True)
+    await show_broadcast_list(callback.message)
 
 
 @dp.callback_query(F.data == "direct_message")
@@ -724,15 +1239,494 @@ async def direct_message_send(message: types.Message, state: FSMContext):
         await state.clear()
         return
     try:
-        await user_sender_bot.send_message(user_id, message.text, disable_notification=getattr(config, "SILENT_MODE", False))
+        await get_user_sender_bot().send_message(user_id, message.text, disable_notification=getattr(config, "SILENT_MODE", False))
         await message.answer("✅ Сообщение отправлено.", reply_markup=manage_users_keyboard(message.from_user.id))
     except Exception as e:
-        logger.error(f"Ошибка отправки DM: {e}")
+        logger.error("Ошибка отправки DM: %s", e)
         await message.answer(f"❌ Не удалось отправить сообщение: {e}", reply_markup=manage_users_keyboard(message.from_user.id))
     await state.clear()
 
 
+# ---------------- Заявки на покупку ----------------
+PENDING_PAGE_SIZE = 10
+
+
+async def _deliver_invite_job(user_id: int, subscription_end: datetime, service_id: Optional[int] = None):
+    # ссылки с заявкой на вступление: доступ решает обработчик chat_join_request
+    await channels.deliver_access(get_bot(), get_user_sender_bot(), user_id, subscription_end, service_id)
+
+
+async def _notify_rejected_job(user_id: int):
+    await get_user_sender_bot().send_message(user_id, "❌ Ваша заявка на покупку отклонена. Свяжитесь с администратором через /start.")
+
+
+async def approve_and_deliver(purchase_ids: List[int]) -> List[Dict[str, Any]]:
+    """Одобряет заявки одной транзакцией; выдача доступа уходит в фоновую очередь"""
+    approved = await db.approve_purchases(purchase_ids)
+    for item in approved:
+        await notify_queue.put(
+            lambda uid=item["user_id"], end=item["subscription_end"], sid=item["service_id"]: _deliver_invite_job(uid, end, sid)
+        )
+    return approved
+
+
+async def _mark_notification(message: types.Message, status_line: str):
+    """Дописывает итог в уведомление о заявке и убирает кнопки"""
+    try:
+        if message.photo:
+            await message.edit_caption(caption=f"{message.caption or ''}\n\n{status_line}", reply_markup=None)
+        else:
+            await message.edit_text(f"{message.text or ''}\n\n{status_line}", reply_markup=None)
+    except Exception as e:
+        logger.debug("Не удалось обновить уведомление: %s", e)
+
+
+@dp.callback_query(F.data.startswith("approve_"))
+async def approve_purchase_cb(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    try:
+        purchase_id = int(callback.data.replace("approve_", ""))
+    except ValueError:
+        await callback.answer("Ошибка ID", show_alert=True)
+        return
+    approved = await approve_and_deliver([purchase_id])
+    if not approved:
+        # повторное нажатие или заявку уже обработал другой админ
+        await callback.answer("Заявка уже обработана")
+        await _mark_notification(callback.message, "ℹ️ Уже обработана")
+        return
+    await callback.answer("✅ Подтверждено")
+    end = approved[0]["subscription_end"]
+    await _mark_notification(callback.message, f"✅ Подтверждено @{callback.from_user.username or callback.from_user.id}, до {end:%d.%m.%Y %H:%M}")
+
+
+@dp.callback_query(F.data.startswith("reject_"))
+async def reject_purchase_cb(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    try:
+        purchase_id = int(callback.data.replace("reject_", ""))
+    except ValueError:
+        await callback.answer("Ошибка ID", show_alert=True)
+        return
+    user_id = await db.reject_purchase(purchase_id)
+    if user_id is None:
+        await callback.answer("Заявка уже обработана")
+        await _mark_notification(callback.message, "ℹ️ Уже обработана")
+        return
+    await notify_queue.put(lambda: _notify_rejected_job(user_id))
+    await callback.answer("❌ Отклонено")
+    await _mark_notification(callback.message, f"❌ Отклонено @{callback.from_user.username or callback.from_user.id}")
+
+
+async def send_pending_page(message: types.Message, state: FSMContext, notice: str = ""):
+    data = await state.get_data()
+    offset = data.get("pending_offset", 0)
+    try:
+        total = await db.count_pending_purchases()
+        page = await db.get_pending_purchases_page(offset=offset, limit=PENDING_PAGE_SIZE)
+        if not page and offset:
+            offset = 0
+            await state.update_data(pending_offset=0)
+            page = await db.get_pending_purchases_page(offset=0, limit=PENDING_PAGE_SIZE)
+    except Exception as e:
+        logger.warning("Не удалось получить заявки: %s", e)
+        total, page = 0, []
+    await state.update_data(pending_page_ids=[p["id"] for p in page])
+    lines = [f"🕒 <b>Заявки на покупку</b> (всего: {total})\n"]
+    if notice:
+        lines.insert(0, notice + "\n")
+    buttons = []
+    for p in page:
+        username = p.get("username") or f"id{p['user_id']}"
+        lines.append(f"#{p['id']} @{username} — {p.get('service_name') or '?'} ({int(p.get('price') or 0)} руб.)")
+        buttons.append([InlineKeyboardButton(text=f"✅ #{p['id']} @{username}", callback_data=f"pq_ok_{p['id']}"),
+                        InlineKeyboardButton(text="❌", callback_data=f"pq_no_{p['id']}")])
+    if page:
+        buttons.append([InlineKeyboardButton(text=f"✅ Одобрить все на странице ({len(page)})", callback_data="pq_approve_page")])
+        buttons.append([InlineKeyboardButton(text="⬅️ Пред", callback_data="pq_prev"),
+                        InlineKeyboardButton(text="➡️ След", callback_data="pq_next")])
+    else:
+        lines.append("Нет открытых заявок.")
+    buttons.append([InlineKeyboardButton(text="🏠 Назад", callback_data="admin_menu")])
+    await message.edit_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+
+
+@dp.callback_query(F.data == "pending_queue")
+async def pending_queue(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    await state.update_data(pending_offset=0)
+    await send_pending_page(callback.message, state)
+
+
+@dp.callback_query(F.data.in_({"pq_prev", "pq_next"}))
+async def pending_pagination(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    data = await state.get_data()
+    offset = data.get("pending_offset", 0)
+    offset = offset + PENDING_PAGE_SIZE if callback.data == "pq_next" else max(0, offset - PENDING_PAGE_SIZE)
+    await state.update_data(pending_offset=offset)
+    await send_pending_page(callback.message, state)
+
+
+@dp.callback_query(F.data == "pq_approve_page")
+async def pending_approve_page(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    data = await state.get_data()
+    ids = data.get("pending_page_ids") or []
+    try:
+        approved = await approve_and_deliver(ids)
+    except Exception as e:
+        logger.exception("Ошибка массового одобрения заявок")
+        await callback.answer(f"Ошибка: {e}", show_alert=True)
+        return
+    await callback.answer(f"✅ Одобрено: {len(approved)}")
+    await send_pending_page(callback.message, state, notice=f"✅ Одобрено заявок: {len(approved)} из {len(ids)}")
+
+
+@dp.callback_query(F.data.startswith("pq_ok_") | F.data.startswith("pq_no_"))
+async def pending_single_action(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    try:
+        purchase_id = int(callback.data[len("pq_ok_"):])
+    except ValueError:
+        await callback.answer("Ошибка ID", show_alert=True)
+        return
+    if callback.data.startswith("pq_ok_"):
+        done = bool(await approve_and_deliver([purchase_id]))
+        notice = f"✅ Заявка #{purchase_id} одобрена" if done else f"ℹ️ Заявка #{purchase_id} уже обработана"
+    else:
+        user_id = await db.reject_purchase(purchase_id)
+        if user_id is not None:
+            await notify_queue.put(lambda: _notify_rejected_job(user_id))
+        notice = f"❌ Заявка #{purchase_id} отклонена" if user_id is not None else f"ℹ️ Заявка #{purchase_id} уже обработана"
+    await callback.answer()
+    await send_pending_page(callback.message, state, notice=notice)
+
+
+# ---------------- Статистика ----------------
+def format_statistics(stats: Dict[str, Any]) -> str:
+    lines = [
+        "📊 <b>Статистика</b>\n",
+        f"✅ Активных: {stats['active']}",
+        f"❌ Неактивных: {stats['inactive']}",
+        f"📦 В архиве: {stats.get('archived', 0)}",
+    ]
+    if stats["by_service"]:
+        lines.append("\n💼 <b>Активные по услугам:</b>")
+        for row in stats["by_service"]:
+            lines.append(f"• {row['name'] or ('#' + str(row['service_id']))}: {row['users']}")
+    lines.append("\n⏳ <b>Истекают по дням:</b>")
+    if stats["expiry_by_day"]:
+        for row in stats["expiry_by_day"]:
+            lines.append(f"• {row['day']}: {row['users']}")
+    else:
+        lines.append("• —")
+    revenue_by_day: Dict[str, float] = {}
+    revenue_by_service: Dict[str, float] = {}
+    for row in stats["revenue"]:
+        revenue_by_day[row["day"]] = revenue_by_day.get(row["day"], 0) + row["amount"]
+        name = row["name"] or f"#{row['service_id']}"
+        revenue_by_service[name] = revenue_by_service.get(name, 0) + row["amount"]
+    lines.append(f"\n💰 <b>Выручка за 30 дней:</b> {int(sum(revenue_by_day.values()))} руб.")
+    for name, amount in sorted(revenue_by_service.items(), key=lambda item: -item[1]):
+        lines.append(f"• {name}: {int(amount)} руб.")
+    for day, amount in list(revenue_by_day.items())[:7]:
+        lines.append(f"  {day}: {int(amount)} руб.")
+    return "\n".join(lines)
+
+
+@dp.callback_query(F.data == "statistics")
+async def statistics(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    try:
+        stats = await db.get_statistics()
+    except Exception as e:
+        logger.warning("Не удалось получить статистику: %s", e)
+        await callback.message.edit_text(f"❌ Ошибка статистики: {e}", reply_markup=admin_main_keyboard(callback.from_user.id))
+        return
+    await callback.message.edit_text(format_statistics(stats), reply_markup=admin_main_keyboard(callback.from_user.id))
+
+
+# ---------------- Вступление в каналы ----------------
+CHANNEL_MEMBER_STATUSES = {ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR}
+
+
+@dp.chat_join_request(F.chat.id.func(channels.is_registered))
+async def channel_join_request(request: types.ChatJoinRequest):
+    # решение по кэшу подписок; промах проверяем по БД — подписку могли оформить
+    # через другой экземпляр до очередного обновления кэша. Сам вызов уходит в пул канала
+    user_id, chat_id = request.from_user.id, request.chat.id
+    entitled = entitlements.is_entitled(user_id, chat_id)
+    if not entitled:
+        try:
+            entitled = await db.load_user_entitlement(user_id) and entitlements.is_entitled(user_id, chat_id)
+        except Exception as e:
+            logger.warning(
+                "Не удалось проверить подписку пользователя %s в БД: %s", user_id, e,
+                extra={"sample": "join_request_check_failed", "user_id": user_id},
+            )
+    if entitled:
+        await channels.pool(chat_id).put(request.approve)
+    else:
+        await channels.pool(chat_id).put(request.decline)
+
+
+def member_status(member) -> str:
+    """Статус участника для channel_members (restricted-участник считается member)"""
+    status = member.status.value if hasattr(member.status, "value") else str(member.status)
+    if status == ChatMemberStatus.RESTRICTED:
+        return "member" if getattr(member, "is_member", False) else "left"
+    return status
+
+
+@dp.chat_member(F.chat.id.func(channels.is_registered))
+async def channel_member_updated(event: types.ChatMemberUpdated):
+    member = event.new_chat_member
+    try:
+        await db.set_channel_member_statuses(event.chat.id, [(member.user.id, member_status(member))])
+    except Exception as e:
+        logger.warning(
+            "Не удалось записать статус участника %s: %s", member.user.id, e,
+            extra={"sample": "member_status_failed", "user_id": member.user.id},
+        )
+
+
+async def remove_from_channels(user_id: int) -> List[str]:
+    """Удаляет пользователя из всех каналов, где он может быть; возвращает ошибки по каналам"""
+    errors: List[str] = []
+    async for _, errors in channels.remove_users(get_bot(), [user_id]):
+        pass
+    if not errors:
+        try:
+            await db.mark_user_removed_from_channel(user_id)
+        except Exception:
+            logger.debug("Не удалось отметить удаление из канала")
+    return errors
+
+
+async def _reconcile_channel(chat_id: int, limit: int) -> int:
+    rows = await db.get_membership_drift(chat_id, limit=limit)
+    queue = channels.check_queue(chat_id)
+    futures = [
+        await queue.put(lambda uid=row["user_id"]: get_bot().get_chat_member(chat_id, uid))
+        for row in rows
+    ]
+    verified = []
+    for row, future in zip(rows, futures):
+        try:
+            member = await future
+        except Exception as e:
+            logger.debug(
+                "get_chat_member %s/%s не удался: %s", chat_id, row['user_id'], e,
+                extra={"sample": "member_check_failed", "user_id": row['user_id']},
+            )
+            continue
+        verified.append((row["user_id"], member_status(member)))
+    if verified:
+        await db.set_channel_member_statuses(chat_id, verified, verified=True)
+    return len(verified)
+
+
+async def reconcile_channel_membership(limit: int = 200) -> int:
+    """Проверяет расхождения через get_chat_member во всех каналах параллельно
+    и записывает подтверждённые статусы (в т.ч. участников, добавленных вручную)"""
+    registered = channels.registered()
+    results = await asyncio.gather(
+        *(_reconcile_channel(channel["chat_id"], limit) for channel in registered), return_exceptions=True
+    )
+    checked = 0
+    for channel, result in zip(registered, results):
+        if isinstance(result, Exception):
+            logger.warning("Сверка участников канала %s не удалась: %s", channels.title(channel['chat_id']), result)
+        else:
+            checked += result
+    return checked
+
+
+# ---------------- Каналы ----------------
+class AddChannel(StatesGroup):
+    waiting_for_chat = State()
+
+
+async def channels_menu_view() -> tuple:
+    services = {s["id"]: s["name"] for s in await db.get_services()}
+    lines = ["📡 <b>Каналы</b>\n"]
+    buttons = []
+    for channel in channels.registered():
+        granted = [services.get(service_id, f"#{service_id}") for service_id in channel["services"]]
+        access = ", ".join(granted) if granted else "—"
+        default = " ⭐️ по умолчанию" if channel["is_default"] else ""
+        lines.append(f"• <b>{channels.title(channel['chat_id'])}</b> (<code>{channel['chat_id']}</code>){default}\n  Услуги: {access}")
+        buttons.append([InlineKeyboardButton(text=f"⚙️ {channels.title(channel['chat_id'])}", callback_data=f"ch_view:{channel['chat_id']}")])
+    if not channels.registered():
+        lines.append("Каналов пока нет.")
+    lines.append("\nУслуги без своих каналов дают доступ к каналам по умолчанию.")
+    buttons.append([InlineKeyboardButton(text="➕ Добавить канал", callback_data="ch_add")])
+    buttons.append([InlineKeyboardButton(text="🏠 Назад", callback_data="admin_menu")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+async def channel_view(chat_id: int) -> tuple:
+    channel = channels.get(chat_id)
+    services = await db.get_services()
+    lines = [
+        f"📡 <b>{channels.title(chat_id)}</b> (<code>{chat_id}</code>)",
+        f"По умолчанию: {'да' if channel['is_default'] else 'нет'}",
+        "\nОтметьте услуги, которые дают доступ к каналу:",
+    ]
+    buttons = [[InlineKeyboardButton(
+        text="⭐️ Снять «по умолчанию»" if channel["is_default"] else "⭐️ Сделать каналом по умолчанию",
+        callback_data=f"ch_default:{chat_id}"
+    )]]
+    for s in services:
+        mark = "✅" if s["id"] in channel["services"] else "▫️"
+        buttons.append([InlineKeyboardButton(text=f"{mark} {s['name']}", callback_data=f"ch_svc:{chat_id}:{s['id']}")])
+    buttons.append([InlineKeyboardButton(text="🗑 Удалить канал", callback_data=f"ch_del:{chat_id}")])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="channels_menu")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.callback_query(F.data == "channels_menu")
+async def channels_menu(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    await state.clear()
+    text, kb = await channels_menu_view()
+    await callback.message.edit_text(text, reply_markup=kb)
+
+
+@dp.callback_query(F.data.startswith("ch_view:") | F.data.startswith("ch_default:") | F.data.startswith("ch_svc:"))
+async def channel_settings(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    action, *args = callback.data.split(":")
+    try:
+        chat_id = int(args[0])
+        service_id = int(args[1]) if action == "ch_svc" else None
+    except (IndexError, ValueError):
+        await callback.answer("Ошибка ID", show_alert=True)
+        return
+    channel = channels.get(chat_id)
+    if channel is None:
+        await callback.answer("Канал не найден", show_alert=True)
+        return
+    if action == "ch_default":
+        await db.set_channel_default(chat_id, not channel["is_default"])
+    elif action == "ch_svc":
+        await db.set_service_channel(service_id, chat_id, service_id not in channel["services"])
+    if action != "ch_view":
+        await channels.refresh()
+    await callback.answer()
+    text, kb = await channel_view(chat_id)
+    await callback.message.edit_text(text, reply_markup=kb)
+
+
+@dp.callback_query(F.data.startswith("ch_del:"))
+async def channel_delete(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    try:
+        chat_id = int(callback.data.split(":")[1])
+    except (IndexError, ValueError):
+        await callback.answer("Ошибка ID", show_alert=True)
+        return
+    await db.remove_channel(chat_id)
+    await channels.refresh()
+    await callback.answer("🗑 Канал удалён")
+    text, kb = await channels_menu_view()
+    await callback.message.edit_text(text, reply_markup=kb)
+
+
+@dp.callback_query(F.data == "ch_add")
+async def channel_add_start(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещён")
+        return
+    await callback.answer()
+    await callback.message.edit_text(
+        "📡 Перешлите сюда любое сообщение из канала или отправьте его ID (например, <code>-1001234567890</code>).\n\n"
+        "Админ-бот должен быть администратором канала с правами приглашать и блокировать пользователей.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="channels_menu")]])
+    )
+    await state.set_state(AddChannel.waiting_for_chat)
+
+
+@dp.message(AddChannel.waiting_for_chat)
+async def channel_add_received(message: types.Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        await message.answer("Доступ запрещён")
+        return
+    if isinstance(message.forward_origin, MessageOriginChannel):
+        chat_id = message.forward_origin.chat.id
+    else:
+        try:
+            chat_id = int((message.text or "").strip())
+        except ValueError:
+            await message.answer("❌ Перешлите сообщение из канала или отправьте числовой ID.")
+            return
+    try:
+        chat = await get_bot().get_chat(chat_id)
+        member = await get_bot().get_chat_member(chat_id, get_bot().id)
+    except Exception as e:
+        await message.answer(f"❌ Нет доступа к каналу: {e}")
+        return
+    await state.clear()
+    await db.add_channel(chat_id, chat.title)
+    await channels.refresh()
+    warning = "" if getattr(member, "status", None) == "administrator" else "\n⚠️ Бот не админ канала!"
+    text, kb = await channels_menu_view()
+    await message.answer(f"✅ Канал «{chat.title}» добавлен.{warning}\n\n{text}", reply_markup=kb)
+
+
 # ---------------- Diagnostics ----------------
+CHANNEL_CHECK_TIMEOUT = 10
+
+
+async def _channel_diagnostics(chat_id: int) -> List[str]:
+    lines = []
+    try:
+        chat = await get_bot().get_chat(chat_id)
+        lines.append(f"✅ Канал: {chat.title} (<code>{chat_id}</code>)")
+        lines.append(f"   Тип: {chat.type}")
+        if chat.title != channels.title(chat_id):
+            await db.add_channel(chat_id, chat.title)
+    except Exception as e:
+        lines.append(f"❌ Ошибка доступа к каналу {channels.title(chat_id)}: {e}")
+    try:
+        member = await get_bot().get_chat_member(chat_id, get_bot().id)
+        status = getattr(member, "status", None)
+        lines.append(f"   Статус бота в канале: {status}")
+        if status == "administrator":
+            lines.append(f"   Права приглашать: {'✅' if getattr(member, 'can_invite_users', False) else '❌'}, "
+                         f"блокировать: {'✅' if getattr(member, 'can_restrict_members', False) else '❌'}")
+        else:
+            lines.append("   ⚠️ Бот не админ канала!")
+    except Exception as e:
+        lines.append(f"❌ Ошибка проверки статуса бота в канале {channels.title(chat_id)}: {e}")
+    return lines
+
+
 @dp.callback_query(F.data == "diagnostics")
 async def diagnostics(callback: types.CallbackQuery):
     if not await is_admin(callback.from_user.id):
@@ -741,30 +1735,77 @@ async def diagnostics(callback: types.CallbackQuery):
     await callback.answer()
     issues = []
     try:
-        me = await bot.get_me()
+        me = await get_bot().get_me()
         issues.append(f"✅ Бот: @{me.username}")
     except Exception as e:
         issues.append(f"❌ Ошибка получения информации о боте: {e}")
-    if PRIVATE_CHANNEL_ID is None:
-        issues.append("❌ PRIVATE_CHANNEL_ID не задан в config")
+    registered = channels.registered()
+    if not registered:
+        issues.append("❌ Каналы не настроены (PRIVATE_CHANNEL_ID в config или меню «Каналы»)")
+    # все каналы проверяются одновременно; зависший канал не задерживает остальные
+    results = await asyncio.gather(*(
+        asyncio.wait_for(_channel_diagnostics(channel["chat_id"]), CHANNEL_CHECK_TIMEOUT) for channel in registered
+    ), return_exceptions=True)
+    for channel, result in zip(registered, results):
+        if isinstance(result, asyncio.TimeoutError):
+            issues.append(f"❌ Канал {channels.title(channel['chat_id'])}: нет ответа за {CHANNEL_CHECK_TIMEOUT} с")
+        elif isinstance(result, Exception):
+            issues.append(f"❌ Канал {channels.title(channel['chat_id'])}: {result}")
+        else:
+            issues.extend(result)
+    for p in channels.pool_stats():
+        issues.append(
+            f"📡 Пул канала {channels.title(p['chat_id'])}: в очереди {p['queued']}, "
+            f"выполнено {p['processed']}, ошибок {p['failed']}"
+        )
+    http = bots.session().pool_stats()
+    issues.append(f"🌐 Bot API (общая сессия ботов): соединений {http['open']}, простаивает {http['idle']}")
+    for name, middleware in throttling.registry.items():
+        m = middleware.snapshot()
+        issues.append(
+            f"🛡 Антифлуд {name}: пропущено {m['passed']}, отброшено {m['throttled']}, "
+            f"склеено {m['coalesced']}, пользователей в памяти {m['tracked_users']}"
+        )
+    lag = loop_monitor.monitor.snapshot()
+    runtime = performance.describe()
+    issues.append(
+        f"⏱ Задержка цикла событий ({runtime['loop']}, JSON: {runtime['json']}): p50 {lag['p50']} мс, p95 {lag['p95']} мс, p99 {lag['p99']} мс, "
+        f"макс. {lag['max']} мс, блокировок {lag['stalls']}"
+    )
+    e = leader.election.snapshot()
+    lease = await db.get_lease(leader.election.name)
+    holder = "этот экземпляр" if e["leader"] else (lease["holder"] if lease else "нет")
+    token = lease["token"] if lease else "-"
+    issues.append(f"👑 Лидер: {holder}, токен {token}; выборов {e['elected']}, потерь {e['lost']}")
+    if BACKEND_NAME == "sqlite":
+        report = maintenance.last_report
+        if report.get("backup_at"):
+            issues.append(
+                f"💾 Бэкап {report['backup_at']}: {report['backup_bytes'] // 1024} КБ "
+                f"за {report['backup_seconds']} с"
+            )
+        if report.get("maintenance_at"):
+            issues.append(f"🧹 Обслуживание {report['maintenance_at']}: освобождено страниц {report['vacuum_pages']}")
+        issues.append(f"🗄 Размер БД: {maintenance.database_size() // 1024} КБ")
+    w = db.write_stats()
+    if "batches" in w:
+        issues.append(
+            f"✍️ Запись в БД: {w['committed']} операций в {w['batches']} транзакциях "
+            f"(в среднем {w['avg_batch']}, макс. {w['max_batch']}), коммит {w['avg_commit_ms']} мс, "
+            f"ошибок {w['failed']}, в очереди {w['queued']}"
+        )
     else:
-        try:
-            chat = await bot.get_chat(PRIVATE_CHANNEL_ID)
-            issues.append(f"✅ Канал: {chat.title}")
-            issues.append(f"   Тип: {chat.type}")
-        except Exception as e:
-            issues.append(f"❌ Ошибка доступа к каналу: {e}")
-        try:
-            member = await bot.get_chat_member(PRIVATE_CHANNEL_ID, (await bot.get_me()).id)
-            status = getattr(member, "status", None)
-            issues.append(f"✅ Статус бота в канале: {status}")
-            if status == "administrator":
-                perms = getattr(member, "can_invite_users", False)
-                issues.append(f"   Права приглашать: {'✅' if perms else '❌'}")
-            else:
-                issues.append("   ⚠️ Бот не админ канала!")
-        except Exception as e:
-            issues.append(f"❌ Ошибка проверки статуса бота в канале: {e}")
+        issues.append(
+            f"✍️ Запись в БД ({BACKEND_NAME}): {w['committed']} транзакций, ошибок {w['failed']}, "
+            f"соединений {w['pool_size']} (свободно {w['pool_idle']})"
+        )
+    for name, scheduler in update_scheduler.registry.items():
+        m = scheduler.snapshot()
+        issues.append(
+            f"🧵 Очереди апдейтов {name}: активных {m['lanes']}, в очереди {m['queued']}, "
+            f"выполняется {m['running']}/{m['limit']}, макс. глубина {m['max_depth']} "
+            f"(пик {m['peak_depth']}), обработано {m['processed']}"
+        )
     await callback.message.edit_text("\n".join(issues), reply_markup=admin_main_keyboard(callback.from_user.id))
 
 
@@ -773,6 +1814,6 @@ async def init_admin_bot():
     try:
         await db.init_db()
     except Exception as e:
-        logger.warning(f"Не удалось инициализировать БД: {e}")
+        logger.warning("Не удалось инициализировать БД: %s", e)
 
 # Конец файла
@@ -0,0 +1,113 @@
+"""One Bot per token on one shared, tuned HTTP session.
+
+Every module gets its bots here (admin() and user()), and both tokens send
+through the same AiohttpSession: one connection pool with keep-alive and a
+DNS cache instead of a pool and TLS handshakes per Bot object. Timeouts
+depend on the call: file uploads get longer, answers to callback and
+pre-checkout queries (useless once Telegram stops waiting) shorter; long
+polling adds its own wait to the default. main.py calls close() on shutdown.
+"""
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.enums import ParseMode
+from aiogram.methods import TelegramMethod
+
+import config
+import performance
+import tracing
+
+# None is api.telegram.org; a local Bot API server or fake_bot_api.py otherwise
+BOT_API_SERVER = getattr(config, "BOT_API_SERVER", None)
+BOT_API_CONNECTION_LIMIT = getattr(config, "BOT_API_CONNECTION_LIMIT", 100)
+BOT_API_KEEPALIVE = getattr(config, "BOT_API_KEEPALIVE", 60)
+BOT_API_DNS_CACHE_TTL = getattr(config, "BOT_API_DNS_CACHE_TTL", 3600)
+BOT_API_TIMEOUTS = {"default": 15, "upload": 120, "answer": 5, **getattr(config, "BOT_API_TIMEOUTS", {})}
+
+_UPLOAD_METHODS = frozenset({
+    "sendDocument", "sendPhoto", "sendVideo", "sendAudio", "sendAnimation",
+    "sendVoice", "sendVideoNote", "sendSticker", "sendMediaGroup",
+})
+_ANSWER_METHODS = frozenset({
+    "answerCallbackQuery", "answerPreCheckoutQuery", "answerShippingQuery", "answerInlineQuery",
+})
+
+
+class TunedSession(AiohttpSession):
+    """AiohttpSession with keep-alive, DNS cache and per-call-type timeouts"""
+
+    def __init__(self, timeouts: Dict[str, float], limit: int, keepalive: float, dns_cache_ttl: int, **kwargs):
+        super().__init__(limit=limit, timeout=timeouts["default"], **kwargs)
+        # aiogram builds its TCPConnector from these arguments
+        self._connector_init.update(keepalive_timeout=keepalive, ttl_dns_cache=dns_cache_ttl)
+        self.timeouts = timeouts
+
+    def timeout_for(self, method: TelegramMethod) -> float:
+        name = method.__api_method__
+        if name in _UPLOAD_METHODS:
+            return self.timeouts["upload"]
+        if name in _ANSWER_METHODS:
+            return self.timeouts["answer"]
+        return self.timeouts["default"]
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None):
+        # an explicit timeout (long polling passes one) wins
+        return await super().make_request(bot, method, self.timeout_for(method) if timeout is None else timeout)
+
+    def pool_stats(self) -> Dict[str, int]:
+        connector = self._session.connector if self._session is not None and not self._session.closed else None
+        if connector is None:
+            return {"open": 0, "idle": 0}
+        idle = sum(len(conns) for conns in connector._conns.values())
+        return {"open": len(connector._acquired) + idle, "idle": idle}
+
+
+_session: Optional[TunedSession] = None
+_bots: Dict[str, Bot] = {}
+
+
+def session() -> TunedSession:
+    """The HTTP session shared by every bot, created on first use"""
+    global _session
+    if _session is None:
+        # orjson with the performance profile, the json module otherwise
+        json_loads, json_dumps = performance.json_codecs()
+        _session = TunedSession(
+            BOT_API_TIMEOUTS,
+            limit=BOT_API_CONNECTION_LIMIT,
+            keepalive=BOT_API_KEEPALIVE,
+            dns_cache_ttl=BOT_API_DNS_CACHE_TTL,
+            api=TelegramAPIServer.from_base(BOT_API_SERVER) if BOT_API_SERVER else PRODUCTION,
+            json_loads=json_loads,
+            json_dumps=json_dumps,
+        )
+        tracing.instrument_session(_session)
+    return _session
+
+
+def get(token: str) -> Bot:
+    """The one Bot for this token (no session is opened until the first request)"""
+    bot = _bots.get(token)
+    if bot is None:
+        bot = _bots[token] = Bot(token=token, session=session(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    return bot
+
+
+def admin() -> Bot:
+    return get(config.ADMIN_BOT_TOKEN)
+
+
+def user() -> Bot:
+    return get(config.USER_BOT_TOKEN)
+
+
+async def close():
+    """Close the shared session; bots asked for afterwards get a new one"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+    _bots.clear()
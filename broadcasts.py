@@ -0,0 +1,123 @@
+"""Segmented, scheduled broadcasts.
+
+Admins create broadcasts in admin_bot; each one is persisted in the
+`broadcasts` table with its audience segment and send time. The leader
+instance polls for due broadcasts, walks the segment in user_id order
+(indexed queries, BROADCAST_BATCH_SIZE users at a time) and sends through a
+rate-limited queue with the user bot. Messages are sent with copy_message
+from BROADCAST_STORAGE_CHAT_ID, so photos and videos are not re-uploaded;
+without a storage chat only text broadcasts are possible.
+
+Progress (last user_id, counters) is saved after every batch: a restart
+resumes where it stopped, and a cancelled broadcast stops after the batch
+in flight.
+"""
+import asyncio
+import logging
+
+import bots
+import config
+from repository import backend as db
+from rate_queue import RateLimitedQueue
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_STORAGE_CHAT_ID = getattr(config, "BROADCAST_STORAGE_CHAT_ID", None)
+BATCH_SIZE = getattr(config, "BROADCAST_BATCH_SIZE", 500)
+CHECK_INTERVAL = getattr(config, "BROADCAST_CHECK_INTERVAL", 30)
+
+SEGMENT_LABELS = {
+    "all": "Все пользователи",
+    "active": "Активные подписчики",
+    "expired": "Истёкшие за {arg} дн.",
+    "never_purchased": "Без покупок",
+    "language": "Язык: {arg}",
+    "service": "Услуга #{arg}",
+}
+
+broadcast_queue = RateLimitedQueue("broadcast", getattr(config, "BROADCAST_SEND_RATE", 25), maxsize=BATCH_SIZE)
+
+_wake = asyncio.Event()
+
+
+def segment_label(segment: str, arg: str | None) -> str:
+    return SEGMENT_LABELS.get(segment, segment).format(arg=arg)
+
+
+def wake_up():
+    """Check for due broadcasts now instead of at the next poll"""
+    _wake.set()
+
+
+async def _send(broadcast: dict, user_id: int):
+    silent = getattr(config, "SILENT_MODE", False)
+    if broadcast["source_message_id"]:
+        await bots.user().copy_message(
+            user_id, broadcast["source_chat_id"], broadcast["source_message_id"], disable_notification=silent
+        )
+    else:
+        await bots.user().send_message(user_id, broadcast["text"], disable_notification=silent)
+
+
+async def run_broadcast(broadcast: dict):
+    """Send a broadcast to its segment from its saved cursor; returns (sent, failed, cancelled)"""
+    sent = failed = 0
+    after = broadcast["last_user_id"]
+    while True:
+        user_ids = await db.get_segment_user_ids(broadcast["segment"], broadcast["segment_arg"], after, BATCH_SIZE)
+        if not user_ids:
+            break
+        futures = [
+            await broadcast_queue.put(lambda user_id=user_id: _send(broadcast, user_id))
+            for user_id in user_ids
+        ]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        batch_failed = sum(isinstance(result, BaseException) for result in results)
+        sent += len(results) - batch_failed
+        failed += batch_failed
+        after = user_ids[-1]
+        if not await db.record_broadcast_progress(broadcast["id"], after, len(results) - batch_failed, batch_failed):
+            return sent, failed, True
+        if len(user_ids) < BATCH_SIZE:
+            break
+    await db.finish_broadcast(broadcast["id"])
+    return sent, failed, False
+
+
+async def _report(broadcast: dict, sent: int, failed: int, cancelled: bool):
+    if not broadcast["created_by"]:
+        return
+    total_sent = broadcast["sent"] + sent
+    total_failed = broadcast["failed"] + failed
+    head = "✖️ Рассылка #{id} отменена" if cancelled else "✅ Рассылка #{id} завершена"
+    try:
+        await bots.admin().send_message(
+            broadcast["created_by"],
+            f"{head.format(id=broadcast['id'])} ({segment_label(broadcast['segment'], broadcast['segment_arg'])}).\n"
+            f"Отправлено: {total_sent}, ошибок: {total_failed}"
+        )
+    except Exception as e:
+        logger.warning("Failed to report broadcast %s to admin: %s", broadcast["id"], e)
+
+
+async def broadcast_loop():
+    """Background task (leader only): start due broadcasts and resume interrupted ones"""
+    while True:
+        try:
+            for broadcast in await db.get_due_broadcasts():
+                if broadcast["status"] == "scheduled" and not await db.start_broadcast(broadcast["id"]):
+                    continue
+                logger.info(
+                    "Broadcast %s to %s started (resuming after user %s)",
+                    broadcast["id"], segment_label(broadcast["segment"], broadcast["segment_arg"]), broadcast["last_user_id"],
+                )
+                sent, failed, cancelled = await run_broadcast(broadcast)
+                logger.info("Broadcast %s: %d sent, %d failed%s", broadcast["id"], sent, failed, ", cancelled" if cancelled else "")
+                await _report(broadcast, sent, failed, cancelled)
+        except Exception as e:
+            logger.error("Error in broadcast engine: %s", e)
+        _wake.clear()
+        try:
+            await asyncio.wait_for(_wake.wait(), CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,159 @@
+"""Channels granted by subscription plans and their Bot API worker pools.
+
+The `channels` table lists every channel the bots manage; `service_channels`
+maps each service to the channels it grants, and services without a list of
+their own grant the default channels (the configured PRIVATE_CHANNEL_ID is
+seeded as one). refresh() loads both into this module and into the
+entitlement cache.
+
+Each channel gets its own rate-limited worker pool (CHANNEL_WORKERS workers
+sharing CHANNEL_API_RATE calls per second) for removals and join requests,
+and its own low-rate queue for get_chat_member checks. A slow or
+misconfigured channel only backs up its own queues.
+
+deliver_access() sends a new subscriber the join links of their channels;
+it is shared by admin approval and Telegram Payments.
+"""
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+import entitlements
+from repository import backend as db
+from rate_queue import RateLimitedQueue
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_API_RATE = getattr(config, "CHANNEL_API_RATE", 20)
+CHANNEL_WORKERS = getattr(config, "CHANNEL_WORKERS", 4)
+MEMBERSHIP_CHECK_RATE = getattr(config, "MEMBERSHIP_CHECK_RATE", 2)
+
+_channels: Dict[int, dict] = {}
+_pools: Dict[int, RateLimitedQueue] = {}
+_check_queues: Dict[int, RateLimitedQueue] = {}
+
+
+async def refresh() -> int:
+    """Reload channels and service grants from the database; returns the channel count"""
+    global _channels
+    rows = await db.get_channels()
+    _channels = {row["chat_id"]: row for row in rows}
+    grants: Dict[int, List[int]] = {}
+    for row in rows:
+        for service_id in row["services"]:
+            grants.setdefault(service_id, []).append(row["chat_id"])
+    entitlements.set_channel_grants(grants, [row["chat_id"] for row in rows if row["is_default"]])
+    return len(_channels)
+
+
+def registered() -> List[dict]:
+    return list(_channels.values())
+
+
+def get(chat_id: int) -> Optional[dict]:
+    return _channels.get(chat_id)
+
+
+def is_registered(chat_id: int) -> bool:
+    return chat_id in _channels
+
+
+def title(chat_id: int) -> str:
+    channel = _channels.get(chat_id)
+    return (channel or {}).get("title") or str(chat_id)
+
+
+def granted_channels(service_id: Optional[int]) -> List[int]:
+    """Registered channels a subscription to this service gives access to"""
+    return [chat_id for chat_id in entitlements.channels_for_service(service_id) if chat_id in _channels]
+
+
+def pool(chat_id: int) -> RateLimitedQueue:
+    """The channel's worker pool for ban/unban and join-request calls"""
+    queue = _pools.get(chat_id)
+    if queue is None:
+        queue = _pools[chat_id] = RateLimitedQueue(f"channel:{chat_id}", CHANNEL_API_RATE, workers=CHANNEL_WORKERS)
+    return queue
+
+
+def check_queue(chat_id: int) -> RateLimitedQueue:
+    """The channel's low-priority queue for get_chat_member checks"""
+    queue = _check_queues.get(chat_id)
+    if queue is None:
+        queue = _check_queues[chat_id] = RateLimitedQueue(f"membership:{chat_id}", MEMBERSHIP_CHECK_RATE)
+    return queue
+
+
+def pool_stats() -> List[dict]:
+    return [
+        {"chat_id": chat_id, "queued": queue.qsize(), "processed": queue.processed, "failed": queue.failed}
+        for chat_id, queue in _pools.items()
+    ]
+
+
+async def join_link(bot: Bot, chat_id: int) -> str:
+    """The channel's join-request link, created once by the channel admin bot and cached in its row"""
+    channel = _channels.get(chat_id)
+    link = channel.get("join_link") if channel else None
+    if not link:
+        invite = await bot.create_chat_invite_link(chat_id, creates_join_request=True, name="subscribers")
+        link = invite.invite_link
+        await db.set_channel_join_link(chat_id, link)
+        if channel is not None:
+            channel["join_link"] = link
+    return link
+
+
+async def deliver_access(admin_bot: Bot, user_bot: Bot, user_id: int, subscription_end: datetime, service_id: Optional[int] = None):
+    """Сообщает пользователю об активации и даёт ссылки на каналы его услуги"""
+    text = f"✅ <b>Подписка активирована!</b>\n\n📅 До: {subscription_end:%d.%m.%Y %H:%M}"
+    granted = granted_channels(service_id)
+    buttons = []
+    for chat_id in granted:
+        try:
+            link = await join_link(admin_bot, chat_id)
+        except Exception as e:
+            logger.warning("Не удалось получить ссылку на канал %s: %s", chat_id, e)
+            continue
+        label = "🔗 Присоединиться к каналу" if len(granted) == 1 else f"🔗 {title(chat_id)}"
+        buttons.append([InlineKeyboardButton(text=label, url=link)])
+    kb = None
+    if buttons:
+        kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+        if len(buttons) == 1:
+            text += "\n\nНажмите кнопку ниже, чтобы присоединиться к приватному каналу:"
+        else:
+            text += "\n\nНажмите кнопки ниже, чтобы присоединиться к приватным каналам:"
+    await user_bot.send_message(user_id, text, reply_markup=kb)
+
+
+async def kick(bot: Bot, chat_id: int, user_id: int):
+    """Remove a user from a channel without banning them for good"""
+    await bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
+    await bot.unban_chat_member(chat_id=chat_id, user_id=user_id)
+
+
+async def remove_users(bot: Bot, user_ids: List[int]) -> AsyncIterator[Tuple[int, List[str]]]:
+    """Remove users from every channel they may be in; yields (user_id, errors) in order.
+
+    All removals are queued up front on the per-channel pools, so channels are
+    worked in parallel; a user is yielded once all of their channels are done.
+    """
+    plan = await db.get_channel_removals(user_ids)
+    pending: Dict[int, list] = {user_id: [] for user_id in user_ids}
+    for chat_id, members in plan.items():
+        queue = pool(chat_id)
+        for user_id in members:
+            pending[user_id].append((chat_id, await queue.put(lambda c=chat_id, u=user_id: kick(bot, c, u))))
+    for user_id in user_ids:
+        errors = []
+        for chat_id, future in pending[user_id]:
+            try:
+                await future
+            except Exception as e:
+                errors.append(f"{title(chat_id)}: {e}")
+        yield user_id, errors
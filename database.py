@@ -2,84 +2,481 @@ import aiosqlite
 import asyncio
 from datetime import datetime, timedelta
 import logging
+from pathlib import Path
+
+import config
+import entitlements
+from db_writer import GroupCommitWriter
 
 DATABASE_FILE = "bot_database.db"
 
+# Every mutation goes through this single writer task (batched group commit);
+# reads use their own read-only connections, which WAL lets run alongside it
+_writer = GroupCommitWriter(lambda: DATABASE_FILE, getattr(config, "DB_WRITE_BATCH_SIZE", 100))
+
+
+async def _write(op):
+    """Run op(db) in the writer's next batch; returns op's result after commit"""
+    return await _writer.submit(op)
+
+
+def write_stats() -> dict:
+    """Group-commit counters for diagnostics"""
+    return _writer.snapshot()
+
+
+async def close_db():
+    """Flush queued writes and close the writer connection"""
+    await _writer.close()
+
+
+def _read():
+    """Read-only connection for queries"""
+    connection = aiosqlite.connect(f"{Path(DATABASE_FILE).absolute().as_uri()}?mode=ro", uri=True)
+    # aiosqlite leaves the thread of a read cancelled while connecting running
+    # (shutdown does that); a daemon thread cannot keep the process from exiting
+    connection.daemon = True
+    return connection
+
+DEFAULT_BOT_CONFIG = {
+    "welcome_message": "👋 <b>Добро пожаловать!</b>\n\nЭтот бот предоставляет доступ к приватному каналу.\n\nВыберите действие:",
+    "btn_buy": "🛍 Купить подписку",
+    "btn_renew": "🔄 Продлить подписку",
+    "btn_my_sub": "ℹ️ Моя подписка",
+    "btn_contact": "✉️ Связаться с админом"
+}
+
+
+PURCHASE_STATUSES = ('pending', 'approved', 'rejected', 'expired')
+
+# chat_member statuses that mean "not in the channel"
+CHANNEL_NON_MEMBER_STATUSES = ('left', 'kicked')
+
+# Columns shared by users and users_archive, in table order
+USER_COLUMNS = (
+    "user_id, username, phone_number, subscription_end, is_active, photo_file_id, "
+    "added_to_channel, channel_member_removed, service_id, last_seen_at, language"
+)
+
+# Broadcast audiences; the argument is days (expired), language code or service id
+BROADCAST_SEGMENTS = ('all', 'active', 'expired', 'never_purchased', 'language', 'service')
+# Segments of active subscribers only; archived users never match them, so they skip users_archive
+ACTIVE_SEGMENTS = ('active', 'service')
+BROADCAST_STATUSES = ('scheduled', 'sending', 'done', 'cancelled')
+# user_bot shows this language to users who never picked one
+DEFAULT_LANGUAGE = "ru"
+
+# Set once init_db() has verified the schema in this process
+_schema_ready = False
+
+
+async def _migration_initial_schema(db):
+    """v1: base tables, indexes and seed data"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            phone_number TEXT,
+            subscription_end TEXT,
+            is_active INTEGER DEFAULT 0,
+            photo_file_id TEXT,
+            added_to_channel INTEGER DEFAULT 0,
+            channel_member_removed INTEGER DEFAULT 0
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS services (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            duration_days INTEGER NOT NULL,
+            price REAL NOT NULL,
+            duration_unit TEXT DEFAULT 'days'
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS pending_purchases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            username TEXT,
+            phone_number TEXT,
+            service_id INTEGER,
+            created_at TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active)")
+
+    cursor = await db.execute("SELECT COUNT(*) FROM services")
+    count = await cursor.fetchone()
+    if count[0] == 0:
+        import config
+        await db.execute(
+            "INSERT INTO services (name, duration_days, price, duration_unit) VALUES (?, ?, ?, ?)",
+            (config.DEFAULT_SERVICE_NAME, config.DEFAULT_SERVICE_DURATION, config.DEFAULT_SERVICE_PRICE, 'days')
+        )
+
+    await db.executemany(
+        "INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)",
+        [(f"userbot_{key}", value) for key, value in DEFAULT_BOT_CONFIG.items()]
+    )
+
+
+async def _migration_purchases_by_user(db):
+    """v2: index purchases by user for per-user lookups and exports"""
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_user ON pending_purchases(user_id)")
+
+
+def _stats_add_sql(row: str) -> str:
+    """Trigger body fragment adding a users row (NEW/OLD) to the aggregates"""
+    return f"""
+        UPDATE stats_counters SET value = value + 1
+            WHERE key = CASE WHEN {row}.is_active = 1 THEN 'active' ELSE 'inactive' END;
+        INSERT INTO stats_expiry_by_day (day, users)
+            SELECT substr({row}.subscription_end, 1, 10), 1
+            WHERE {row}.is_active = 1 AND {row}.subscription_end IS NOT NULL
+            ON CONFLICT(day) DO UPDATE SET users = users + 1;
+        INSERT INTO stats_service_active (service_id, users)
+            SELECT {row}.service_id, 1
+            WHERE {row}.is_active = 1 AND {row}.service_id IS NOT NULL
+            ON CONFLICT(service_id) DO UPDATE SET users = users + 1;
+    """
+
+
+def _stats_remove_sql(row: str) -> str:
+    """Trigger body fragment removing a users row (NEW/OLD) from the aggregates"""
+    return f"""
+        UPDATE stats_counters SET value = value - 1
+            WHERE key = CASE WHEN {row}.is_active = 1 THEN 'active' ELSE 'inactive' END;
+        UPDATE stats_expiry_by_day SET users = users - 1
+            WHERE {row}.is_active = 1 AND day = substr({row}.subscription_end, 1, 10);
+        UPDATE stats_service_active SET users = users - 1
+            WHERE {row}.is_active = 1 AND service_id = {row}.service_id;
+    """
+
+
+async def _migration_statistics(db):
+    """v3: incrementally maintained statistics aggregates"""
+    await db.execute("ALTER TABLE users ADD COLUMN service_id INTEGER")
+    await db.execute("CREATE TABLE IF NOT EXISTS stats_counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)")
+    await db.execute("CREATE TABLE IF NOT EXISTS stats_expiry_by_day (day TEXT PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0)")
+    await db.execute("CREATE TABLE IF NOT EXISTS stats_service_active (service_id INTEGER PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0)")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS stats_revenue_by_day (
+            day TEXT NOT NULL,
+            service_id INTEGER NOT NULL,
+            amount REAL NOT NULL DEFAULT 0,
+            purchases INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, service_id)
+        )
+    """)
+    await db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users
+        BEGIN {_stats_add_sql("NEW")} END
+    """)
+    await db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users
+        BEGIN {_stats_remove_sql("OLD")} END
+    """)
+    await db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_update
+        AFTER UPDATE OF is_active, subscription_end, service_id ON users
+        WHEN OLD.is_active IS NOT NEW.is_active
+            OR OLD.subscription_end IS NOT NEW.subscription_end
+            OR OLD.service_id IS NOT NEW.service_id
+        BEGIN {_stats_remove_sql("OLD")} {_stats_add_sql("NEW")} END
+    """)
+    await _rebuild_user_statistics(db)
+
+
+async def _migration_purchase_ledger(db):
+    """v4: purchase statuses, ledger indexes and one open request per user/service"""
+    await db.execute("ALTER TABLE pending_purchases ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'")
+    await db.execute("ALTER TABLE pending_purchases ADD COLUMN resolved_at TEXT")
+    now = datetime.now().isoformat()
+    # keep only the newest open request per (user, service) before enforcing uniqueness
+    await db.execute(
+        """
+        UPDATE pending_purchases SET status = 'expired', resolved_at = ?
+        WHERE status = 'pending' AND id NOT IN (
+            SELECT MAX(id) FROM pending_purchases WHERE status = 'pending' GROUP BY user_id, service_id
+        )
+        """,
+        (now,)
+    )
+    await db.execute("DROP INDEX IF EXISTS idx_pending_purchases_user")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_user_status ON pending_purchases(user_id, status)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_pending_purchases_created ON pending_purchases(created_at)")
+    await db.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_pending_purchases_open
+        ON pending_purchases(user_id, service_id) WHERE status = 'pending'
+    """)
+
+
+async def _migration_open_purchases_index(db):
+    """v5: small partial index for the oldest-first pending queue"""
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pending_purchases_open_created
+        ON pending_purchases(created_at) WHERE status = 'pending'
+    """)
+
+
+async def _migration_channel_members(db):
+    """v6: channel membership table maintained from chat_member updates"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS channel_members (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            verified_at TEXT,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_channel_members_verified ON channel_members(chat_id, verified_at)")
+    import config
+    if getattr(config, "PRIVATE_CHANNEL_ID", None) is not None:
+        # seed from our own flags; rows stay unverified until reconciliation checks them
+        await db.execute(
+            """
+            INSERT OR IGNORE INTO channel_members (chat_id, user_id, status, updated_at)
+            SELECT ?, user_id, CASE WHEN channel_member_removed = 1 THEN 'left' ELSE 'member' END, ?
+            FROM users WHERE added_to_channel = 1 OR channel_member_removed = 1
+            """,
+            (int(config.PRIVATE_CHANNEL_ID), datetime.now().isoformat())
+        )
+
+
+async def _migration_reminders(db):
+    """v7: expiry-ordered index on active users and the reminder ledger"""
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_active_end ON users(is_active, subscription_end)")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS reminders (
+            user_id INTEGER NOT NULL,
+            offset_seconds INTEGER NOT NULL,
+            subscription_end TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, offset_seconds, subscription_end)
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_reminders_status ON reminders(status, subscription_end)")
+
+
+async def _migration_user_archive(db):
+    """v8: last-seen tracking and the cold users_archive tier"""
+    await db.execute("ALTER TABLE users ADD COLUMN last_seen_at TEXT")
+    # unknown activity counts from now, so nobody is archived right after upgrade
+    await db.execute("UPDATE users SET last_seen_at = ?", (datetime.now().isoformat(),))
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_inactive_seen ON users(last_seen_at) WHERE is_active = 0")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users_archive (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            phone_number TEXT,
+            subscription_end TEXT,
+            is_active INTEGER DEFAULT 0,
+            photo_file_id TEXT,
+            added_to_channel INTEGER DEFAULT 0,
+            channel_member_removed INTEGER DEFAULT 0,
+            service_id INTEGER,
+            last_seen_at TEXT,
+            archived_at TEXT NOT NULL
+        )
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_archive_stats_insert AFTER INSERT ON users_archive
+        BEGIN UPDATE stats_counters SET value = value + 1 WHERE key = 'archived'; END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_archive_stats_delete AFTER DELETE ON users_archive
+        BEGIN UPDATE stats_counters SET value = value - 1 WHERE key = 'archived'; END
+    """)
+    await db.execute("INSERT OR IGNORE INTO stats_counters (key, value) VALUES ('archived', 0)")
+
+
+async def _migration_leases(db):
+    """v9: leases for leader election between bot instances"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            token INTEGER NOT NULL,
+            expires_at TEXT NOT NULL
+        )
+    """)
+
+
+async def _migration_broadcasts(db):
+    """v10: user language, broadcast audience indexes and the broadcast schedule"""
+    await db.execute("ALTER TABLE users ADD COLUMN language TEXT")
+    await db.execute("ALTER TABLE users_archive ADD COLUMN language TEXT")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_language ON users(language)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_service_active ON users(service_id, is_active)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_never_purchased ON users(user_id) WHERE subscription_end IS NULL")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            segment TEXT NOT NULL,
+            segment_arg TEXT,
+            text TEXT,
+            source_chat_id INTEGER,
+            source_message_id INTEGER,
+            scheduled_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'scheduled',
+            created_by INTEGER,
+            created_at TEXT NOT NULL,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            finished_at TEXT
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status, scheduled_at)")
+
+
+async def _migration_channels(db):
+    """v11: channels granted by services; default channels cover services without their own list"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS channels (
+            chat_id INTEGER PRIMARY KEY,
+            title TEXT,
+            is_default INTEGER NOT NULL DEFAULT 0,
+            join_link TEXT,
+            added_at TEXT NOT NULL
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS service_channels (
+            service_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            PRIMARY KEY (service_id, chat_id)
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_service_channels_chat ON service_channels(chat_id)")
+    import config
+    if getattr(config, "PRIVATE_CHANNEL_ID", None) is not None:
+        # the configured channel becomes the default one and keeps its join link
+        await db.execute(
+            """
+            INSERT OR IGNORE INTO channels (chat_id, is_default, join_link, added_at)
+            VALUES (?, 1, (SELECT value FROM bot_settings WHERE key = 'channel_join_link'), ?)
+            """,
+            (int(config.PRIVATE_CHANNEL_ID), datetime.now().isoformat())
+        )
+
+
+async def _migration_payments(db):
+    """v12: Telegram Payments, one row per charge so a redelivered payment is applied once"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            telegram_payment_charge_id TEXT PRIMARY KEY,
+            provider_payment_charge_id TEXT,
+            user_id INTEGER NOT NULL,
+            service_id INTEGER,
+            currency TEXT NOT NULL,
+            total_amount INTEGER NOT NULL,
+            subscription_end TEXT,
+            created_at TEXT NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id)")
+
+
+async def _migration_archive_audience(db):
+    """v13: indexes for broadcast audiences and exports that include users_archive"""
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_archive_language ON users_archive(language)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_archive_end ON users_archive(subscription_end)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_archive_never_purchased ON users_archive(user_id) WHERE subscription_end IS NULL")
+
+
+# Ordered list of (version, migration). Never edit an applied migration —
+# append a new one instead.
+SCHEMA_MIGRATIONS = [
+    (1, _migration_initial_schema),
+    (2, _migration_purchases_by_user),
+    (3, _migration_statistics),
+    (4, _migration_purchase_ledger),
+    (5, _migration_open_purchases_index),
+    (6, _migration_channel_members),
+    (7, _migration_reminders),
+    (8, _migration_user_archive),
+    (9, _migration_leases),
+    (10, _migration_broadcasts),
+    (11, _migration_channels),
+    (12, _migration_payments),
+    (13, _migration_archive_audience),
+]
+
+
+async def get_schema_version(db) -> int:
+    """Return the applied schema version (0 for a fresh database)"""
+    try:
+        cursor = await db.execute("SELECT MAX(version) FROM schema_version")
+    except aiosqlite.OperationalError:
+        return 0
+    row = await cursor.fetchone()
+    return row[0] or 0
+
 
 async def init_db():
-    """Initialize the database with required tables"""
+    """Bring the database schema up to date; a no-op when already current"""
+    global _schema_ready
+    if _schema_ready:
+        return
     async with aiosqlite.connect(DATABASE_FILE) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                phone_number TEXT,
-                subscription_end TEXT,
-                is_active INTEGER DEFAULT 0,
-                photo_file_id TEXT,
-                added_to_channel INTEGER DEFAULT 0,
-                channel_member_removed INTEGER DEFAULT 0
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS services (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                duration_days INTEGER NOT NULL,
-                price REAL NOT NULL,
-                duration_unit TEXT DEFAULT 'days'
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS pending_purchases (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                username TEXT,
-                phone_number TEXT,
-                service_id INTEGER,
-                created_at TEXT
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS bot_settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        """)
-        
-        await db.commit()
-        
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active)")
-        await db.commit()
-        
-        cursor = await db.execute("SELECT COUNT(*) FROM services")
-        count = await cursor.fetchone()
-        if count[0] == 0:
-            import config
-            await db.execute(
-                "INSERT INTO services (name, duration_days, price, duration_unit) VALUES (?, ?, ?, ?)",
-                (config.DEFAULT_SERVICE_NAME, config.DEFAULT_SERVICE_DURATION, config.DEFAULT_SERVICE_PRICE, 'days')
-            )
+        current = await get_schema_version(db)
+        latest = SCHEMA_MIGRATIONS[-1][0]
+        if current == 0:
+            # must be set before the first table exists; lets maintenance reclaim free pages
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # persistent: readers no longer block the writer and vice versa
+        await db.execute("PRAGMA journal_mode = WAL")
+        if current < latest:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    applied_at TEXT NOT NULL
+                )
+            """)
             await db.commit()
+            for version, migration in SCHEMA_MIGRATIONS:
+                if version <= current:
+                    continue
+                await db.execute("BEGIN IMMEDIATE")
+                try:
+                    await migration(db)
+                    await db.execute(
+                        "INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                        (version, datetime.now().isoformat())
+                    )
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+                logging.getLogger(__name__).info("Applied schema migration v%d", version)
+    _schema_ready = True
 
 
 async def add_service(name: str, duration_days: int, price: float, duration_unit: str = 'days'):
-    """Add a new service/plan"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        await db.execute(
+    """Add a new service/plan; returns its id"""
+    async def op(db):
+        cursor = await db.execute(
             "INSERT INTO services (name, duration_days, price, duration_unit) VALUES (?, ?, ?, ?)",
             (name, duration_days, price, duration_unit)
         )
-        await db.commit()
+        return cursor.lastrowid
+    return await _write(op)
 
 
 async def get_services():
     """Get all available services"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with _read() as db:
         cursor = await db.execute("SELECT id, name, duration_days, price, duration_unit FROM services")
         rows = await cursor.fetchall()
         return [{"id": row[0], "name": row[1], "duration_days": row[2], "price": row[3], "duration_unit": row[4] or 'days'} for row in rows]
@@ -87,51 +484,59 @@ async def get_services():
 
 async def update_service_price(service_id: int, new_price: float):
     """Update service price"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        await db.execute("UPDATE services SET price = ? WHERE id = ?", (new_price, service_id))
-        await db.commit()
+    await _write(lambda db: db.execute("UPDATE services SET price = ? WHERE id = ?", (new_price, service_id)))
 
 
 async def update_service_duration(service_id: int, new_duration: int, duration_unit: str = 'days'):
     """Update service duration"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        await db.execute("UPDATE services SET duration_days = ?, duration_unit = ? WHERE id = ?", (new_duration, duration_unit, service_id))
-        await db.commit()
+    await _write(lambda db: db.execute("UPDATE services SET duration_days = ?, duration_unit = ? WHERE id = ?", (new_duration, duration_unit, service_id)))
 
 
 async def delete_service(service_id: int):
-    """Delete a service"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    """Delete a service and its channel grants"""
+    async def op(db):
+        await db.execute("DELETE FROM service_channels WHERE service_id = ?", (service_id,))
         await db.execute("DELETE FROM services WHERE id = ?", (service_id,))
-        await db.commit()
+    await _write(op)
 
 
 async def update_service_name(service_id: int, new_name: str):
     """Update service name"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        await db.execute("UPDATE services SET name = ? WHERE id = ?", (new_name, service_id))
-        await db.commit()
+    await _write(lambda db: db.execute("UPDATE services SET name = ? WHERE id = ?", (new_name, service_id)))
 
 
 async def add_pending_purchase(user_id: int, username: str, phone_number: str | None, service_id: int):
-    """Add a pending purchase for admin confirmation"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    """Add a pending purchase for admin confirmation.
+
+    Only one open request per user and service is allowed: if one exists it is
+    returned instead. Returns (purchase_id, created).
+    """
+    async def op(db):
         created_at = datetime.now().isoformat()
-        await db.execute(
-            "INSERT INTO pending_purchases (user_id, username, phone_number, service_id, created_at) VALUES (?, ?, ?, ?, ?)",
+        cursor = await db.execute(
+            """
+            INSERT INTO pending_purchases (user_id, username, phone_number, service_id, created_at, status)
+            VALUES (?, ?, ?, ?, ?, 'pending')
+            ON CONFLICT(user_id, service_id) WHERE status = 'pending' DO NOTHING
+            """,
             (user_id, username, phone_number, service_id, created_at)
         )
-        await db.commit()
-        cursor = await db.execute("SELECT last_insert_rowid()")
+        if cursor.rowcount == 1:
+            return cursor.lastrowid, True
+        cursor = await db.execute(
+            "SELECT id FROM pending_purchases WHERE user_id = ? AND service_id = ? AND status = 'pending'",
+            (user_id, service_id)
+        )
         row = await cursor.fetchone()
-        return row[0]
+        return row[0], False
+    return await _write(op)
 
 
 async def get_pending_purchase(purchase_id: int):
-    """Get pending purchase details"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    """Get purchase request details"""
+    async with _read() as db:
         cursor = await db.execute(
-            "SELECT user_id, username, phone_number, service_id FROM pending_purchases WHERE id = ?",
+            "SELECT user_id, username, phone_number, service_id, status, created_at FROM pending_purchases WHERE id = ?",
             (purchase_id,)
         )
         row = await cursor.fetchone()
@@ -140,59 +545,252 @@ async def get_pending_purchase(purchase_id: int):
                 "user_id": row[0],
                 "username": row[1],
                 "phone_number": row[2],
-                "service_id": row[3]
+                "service_id": row[3],
+                "status": row[4],
+                "created_at": row[5]
             }
         return None
 
 
 async def delete_pending_purchase(purchase_id: int):
     """Delete a pending purchase"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        await db.execute("DELETE FROM pending_purchases WHERE id = ?", (purchase_id,))
-        await db.commit()
+    await _write(lambda db: db.execute("DELETE FROM pending_purchases WHERE id = ?", (purchase_id,)))
 
 
-async def activate_user_subscription(user_id: int, username: str, phone_number: str | None, duration_value: int, duration_unit: str = 'days'):
-    """Activate or extend user subscription with flexible time units"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        cursor = await db.execute("SELECT subscription_end FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
+async def resolve_pending_purchase(purchase_id: int, status: str):
+    """Move a request out of 'pending' (approved/rejected/expired); False if it was already resolved"""
+    if status not in PURCHASE_STATUSES or status == 'pending':
+        raise ValueError(f"invalid purchase status: {status}")
+    async def op(db):
+        cursor = await db.execute(
+            "UPDATE pending_purchases SET status = ?, resolved_at = ? WHERE id = ? AND status = 'pending'",
+            (status, datetime.now().isoformat(), purchase_id)
+        )
+        return cursor.rowcount == 1
+    return await _write(op)
 
-        base = datetime.now()
-        if row and row[0]:
-            current_end = datetime.fromisoformat(row[0])
-            if current_end > datetime.now():
-                base = current_end
-
-        unit = (duration_unit or 'days').lower()
-        if unit in ('second', 'seconds'):
-            new_end = base + timedelta(seconds=duration_value)
-        elif unit in ('minute', 'minutes'):
-            new_end = base + timedelta(minutes=duration_value)
-        elif unit in ('month', 'months'):
-            new_end = base + timedelta(days=30 * duration_value)
-        else:
-            new_end = base + timedelta(days=duration_value)
 
-        await db.execute(
+async def expire_stale_purchases(max_age_seconds: float, retention_days: int):
+    """Expire pending requests older than max_age and purge old expired/rejected rows.
+
+    Returns (expired, purged) row counts.
+    """
+    now = datetime.now()
+
+    async def op(db):
+        cursor = await db.execute(
+            "UPDATE pending_purchases SET status = 'expired', resolved_at = ? WHERE status = 'pending' AND created_at < ?",
+            (now.isoformat(), (now - timedelta(seconds=max_age_seconds)).isoformat())
+        )
+        expired = cursor.rowcount
+        cutoff = (now - timedelta(days=retention_days)).isoformat()
+        # created_at narrows the scan via its index; resolved_at enforces the retention window
+        cursor = await db.execute(
             """
-            INSERT INTO users (user_id, username, phone_number, subscription_end, is_active)
-            VALUES (?, ?, ?, ?, 1)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username = excluded.username,
-                phone_number = COALESCE(excluded.phone_number, phone_number),
-                subscription_end = excluded.subscription_end,
-                is_active = 1
+            DELETE FROM pending_purchases
+            WHERE created_at < ? AND resolved_at < ? AND status IN ('expired', 'rejected')
             """,
-            (user_id, username, phone_number, new_end.isoformat())
+            (cutoff, cutoff)
         )
-        await db.commit()
+        return expired, cursor.rowcount
+    return await _write(op)
+
+
+def duration_to_timedelta(duration_value: int, duration_unit: str = 'days') -> timedelta:
+    """Convert a service duration (value + unit) to a timedelta"""
+    unit = (duration_unit or 'days').lower()
+    if unit in ('second', 'seconds'):
+        return timedelta(seconds=duration_value)
+    if unit in ('minute', 'minutes'):
+        return timedelta(minutes=duration_value)
+    if unit in ('month', 'months'):
+        return timedelta(days=30 * duration_value)
+    return timedelta(days=duration_value)
+
+
+def extend_subscription_end(current_end: str | None, duration_value: int, duration_unit: str = 'days') -> datetime:
+    """New subscription end: extend from the current end if still in the future, else from now"""
+    base = datetime.now()
+    if current_end:
+        end = datetime.fromisoformat(current_end)
+        if end > base:
+            base = end
+    return base + duration_to_timedelta(duration_value, duration_unit)
+
+
+async def _extend_subscription(db, user_id: int, username: str | None, phone_number: str | None, duration_value: int, duration_unit: str = 'days', service_id: int | None = None) -> datetime:
+    """Single-statement activate/extend: the new end is computed from the row's
+    current value inside the upsert, so concurrent extensions never lose time"""
+    now = datetime.now()
+    delta = duration_to_timedelta(duration_value, duration_unit)
+    await _restore_archived_users(db, [user_id])
+    cursor = await db.execute(
+        """
+        INSERT INTO users (user_id, username, phone_number, subscription_end, is_active, service_id)
+        VALUES (?, ?, ?, ?, 1, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = COALESCE(excluded.username, username),
+            phone_number = COALESCE(excluded.phone_number, phone_number),
+            subscription_end = strftime('%Y-%m-%dT%H:%M:%f', MAX(COALESCE(subscription_end, ''), ?), ?),
+            is_active = 1,
+            service_id = COALESCE(excluded.service_id, service_id)
+        RETURNING subscription_end
+        """,
+        (user_id, username, phone_number, (now + delta).isoformat(), service_id,
+         now.isoformat(), f"+{delta.total_seconds()} seconds")
+    )
+    row = await cursor.fetchone()
+    return datetime.fromisoformat(row[0])
+
+
+async def activate_user_subscription(user_id: int, username: str, phone_number: str | None, duration_value: int, duration_unit: str = 'days', service_id: int | None = None):
+    """Activate or extend user subscription with flexible time units.
+
+    When service_id is given the purchase is counted as confirmed revenue.
+    """
+    async def op(db):
+        new_end = await _extend_subscription(db, user_id, username, phone_number, duration_value, duration_unit, service_id)
+        if service_id is not None:
+            await _record_revenue(db, service_id)
         return new_end
+    new_end = await _write(op)
+    entitlements.grant(user_id, new_end, service_id)
+    return new_end
+
+
+async def approve_purchases(purchase_ids: list):
+    """Approve pending requests and extend the subscriptions in one transaction.
+
+    The pending -> approved transition is a compare-and-set, so ids that are
+    already resolved are skipped and a repeated call is a no-op. Returns the
+    requests approved by this call.
+    """
+    if not purchase_ids:
+        return []
+
+    async def op(db):
+        approved = []
+        cursor = await db.execute("SELECT id, name, duration_days, price, duration_unit FROM services")
+        services = {row[0]: row for row in await cursor.fetchall()}
+        cursor = await db.execute(
+            f"""
+            UPDATE pending_purchases SET status = 'approved', resolved_at = ?
+            WHERE status = 'pending'
+              AND id IN ({','.join('?' * len(purchase_ids))})
+              AND service_id IN (SELECT id FROM services)
+            RETURNING id, user_id, username, phone_number, service_id
+            """,
+            (datetime.now().isoformat(), *purchase_ids)
+        )
+        for purchase_id, user_id, username, phone_number, service_id in await cursor.fetchall():
+            _, name, duration, price, unit = services[service_id]
+            new_end = await _extend_subscription(db, user_id, username, phone_number, duration, unit or 'days', service_id)
+            await _record_revenue(db, service_id, price)
+            approved.append({
+                "purchase_id": purchase_id,
+                "user_id": user_id,
+                "username": username,
+                "service_id": service_id,
+                "service_name": name,
+                "subscription_end": new_end
+            })
+        return approved
+
+    approved = await _write(op)
+    for item in approved:
+        entitlements.grant(item["user_id"], item["subscription_end"], item["service_id"])
+    return approved
+
+
+async def record_payment(charge_id: str, provider_charge_id: str | None, user_id: int, username: str | None,
+                         service_id: int | None, currency: str, total_amount: int):
+    """Store a successful payment and extend the subscription in one transaction.
+
+    The Telegram charge id is the key, so a redelivered payment is a no-op and
+    returns None. Otherwise returns the user, service and new subscription end
+    (None when the service no longer exists and access must be granted by hand).
+    """
+    async def op(db):
+        cursor = await db.execute(
+            """
+            INSERT OR IGNORE INTO payments
+                (telegram_payment_charge_id, provider_payment_charge_id, user_id, service_id, currency, total_amount, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (charge_id, provider_charge_id, user_id, service_id, currency, total_amount, datetime.now().isoformat())
+        )
+        if cursor.rowcount == 0:
+            return None
+        cursor = await db.execute("SELECT name, duration_days, price, duration_unit FROM services WHERE id = ?", (service_id,))
+        service = await cursor.fetchone()
+        if service is None:
+            return {"user_id": user_id, "service_id": service_id, "service_name": None, "subscription_end": None}
+        name, duration, price, unit = service
+        new_end = await _extend_subscription(db, user_id, username, None, duration, unit or 'days', service_id)
+        await _record_revenue(db, service_id, price)
+        await db.execute(
+            "UPDATE payments SET subscription_end = ? WHERE telegram_payment_charge_id = ?",
+            (new_end.isoformat(), charge_id)
+        )
+        return {"user_id": user_id, "service_id": service_id, "service_name": name, "subscription_end": new_end}
+
+    payment = await _write(op)
+    if payment and payment["subscription_end"] is not None:
+        entitlements.grant(user_id, payment["subscription_end"], service_id)
+    return payment
+
+
+async def reject_purchase(purchase_id: int):
+    """Reject a pending request; returns its user_id, or None if already resolved"""
+    async def op(db):
+        cursor = await db.execute(
+            "UPDATE pending_purchases SET status = 'rejected', resolved_at = ? WHERE id = ? AND status = 'pending' RETURNING user_id",
+            (datetime.now().isoformat(), purchase_id)
+        )
+        row = await cursor.fetchone()
+        return row[0] if row else None
+    return await _write(op)
+
+
+async def get_pending_purchases_page(offset: int = 0, limit: int = 10):
+    """Oldest-first page of open purchase requests with service details"""
+    async with _read() as db:
+        cursor = await db.execute(
+            """
+            SELECT p.id, p.user_id, p.username, p.created_at, s.name, s.price
+            FROM pending_purchases p
+            LEFT JOIN services s ON s.id = p.service_id
+            WHERE p.status = 'pending'
+            ORDER BY p.created_at
+            LIMIT ? OFFSET ?
+            """,
+            (limit, offset)
+        )
+        rows = await cursor.fetchall()
+        return [
+            {
+                "id": row[0],
+                "user_id": row[1],
+                "username": row[2],
+                "created_at": row[3],
+                "service_name": row[4],
+                "price": row[5]
+            }
+            for row in rows
+        ]
+
+
+async def count_pending_purchases() -> int:
+    """Number of open purchase requests"""
+    async with _read() as db:
+        cursor = await db.execute("SELECT COUNT(*) FROM pending_purchases WHERE status = 'pending'")
+        row = await cursor.fetchone()
+        return row[0]
 
 
 async def get_user_subscription(user_id: int):
     """Get user subscription status"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with _read() as db:
         cursor = await db.execute(
             "SELECT subscription_end, is_active FROM users WHERE user_id = ?",
             (user_id,)
@@ -207,10 +805,14 @@ async def get_user_subscription(user_id: int):
 
 
 async def get_all_users():
-    """Get all users with their subscription status"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    """Get all users with their subscription status, archived ones included"""
+    async with _read() as db:
         cursor = await db.execute(
-            "SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id FROM users"
+            """
+            SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id FROM users
+            UNION ALL
+            SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id FROM users_archive
+            """
         )
         rows = await cursor.fetchall()
         return [
@@ -226,29 +828,56 @@ async def get_all_users():
         ]
 
 
-async def deactivate_expired_subscriptions():
-    """Deactivate expired subscriptions and return list of expired user IDs"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        now = datetime.now().isoformat()
+async def deactivate_expired_subscriptions(fence: tuple | None = None):
+    """Deactivate expired subscriptions and return list of expired user IDs.
+
+    fence=(lease_name, token): do nothing unless that lease token is still current.
+    """
+    async def op(db):
+        if fence and not await _holds_lease(db, *fence):
+            return []
         cursor = await db.execute(
-            "SELECT user_id FROM users WHERE subscription_end < ? AND is_active = 1",
-            (now,)
+            "UPDATE users SET is_active = 0 WHERE subscription_end < ? AND is_active = 1 RETURNING user_id",
+            (datetime.now().isoformat(),)
         )
-        expired_users = [row[0] for row in await cursor.fetchall()]
-        
-        if expired_users:
-            await db.execute(
-                "UPDATE users SET is_active = 0 WHERE subscription_end < ? AND is_active = 1",
-                (now,)
-            )
-            await db.commit()
-        
-        return expired_users
+        return [row[0] for row in await cursor.fetchall()]
+    expired_users = await _write(op)
+    for user_id in expired_users:
+        entitlements.revoke(user_id)
+    return expired_users
+
+
+async def deactivate_user_subscription(user_id: int):
+    """Deactivate a single user's subscription (user-initiated cancel)"""
+    await _write(lambda db: db.execute("UPDATE users SET is_active = 0 WHERE user_id = ?", (user_id,)))
+    entitlements.revoke(user_id)
+
+
+async def load_entitlements():
+    """Reload the in-memory entitlement cache from active subscriptions"""
+    async with _read() as db:
+        cursor = await db.execute("SELECT user_id, subscription_end, service_id FROM users WHERE is_active = 1")
+        entitlements.replace_all(await cursor.fetchall())
+    return entitlements.count()
+
+
+async def load_user_entitlement(user_id: int) -> bool:
+    """Refresh one user's cache entry from the database; True if they have an active subscription"""
+    async with _read() as db:
+        cursor = await db.execute(
+            "SELECT subscription_end, service_id FROM users WHERE user_id = ? AND is_active = 1", (user_id,)
+        )
+        row = await cursor.fetchone()
+    if not row or not row[0]:
+        entitlements.revoke(user_id)
+        return False
+    entitlements.grant(user_id, datetime.fromisoformat(row[0]), row[1])
+    return True
 
 
 async def get_service_by_id(service_id: int):
     """Get service by ID"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with _read() as db:
         cursor = await db.execute("SELECT id, name, duration_days, price, duration_unit FROM services WHERE id = ?", (service_id,))
         row = await cursor.fetchone()
         if row:
@@ -262,121 +891,183 @@ async def get_service_by_id(service_id: int):
         return None
 
 
+async def _restore_archived_users(db, user_ids: list) -> int:
+    """Move users back from the archive into the hot table (caller commits)"""
+    restored = 0
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        cursor = await db.execute(
+            f"INSERT OR IGNORE INTO users ({USER_COLUMNS}) SELECT {USER_COLUMNS} FROM users_archive WHERE user_id IN ({placeholders})",
+            chunk
+        )
+        if cursor.rowcount > 0:
+            restored += cursor.rowcount
+            await db.execute(f"DELETE FROM users_archive WHERE user_id IN ({placeholders})", chunk)
+    return restored
+
+
 async def upsert_user_profile(user_id: int, username: str | None, phone_number: str | None, photo_file_id: str | None):
-    """Create or update user profile fields"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    """Create or update user profile fields and mark the user as seen"""
+    async def op(db):
+        await _restore_archived_users(db, [user_id])
         await db.execute(
             """
-            INSERT INTO users (user_id, username, phone_number, subscription_end, is_active, photo_file_id)
-            VALUES (?, ?, ?, NULL, 0, ?)
+            INSERT INTO users (user_id, username, phone_number, subscription_end, is_active, photo_file_id, last_seen_at)
+            VALUES (?, ?, ?, NULL, 0, ?, ?)
             ON CONFLICT(user_id) DO UPDATE SET
-                username = COALESCE(?, username),
-                phone_number = COALESCE(?, phone_number),
-                photo_file_id = COALESCE(?, photo_file_id)
+                username = COALESCE(excluded.username, username),
+                phone_number = COALESCE(excluded.phone_number, phone_number),
+                photo_file_id = COALESCE(excluded.photo_file_id, photo_file_id),
+                last_seen_at = excluded.last_seen_at
             """,
-            (user_id, username, phone_number, photo_file_id, username, phone_number, photo_file_id)
+            (user_id, username, phone_number, photo_file_id, datetime.now().isoformat())
         )
-        await db.commit()
+    await _write(op)
 
 
 async def get_user(user_id: int):
-    """Get single user by id"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        cursor = await db.execute(
-            "SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id, added_to_channel FROM users WHERE user_id = ?",
-            (user_id,)
-        )
+    """Get single user by id, restoring them from the archive if needed"""
+    query = "SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id, added_to_channel FROM users WHERE user_id = ?"
+    async with _read() as db:
+        cursor = await db.execute(query, (user_id,))
         row = await cursor.fetchone()
-        if not row:
-            return None
-        return {
-            "user_id": row[0],
-            "username": row[1],
-            "phone_number": row[2],
-            "subscription_end": row[3],
-            "is_active": row[4],
-            "photo_file_id": row[5],
-            "added_to_channel": row[6] if len(row) > 6 else 0
-        }
-
-
-async def search_users_by_username(query: str, offset: int = 0, limit: int = 20):
+        archived = not row and await (await db.execute("SELECT 1 FROM users_archive WHERE user_id = ?", (user_id,))).fetchone()
+    if archived:
+        async def restore(db):
+            if await _restore_archived_users(db, [user_id]):
+                cursor = await db.execute(query, (user_id,))
+                return await cursor.fetchone()
+        row = await _write(restore)
+    if not row:
+        return None
+    return {
+        "user_id": row[0],
+        "username": row[1],
+        "phone_number": row[2],
+        "subscription_end": row[3],
+        "is_active": row[4],
+        "photo_file_id": row[5],
+        "added_to_channel": row[6] if len(row) > 6 else 0
+    }
+
+
+def _users_listing_source(include_archived: bool) -> str:
+    """FROM clause for admin listings: the hot tier, optionally with the archive"""
+    columns = "user_id, username, phone_number, subscription_end, is_active, photo_file_id"
+    if not include_archived:
+        return f"(SELECT {columns}, 0 AS archived FROM users)"
+    return f"""(
+        SELECT {columns}, 0 AS archived FROM users
+        UNION ALL
+        SELECT {columns}, 1 AS archived FROM users_archive
+    )"""
+
+
+def _listing_row(row) -> dict:
+    return {
+        "user_id": row[0],
+        "username": row[1],
+        "phone_number": row[2],
+        "subscription_end": row[3],
+        "is_active": row[4],
+        "photo_file_id": row[5],
+        "archived": row[6]
+    }
+
+
+async def search_users_by_username(query: str, offset: int = 0, limit: int = 20, include_archived: bool = False):
     """Search users by username (case-insensitive, contains) with pagination"""
     like = f"%{query.lower()}%"
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with _read() as db:
         cursor = await db.execute(
-            """
-            SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id
-            FROM users
+            f"""
+            SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id, archived
+            FROM {_users_listing_source(include_archived)}
             WHERE LOWER(COALESCE(username, '')) LIKE ?
             ORDER BY username IS NULL, username
             LIMIT ? OFFSET ?
             """,
             (like, limit, offset)
         )
-        rows = await cursor.fetchall()
-        return [
-            {
-                "user_id": row[0],
-                "username": row[1],
-                "phone_number": row[2],
-                "subscription_end": row[3],
-                "is_active": row[4],
-                "photo_file_id": row[5]
-            }
-            for row in rows
-        ]
+        return [_listing_row(row) for row in await cursor.fetchall()]
 
 
-async def get_users_paginated(offset: int = 0, limit: int = 20):
+async def get_users_paginated(offset: int = 0, limit: int = 20, include_archived: bool = False):
     """Get users with pagination (alphabetical by username)"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with _read() as db:
         cursor = await db.execute(
-            """
-            SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id
-            FROM users
+            f"""
+            SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id, archived
+            FROM {_users_listing_source(include_archived)}
             ORDER BY username IS NULL, username
             LIMIT ? OFFSET ?
             """,
             (limit, offset)
         )
-        rows = await cursor.fetchall()
-        return [
-            {
-                "user_id": row[0],
-                "username": row[1],
-                "phone_number": row[2],
-                "subscription_end": row[3],
-                "is_active": row[4],
-                "photo_file_id": row[5]
-            }
-            for row in rows
-        ]
+        return [_listing_row(row) for row in await cursor.fetchall()]
+
+
+async def archive_inactive_users(inactive_days: int, batch_size: int = 1000) -> int:
+    """Move users with no subscription and no activity for inactive_days into
+    users_archive, in short per-batch transactions. Users with an open
+    purchase request stay hot. Returns the number of archived users.
+    """
+    now = datetime.now().isoformat()
+    cutoff = (datetime.now() - timedelta(days=inactive_days)).isoformat()
+    archived = 0
+
+    async def op(db):
+        cursor = await db.execute(
+            """
+            SELECT user_id FROM users u
+            WHERE is_active = 0
+              AND (last_seen_at < ? OR last_seen_at IS NULL)
+              AND (subscription_end IS NULL OR subscription_end < ?)
+              AND NOT EXISTS (
+                  SELECT 1 FROM pending_purchases p WHERE p.user_id = u.user_id AND p.status = 'pending'
+              )
+            LIMIT ?
+            """,
+            (cutoff, cutoff, batch_size)
+        )
+        ids = [row[0] for row in await cursor.fetchall()]
+        if ids:
+            placeholders = ','.join('?' * len(ids))
+            await db.execute(
+                f"INSERT OR REPLACE INTO users_archive ({USER_COLUMNS}, archived_at) "
+                f"SELECT {USER_COLUMNS}, ? FROM users WHERE user_id IN ({placeholders})",
+                (now, *ids)
+            )
+            await db.execute(f"DELETE FROM users WHERE user_id IN ({placeholders})", ids)
+        return len(ids)
+
+    while True:
+        moved = await _write(op)
+        archived += moved
+        if moved < batch_size:
+            return archived
 
 
 async def mark_user_added_to_channel(user_id: int):
     """Mark user as added to channel"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        await db.execute(
-            "UPDATE users SET added_to_channel = 1, channel_member_removed = 0 WHERE user_id = ?",
-            (user_id,)
-        )
-        await db.commit()
+    await _write(lambda db: db.execute(
+        "UPDATE users SET added_to_channel = 1, channel_member_removed = 0 WHERE user_id = ?",
+        (user_id,)
+    ))
 
 
 async def mark_user_removed_from_channel(user_id: int):
     """Mark user as removed from channel"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        await db.execute(
-            "UPDATE users SET channel_member_removed = 1 WHERE user_id = ?",
-            (user_id,)
-        )
-        await db.commit()
+    await _write(lambda db: db.execute(
+        "UPDATE users SET channel_member_removed = 1 WHERE user_id = ?",
+        (user_id,)
+    ))
 
 
 async def get_bot_setting(key: str, default: str = None):
     """Get bot setting value"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with _read() as db:
         cursor = await db.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
         row = await cursor.fetchone()
         return row[0] if row else default
@@ -384,17 +1075,15 @@ async def get_bot_setting(key: str, default: str = None):
 
 async def set_bot_setting(key: str, value: str):
     """Set bot setting value"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)",
-            (key, value)
-        )
-        await db.commit()
+    await _write(lambda db: db.execute(
+        "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)",
+        (key, value)
+    ))
 
 
 async def get_shortest_active_subscription_seconds():
     """Get the time in seconds until the next subscription expires"""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with _read() as db:
         now = datetime.now()
         cursor = await db.execute(
             "SELECT subscription_end FROM users WHERE is_active = 1 AND subscription_end > ? ORDER BY subscription_end ASC LIMIT 1",
@@ -419,24 +1108,713 @@ async def set_bot_config(key: str, value: str):
 
 
 async def init_default_bot_config():
-    """Initialize default bot configuration"""
-    defaults = {
-        "welcome_message": "👋 <b>Добро пожаловать!</b>\n\nЭтот бот предоставляет доступ к приватному каналу.\n\nВыберите действие:",
-        "btn_buy": "🛍 Купить подписку",
-        "btn_renew": "🔄 Продлить подписку",
-        "btn_my_sub": "ℹ️ Моя подписка",
-        "btn_contact": "✉️ Связаться с админом"
+    """Initialize default bot configuration (missing keys only)"""
+    await _write(lambda db: db.executemany(
+        "INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)",
+        [(f"userbot_{key}", value) for key, value in DEFAULT_BOT_CONFIG.items()]
+    ))
+
+
+async def bulk_update_subscriptions(extensions: list, deactivations: list):
+    """Apply many subscription changes in a single transaction.
+
+    extensions: list of (user_id, duration_value, duration_unit); repeated
+    user_ids are applied cumulatively. deactivations: list of user_ids.
+    Returns {user_id: new_end} for the extended users.
+    """
+    async def op(db):
+        new_ends = {}
+        ext_ids = list({row[0] for row in extensions})
+        await _restore_archived_users(db, ext_ids)
+        current = {}
+        for i in range(0, len(ext_ids), 500):
+            chunk = ext_ids[i:i + 500]
+            cursor = await db.execute(
+                f"SELECT user_id, subscription_end FROM users WHERE user_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            current.update({row[0]: row[1] for row in await cursor.fetchall()})
+
+        for user_id, duration_value, duration_unit in extensions:
+            end = new_ends[user_id].isoformat() if user_id in new_ends else current.get(user_id)
+            new_ends[user_id] = extend_subscription_end(end, duration_value, duration_unit)
+
+        await db.executemany(
+            """
+            INSERT INTO users (user_id, subscription_end, is_active)
+            VALUES (?, ?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET
+                subscription_end = excluded.subscription_end,
+                is_active = 1
+            """,
+            [(user_id, end.isoformat()) for user_id, end in new_ends.items()]
+        )
+        await db.executemany(
+            "UPDATE users SET is_active = 0 WHERE user_id = ?",
+            [(user_id,) for user_id in deactivations]
+        )
+        return new_ends
+
+    new_ends = await _write(op)
+    for user_id, end in new_ends.items():
+        entitlements.grant(user_id, end)
+    for user_id in deactivations:
+        entitlements.revoke(user_id)
+    return new_ends
+
+
+async def mark_users_removed_from_channel(user_ids: list):
+    """Mark many users as removed from channel in one transaction"""
+    await _write(lambda db: db.executemany(
+        "UPDATE users SET channel_member_removed = 1 WHERE user_id = ?",
+        [(user_id,) for user_id in user_ids]
+    ))
+
+
+async def iter_users_export(active_only: bool = False, expiring_within_days: int | None = None,
+                            language: str | None = None, chunk_size: int = 1000):
+    """Yield users joined with their latest purchase, chunk by chunk.
+
+    Uses keyset pagination on user_id so each chunk is a short, fully consumed
+    statement: memory stays bounded and no read lock is held between chunks.
+    Without an active/expiring filter archived users are exported too.
+    """
+    conditions = ["user_id > ?"]
+    params = []
+    if active_only:
+        conditions.append("is_active = 1")
+    if expiring_within_days is not None:
+        now = datetime.now()
+        conditions.append("is_active = 1 AND subscription_end BETWEEN ? AND ?")
+        params += [now.isoformat(), (now + timedelta(days=expiring_within_days)).isoformat()]
+    if language is not None:
+        where, language_params = _segment_filter('language', language)
+        conditions.append(where)
+        params += language_params
+    tables = ('users',) if active_only or expiring_within_days is not None else ('users', 'users_archive')
+    # each tier yields its own next chunk from an index, the merge keeps the first chunk_size
+    source = " UNION ALL ".join(
+        f"""SELECT * FROM (
+            SELECT user_id, username, phone_number, subscription_end, is_active, added_to_channel, language
+            FROM {table} WHERE {" AND ".join(conditions)} ORDER BY user_id LIMIT ?
+        )"""
+        for table in tables
+    )
+    query = f"""
+        SELECT u.user_id, u.username, u.phone_number, u.subscription_end, u.is_active,
+               u.added_to_channel,
+               (SELECT COUNT(*) FROM pending_purchases p WHERE p.user_id = u.user_id AND p.status = 'approved'),
+               lp.created_at, lp.status, s.name, s.price, u.language
+        FROM ({source}) u
+        LEFT JOIN pending_purchases lp
+            ON lp.id = (SELECT MAX(p.id) FROM pending_purchases p WHERE p.user_id = u.user_id)
+        LEFT JOIN services s ON s.id = lp.service_id
+        ORDER BY u.user_id
+        LIMIT ?
+    """
+    last_id = -1
+    async with _read() as db:
+        while True:
+            cursor = await db.execute(query, (last_id, *params, chunk_size) * len(tables) + (chunk_size,))
+            rows = await cursor.fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [
+                {
+                    "user_id": row[0],
+                    "username": row[1],
+                    "phone_number": row[2],
+                    "subscription_end": row[3],
+                    "is_active": row[4],
+                    "added_to_channel": row[5],
+                    "purchases": row[6],
+                    "last_purchase_at": row[7],
+                    "last_purchase_status": row[8],
+                    "last_service": row[9],
+                    "last_service_price": row[10],
+                    "language": row[11] or ""
+                }
+                for row in rows
+            ]
+            if len(rows) < chunk_size:
+                return
+
+
+async def _record_revenue(db, service_id: int, amount: float | None = None):
+    """Add one confirmed purchase of a service to today's revenue aggregate"""
+    if amount is None:
+        cursor = await db.execute("SELECT price FROM services WHERE id = ?", (service_id,))
+        row = await cursor.fetchone()
+        amount = row[0] if row else 0
+    await db.execute(
+        """
+        INSERT INTO stats_revenue_by_day (day, service_id, amount, purchases)
+        VALUES (?, ?, ?, 1)
+        ON CONFLICT(day, service_id) DO UPDATE SET
+            amount = amount + excluded.amount,
+            purchases = purchases + 1
+        """,
+        (datetime.now().date().isoformat(), service_id, amount)
+    )
+
+
+async def _rebuild_user_statistics(db):
+    """Recompute the users-derived aggregates from scratch (caller commits)"""
+    await db.execute("DELETE FROM stats_counters")
+    await db.execute("""
+        INSERT INTO stats_counters (key, value)
+        SELECT 'active', COUNT(*) FROM users WHERE is_active = 1
+        UNION ALL
+        SELECT 'inactive', COUNT(*) FROM users WHERE is_active IS NOT 1
+    """)
+    await db.execute("DELETE FROM stats_expiry_by_day")
+    await db.execute("""
+        INSERT INTO stats_expiry_by_day (day, users)
+        SELECT substr(subscription_end, 1, 10), COUNT(*) FROM users
+        WHERE is_active = 1 AND subscription_end IS NOT NULL
+        GROUP BY 1
+    """)
+    await db.execute("DELETE FROM stats_service_active")
+    await db.execute("""
+        INSERT INTO stats_service_active (service_id, users)
+        SELECT service_id, COUNT(*) FROM users
+        WHERE is_active = 1 AND service_id IS NOT NULL
+        GROUP BY service_id
+    """)
+
+
+async def _snapshot_user_statistics(db):
+    counters = await (await db.execute("SELECT key, value FROM stats_counters ORDER BY key")).fetchall()
+    expiry = await (await db.execute("SELECT day, users FROM stats_expiry_by_day WHERE users != 0 ORDER BY day")).fetchall()
+    services = await (await db.execute("SELECT service_id, users FROM stats_service_active WHERE users != 0 ORDER BY service_id")).fetchall()
+    return counters, expiry, services
+
+
+async def reconcile_statistics():
+    """Rebuild users-derived aggregates to correct drift; returns True if drift was found"""
+    async def op(db):
+        before = await _snapshot_user_statistics(db)
+        await _rebuild_user_statistics(db)
+        await db.execute("INSERT INTO stats_counters (key, value) SELECT 'archived', COUNT(*) FROM users_archive")
+        after = await _snapshot_user_statistics(db)
+        # past days with no active users are dead weight
+        await db.execute(
+            "DELETE FROM stats_expiry_by_day WHERE users <= 0 AND day < ?",
+            (datetime.now().date().isoformat(),)
+        )
+        return before != after
+    return await _write(op)
+
+
+async def get_statistics(expiry_days: int = 7, revenue_days: int = 30):
+    """Read the admin statistics from the aggregate tables (no scans of users)"""
+    today = datetime.now().date()
+    async with _read() as db:
+        cursor = await db.execute("SELECT key, value FROM stats_counters")
+        counters = {row[0]: row[1] for row in await cursor.fetchall()}
+        cursor = await db.execute(
+            """
+            SELECT a.service_id, s.name, a.users FROM stats_service_active a
+            LEFT JOIN services s ON s.id = a.service_id
+            WHERE a.users > 0 ORDER BY a.users DESC
+            """
+        )
+        by_service = [{"service_id": row[0], "name": row[1], "users": row[2]} for row in await cursor.fetchall()]
+        cursor = await db.execute(
+            "SELECT day, users FROM stats_expiry_by_day WHERE day BETWEEN ? AND ? AND users > 0 ORDER BY day",
+            (today.isoformat(), (today + timedelta(days=expiry_days - 1)).isoformat())
+        )
+        expiry = [{"day": row[0], "users": row[1]} for row in await cursor.fetchall()]
+        cursor = await db.execute(
+            """
+            SELECT r.day, r.service_id, s.name, r.amount, r.purchases FROM stats_revenue_by_day r
+            LEFT JOIN services s ON s.id = r.service_id
+            WHERE r.day >= ? ORDER BY r.day DESC
+            """,
+            ((today - timedelta(days=revenue_days - 1)).isoformat(),)
+        )
+        revenue = [
+            {"day": row[0], "service_id": row[1], "name": row[2], "amount": row[3], "purchases": row[4]}
+            for row in await cursor.fetchall()
+        ]
+    return {
+        "active": counters.get("active", 0),
+        "inactive": counters.get("inactive", 0),
+        "archived": counters.get("archived", 0),
+        "by_service": by_service,
+        "expiry_by_day": expiry,
+        "revenue": revenue,
     }
-    
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        for key, value in defaults.items():
+
+
+async def set_channel_member_statuses(chat_id: int, statuses: list, verified: bool = False):
+    """Record channel membership for [(user_id, status)] and sync the users flags"""
+    now = datetime.now().isoformat()
+    verified_at = now if verified else None
+
+    async def op(db):
+        await db.executemany(
+            """
+            INSERT INTO channel_members (chat_id, user_id, status, updated_at, verified_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                status = excluded.status,
+                updated_at = excluded.updated_at,
+                verified_at = COALESCE(excluded.verified_at, verified_at)
+            """,
+            [(chat_id, user_id, status, now, verified_at) for user_id, status in statuses]
+        )
+        await db.executemany(
+            """
+            UPDATE users SET
+                added_to_channel = CASE WHEN ? THEN added_to_channel ELSE 1 END,
+                channel_member_removed = CASE WHEN ? THEN 1 ELSE 0 END
+            WHERE user_id = ?
+            """,
+            [
+                (status in CHANNEL_NON_MEMBER_STATUSES, status in CHANNEL_NON_MEMBER_STATUSES, user_id)
+                for user_id, status in statuses
+            ]
+        )
+    await _write(op)
+
+
+async def get_known_non_members(chat_id: int, user_ids: list) -> set:
+    """Subset of user_ids known to be outside the channel (unknown users are not included)"""
+    result = set()
+    async with _read() as db:
+        for i in range(0, len(user_ids), 500):
+            chunk = list(user_ids[i:i + 500])
             cursor = await db.execute(
-                "SELECT value FROM bot_settings WHERE key = ?",
-                (f"userbot_{key}",)
+                f"""
+                SELECT user_id FROM channel_members
+                WHERE chat_id = ? AND status IN ('left', 'kicked')
+                  AND user_id IN ({','.join('?' * len(chunk))})
+                """,
+                (chat_id, *chunk)
             )
-            if not await cursor.fetchone():
-                await db.execute(
-                    "INSERT INTO bot_settings (key, value) VALUES (?, ?)",
-                    (f"userbot_{key}", value)
-                )
-        await db.commit()
+            result.update(row[0] for row in await cursor.fetchall())
+    return result
+
+
+async def get_membership_drift(chat_id: int, stale_after_days: int = 7, limit: int = 200):
+    """Membership rows worth re-checking with get_chat_member: never verified,
+    verified long ago, or members without an active subscription"""
+    stale = (datetime.now() - timedelta(days=stale_after_days)).isoformat()
+    async with _read() as db:
+        cursor = await db.execute(
+            """
+            SELECT m.user_id, m.status FROM channel_members m
+            LEFT JOIN users u ON u.user_id = m.user_id
+            WHERE m.chat_id = ?
+              AND (m.verified_at IS NULL OR m.verified_at < ?
+                   OR (m.status = 'member' AND COALESCE(u.is_active, 0) = 0))
+            ORDER BY m.verified_at IS NOT NULL, m.verified_at
+            LIMIT ?
+            """,
+            (chat_id, stale, limit)
+        )
+        return [{"user_id": row[0], "status": row[1]} for row in await cursor.fetchall()]
+
+
+async def claim_due_reminders(offset_seconds: int, next_offset_seconds: int, limit: int = 500, fence: tuple | None = None):
+    """Claim up to `limit` users whose subscription_end entered the reminder
+    window (now + next_offset, now + offset].
+
+    A per-offset keyset watermark (subscription_end, user_id) stored in
+    bot_settings makes each call an index range scan over new entries only.
+    Claiming and advancing the watermark happen in one transaction, so a
+    restart neither repeats nor skips users. Users already inside a smaller
+    window are left to that offset's reminder, and subscriptions that land
+    inside a window already passed (e.g. a fresh renewal) are not reminded.
+    With fence=(lease_name, token) nothing is claimed unless the token is current.
+    """
+    now = datetime.now()
+    upper = (now + timedelta(seconds=offset_seconds)).isoformat()
+    floor = (now + timedelta(seconds=next_offset_seconds)).isoformat()
+    key = f"reminder_watermark_{offset_seconds}"
+
+    async def op(db):
+        if fence and not await _holds_lease(db, *fence):
+            return []
+        cursor = await db.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
+        row = await cursor.fetchone()
+        mark_end, mark_user = floor, -1
+        if row and row[0]:
+            end, user = row[0].rsplit("|", 1)
+            if end > floor:
+                mark_end, mark_user = end, int(user)
+        cursor = await db.execute(
+            """
+            SELECT user_id, subscription_end FROM users
+            WHERE is_active = 1
+              AND (subscription_end, user_id) > (?, ?)
+              AND subscription_end <= ?
+            ORDER BY subscription_end, user_id
+            LIMIT ?
+            """,
+            (mark_end, mark_user, upper, limit)
+        )
+        rows = await cursor.fetchall()
+        if rows:
+            await db.executemany(
+                """
+                INSERT OR IGNORE INTO reminders (user_id, offset_seconds, subscription_end, status, updated_at)
+                VALUES (?, ?, ?, 'queued', ?)
+                """,
+                [(user_id, offset_seconds, end, now.isoformat()) for user_id, end in rows]
+            )
+        # a short batch means the window is drained up to `upper`
+        if len(rows) == limit:
+            mark = f"{rows[-1][1]}|{rows[-1][0]}"
+        else:
+            mark = f"{upper}|{2**63 - 1}"
+        await db.execute("INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)", (key, mark))
+        return rows
+
+    rows = await _write(op)
+    return [{"user_id": user_id, "subscription_end": end, "offset_seconds": offset_seconds} for user_id, end in rows]
+
+
+async def get_queued_reminders(limit: int = 500):
+    """Reminders claimed but never confirmed sent (e.g. the process stopped mid-batch)"""
+    async with _read() as db:
+        cursor = await db.execute(
+            """
+            SELECT user_id, offset_seconds, subscription_end FROM reminders
+            WHERE status = 'queued' AND subscription_end > ?
+            ORDER BY subscription_end
+            LIMIT ?
+            """,
+            (datetime.now().isoformat(), limit)
+        )
+        return [
+            {"user_id": row[0], "offset_seconds": row[1], "subscription_end": row[2]}
+            for row in await cursor.fetchall()
+        ]
+
+
+async def mark_reminders(reminders: list, status: str):
+    """Set the status of claimed reminders ('sent' or 'failed')"""
+    await _write(lambda db: db.executemany(
+        "UPDATE reminders SET status = ?, updated_at = ? WHERE user_id = ? AND offset_seconds = ? AND subscription_end = ?",
+        [
+            (status, datetime.now().isoformat(), r["user_id"], r["offset_seconds"], r["subscription_end"])
+            for r in reminders
+        ]
+    ))
+
+
+async def purge_old_reminders(days: int = 7):
+    """Drop reminder rows for subscriptions that ended more than `days` ago"""
+    async def op(db):
+        cursor = await db.execute(
+            "DELETE FROM reminders WHERE status IN ('queued', 'sent', 'failed') AND subscription_end < ?",
+            ((datetime.now() - timedelta(days=days)).isoformat(),)
+        )
+        return cursor.rowcount
+    return await _write(op)
+
+
+async def acquire_lease(name: str, holder: str, ttl_seconds: float):
+    """Take or renew the named lease for ttl_seconds.
+
+    Succeeds when the lease is free, expired or already ours. Every change of
+    holder increments the fencing token. Returns the token, or None while
+    another holder's lease is still valid.
+    """
+    now = datetime.now()
+
+    async def op(db):
+        cursor = await db.execute(
+            """
+            INSERT INTO leases (name, holder, token, expires_at) VALUES (?, ?, 1, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                token = CASE WHEN leases.holder = excluded.holder THEN leases.token ELSE leases.token + 1 END,
+                holder = excluded.holder,
+                expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+            RETURNING token
+            """,
+            (name, holder, (now + timedelta(seconds=ttl_seconds)).isoformat(), now.isoformat())
+        )
+        row = await cursor.fetchone()
+        return row[0] if row else None
+    return await _write(op)
+
+
+async def release_lease(name: str, holder: str):
+    """Give up the lease if we hold it, so a standby can take over at once"""
+    await _write(lambda db: db.execute(
+        "UPDATE leases SET expires_at = ? WHERE name = ? AND holder = ?",
+        (datetime.min.isoformat(), name, holder)
+    ))
+
+
+async def get_lease(name: str):
+    """Current holder, fencing token and expiry of a lease (None if never taken)"""
+    async with _read() as db:
+        cursor = await db.execute("SELECT holder, token, expires_at FROM leases WHERE name = ?", (name,))
+        row = await cursor.fetchone()
+    if row:
+        return {"holder": row[0], "token": row[1], "expires_at": row[2]}
+    return None
+
+
+async def _holds_lease(db, name: str, token: int) -> bool:
+    """Fencing check inside a write: is `token` still the current one?"""
+    cursor = await db.execute("SELECT token FROM leases WHERE name = ?", (name,))
+    row = await cursor.fetchone()
+    return bool(row) and row[0] == token
+
+
+async def set_user_language(user_id: int, language: str):
+    """Remember the user's interface language (used for broadcast targeting)"""
+    await _write(lambda db: db.execute("UPDATE users SET language = ? WHERE user_id = ?", (language, user_id)))
+
+
+async def sync_user_languages(languages: list) -> int:
+    """Copy [(user_id, language)] into users and users_archive where it differs; returns rows changed"""
+    rows = [(language, int(user_id), language) for user_id, language in languages]
+    if not rows:
+        return 0
+
+    async def op(db):
+        changed = 0
+        for row in rows:
+            for table in ("users", "users_archive"):
+                cursor = await db.execute(f"UPDATE {table} SET language = ? WHERE user_id = ? AND language IS NOT ?", row)
+                changed += cursor.rowcount
+        return changed
+    return await _write(op)
+
+
+def _segment_filter(segment: str, arg: str | None):
+    """WHERE clause and params selecting a broadcast audience; each one is index-backed"""
+    if segment == 'all':
+        return "1 = 1", ()
+    if segment == 'active':
+        return "is_active = 1", ()
+    if segment == 'expired':
+        now = datetime.now()
+        since = (now - timedelta(days=int(arg or 7))).isoformat()
+        return "is_active = 0 AND subscription_end >= ? AND subscription_end < ?", (since, now.isoformat())
+    if segment == 'never_purchased':
+        return "subscription_end IS NULL", ()
+    if segment == 'language':
+        if arg == DEFAULT_LANGUAGE:
+            return "(language = ? OR language IS NULL)", (arg,)
+        return "language = ?", (arg,)
+    if segment == 'service':
+        return "service_id = ? AND is_active = 1", (int(arg),)
+    raise ValueError(f"unknown broadcast segment: {segment}")
+
+
+def _segment_tables(segment: str) -> tuple:
+    """Tables a segment reads: the hot tier, plus the archive unless it targets active subscribers"""
+    return ('users',) if segment in ACTIVE_SEGMENTS else ('users', 'users_archive')
+
+
+async def get_segment_user_ids(segment: str, arg: str | None = None, after_user_id: int = 0, limit: int = 500) -> list:
+    """Next page of a segment's user ids (keyset on user_id across the hot and archive tiers)"""
+    where, params = _segment_filter(segment, arg)
+    tables = _segment_tables(segment)
+    # each tier yields its own next page from its index; the merge keeps the first `limit`
+    query = " UNION ALL ".join(
+        f"SELECT * FROM (SELECT user_id FROM {table} WHERE {where} AND user_id > ? ORDER BY user_id LIMIT ?)"
+        for table in tables
+    )
+    async with _read() as db:
+        cursor = await db.execute(
+            f"{query} ORDER BY user_id LIMIT ?",
+            (*params, after_user_id, limit) * len(tables) + (limit,)
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+
+async def count_segment(segment: str, arg: str | None = None) -> int:
+    """Number of users in a broadcast segment"""
+    where, params = _segment_filter(segment, arg)
+    tables = _segment_tables(segment)
+    counts = " + ".join(f"(SELECT COUNT(*) FROM {table} WHERE {where})" for table in tables)
+    async with _read() as db:
+        cursor = await db.execute(f"SELECT {counts}", tuple(params) * len(tables))
+        return (await cursor.fetchone())[0]
+
+
+async def create_broadcast(segment: str, segment_arg: str | None, scheduled_at: datetime, created_by: int,
+                           text: str | None = None, source_chat_id: int | None = None,
+                           source_message_id: int | None = None) -> int:
+    """Persist a broadcast: either HTML text or a stored message to copy"""
+    _segment_filter(segment, segment_arg)
+
+    async def op(db):
+        cursor = await db.execute(
+            """
+            INSERT INTO broadcasts (segment, segment_arg, text, source_chat_id, source_message_id, scheduled_at, status, created_by, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'scheduled', ?, ?)
+            """,
+            (segment, segment_arg, text, source_chat_id, source_message_id, scheduled_at.isoformat(), created_by, datetime.now().isoformat())
+        )
+        return cursor.lastrowid
+    return await _write(op)
+
+
+_BROADCAST_COLUMNS = (
+    "id, segment, segment_arg, text, source_chat_id, source_message_id, scheduled_at, "
+    "status, created_by, last_user_id, sent, failed, finished_at"
+)
+
+
+def _broadcast_row(row) -> dict:
+    return dict(zip(_BROADCAST_COLUMNS.split(", "), row))
+
+
+async def get_due_broadcasts() -> list:
+    """Broadcasts whose time has come, plus ones interrupted mid-send"""
+    async with _read() as db:
+        cursor = await db.execute(
+            f"""
+            SELECT {_BROADCAST_COLUMNS} FROM broadcasts
+            WHERE status = 'sending' OR (status = 'scheduled' AND scheduled_at <= ?)
+            ORDER BY scheduled_at
+            """,
+            (datetime.now().isoformat(),)
+        )
+        return [_broadcast_row(row) for row in await cursor.fetchall()]
+
+
+async def get_broadcasts(limit: int = 10) -> list:
+    """Pending broadcasts first, then the most recent finished ones"""
+    async with _read() as db:
+        cursor = await db.execute(
+            f"""
+            SELECT {_BROADCAST_COLUMNS} FROM broadcasts
+            ORDER BY status IN ('scheduled', 'sending') DESC, scheduled_at DESC
+            LIMIT ?
+            """,
+            (limit,)
+        )
+        return [_broadcast_row(row) for row in await cursor.fetchall()]
+
+
+async def start_broadcast(broadcast_id: int) -> bool:
+    """scheduled -> sending; False if it was cancelled or already started"""
+    async def op(db):
+        cursor = await db.execute("UPDATE broadcasts SET status = 'sending' WHERE id = ? AND status = 'scheduled'", (broadcast_id,))
+        return cursor.rowcount == 1
+    return await _write(op)
+
+
+async def record_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int) -> bool:
+    """Advance the resume cursor and counters; False once the broadcast was cancelled"""
+    async def op(db):
+        cursor = await db.execute(
+            """
+            UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?
+            WHERE id = ? AND status = 'sending'
+            """,
+            (last_user_id, sent, failed, broadcast_id)
+        )
+        return cursor.rowcount == 1
+    return await _write(op)
+
+
+async def finish_broadcast(broadcast_id: int, status: str = 'done'):
+    """Close a broadcast (done/cancelled) unless it was already closed"""
+    if status not in BROADCAST_STATUSES:
+        raise ValueError(f"invalid broadcast status: {status}")
+    async def op(db):
+        cursor = await db.execute(
+            "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status IN ('scheduled', 'sending')",
+            (status, datetime.now().isoformat(), broadcast_id)
+        )
+        return cursor.rowcount == 1
+    return await _write(op)
+
+
+async def get_channels() -> list:
+    """Registered channels with the ids of the services granting each one"""
+    async with _read() as db:
+        cursor = await db.execute("SELECT chat_id, title, is_default, join_link FROM channels ORDER BY added_at, chat_id")
+        channels = [
+            {"chat_id": row[0], "title": row[1], "is_default": bool(row[2]), "join_link": row[3], "services": []}
+            for row in await cursor.fetchall()
+        ]
+        by_id = {channel["chat_id"]: channel for channel in channels}
+        cursor = await db.execute("SELECT service_id, chat_id FROM service_channels ORDER BY service_id")
+        for service_id, chat_id in await cursor.fetchall():
+            if chat_id in by_id:
+                by_id[chat_id]["services"].append(service_id)
+    return channels
+
+
+async def add_channel(chat_id: int, title: str | None = None, is_default: bool = False) -> bool:
+    """Register a channel, or refresh the title of a known one; True if it is new"""
+    async def op(db):
+        cursor = await db.execute(
+            "INSERT OR IGNORE INTO channels (chat_id, title, is_default, added_at) VALUES (?, ?, ?, ?)",
+            (chat_id, title, int(is_default), datetime.now().isoformat())
+        )
+        if cursor.rowcount == 1:
+            return True
+        await db.execute("UPDATE channels SET title = COALESCE(?, title) WHERE chat_id = ?", (title, chat_id))
+        return False
+    return await _write(op)
+
+
+async def remove_channel(chat_id: int):
+    """Forget a channel and every service grant of it"""
+    async def op(db):
+        await db.execute("DELETE FROM service_channels WHERE chat_id = ?", (chat_id,))
+        await db.execute("DELETE FROM channels WHERE chat_id = ?", (chat_id,))
+    await _write(op)
+
+
+async def set_channel_default(chat_id: int, is_default: bool):
+    """Default channels are granted by services without their own channel list"""
+    await _write(lambda db: db.execute("UPDATE channels SET is_default = ? WHERE chat_id = ?", (int(is_default), chat_id)))
+
+
+async def set_channel_join_link(chat_id: int, join_link: str):
+    await _write(lambda db: db.execute("UPDATE channels SET join_link = ? WHERE chat_id = ?", (join_link, chat_id)))
+
+
+async def set_service_channel(service_id: int, chat_id: int, granted: bool):
+    """Grant or withdraw a channel for a service"""
+    if granted:
+        await _write(lambda db: db.execute(
+            "INSERT OR IGNORE INTO service_channels (service_id, chat_id) VALUES (?, ?)", (service_id, chat_id)
+        ))
+    else:
+        await _write(lambda db: db.execute(
+            "DELETE FROM service_channels WHERE service_id = ? AND chat_id = ?", (service_id, chat_id)
+        ))
+
+
+async def get_channel_removals(user_ids: list) -> dict:
+    """{chat_id: [user_id]} of channels each user may be in: known members, plus
+    channels their service grants where membership is unknown"""
+    removals = {}
+    async with _read() as db:
+        for i in range(0, len(user_ids), 500):
+            chunk = list(user_ids[i:i + 500])
+            cursor = await db.execute(
+                f"""
+                WITH ids(user_id) AS (VALUES {','.join(['(?)'] * len(chunk))})
+                SELECT c.chat_id, ids.user_id FROM ids
+                CROSS JOIN channels c
+                LEFT JOIN users u ON u.user_id = ids.user_id
+                LEFT JOIN channel_members m ON m.chat_id = c.chat_id AND m.user_id = ids.user_id
+                WHERE CASE WHEN m.status IS NOT NULL THEN m.status NOT IN ('left', 'kicked')
+                      ELSE EXISTS (SELECT 1 FROM service_channels s WHERE s.service_id = u.service_id AND s.chat_id = c.chat_id)
+                           OR (c.is_default = 1 AND NOT EXISTS (SELECT 1 FROM service_channels s WHERE s.service_id = u.service_id))
+                      END
+                ORDER BY c.chat_id, ids.user_id
+                """,
+                chunk
+            )
+            for chat_id, user_id in await cursor.fetchall():
+                removals.setdefault(chat_id, []).append(user_id)
+    return removals
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+class GroupCommitWriter:
+    """Single writer task that owns the only write connection to a database.
+
+    `submit(op)` queues a coroutine function taking the connection and returns
+    its result once the transaction containing it has been committed. The
+    worker takes up to `batch_size` queued ops, runs each inside a savepoint
+    of one `BEGIN IMMEDIATE` transaction and commits once, so concurrent
+    writers share an fsync instead of fighting over the database lock. A
+    failing op is rolled back to its savepoint and only its caller sees the
+    exception. Ops must not commit or open transactions themselves.
+    """
+
+    def __init__(self, path_getter: Callable[[], str], batch_size: int = 100):
+        self.path_getter = path_getter
+        self.batch_size = batch_size
+        self.committed = 0
+        self.batches = 0
+        self.failed = 0
+        self.max_batch = 0
+        self.commit_seconds = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._conn_path: Optional[str] = None
+
+    def _bind(self):
+        # queue, worker and connection belong to one event loop until close()
+        loop = asyncio.get_running_loop()
+        if self._loop is None:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+        elif self._loop is not loop:
+            raise RuntimeError("GroupCommitWriter is bound to another event loop; close() it there first")
+
+    def _ensure_worker(self):
+        self._bind()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run(), name="db-writer")
+
+    async def submit(self, op: WriteOp) -> Any:
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, future))
+        return await future
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def snapshot(self) -> dict:
+        return {
+            "queued": self.qsize(),
+            "committed": self.committed,
+            "batches": self.batches,
+            "failed": self.failed,
+            "max_batch": self.max_batch,
+            "avg_batch": round(self.committed / self.batches, 1) if self.batches else 0,
+            "avg_commit_ms": round(self.commit_seconds / self.batches * 1000, 2) if self.batches else 0,
+        }
+
+    async def close(self):
+        """Finish queued ops, then stop the worker, close the connection and unbind the loop"""
+        if self._loop is None:
+            return
+        self._bind()
+        if self._queue is not None and self._worker is not None and not self._worker.done():
+            await self._queue.join()
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+        self._queue = None
+        self._loop = None
+
+    async def _connect(self, path: str) -> aiosqlite.Connection:
+        # autocommit mode: transactions are opened explicitly by the worker
+        conn = await aiosqlite.connect(path, isolation_level=None)
+        await conn.execute("PRAGMA busy_timeout = 5000")
+        return conn
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._run_batch(batch)
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    if not future.done():
+                        future.cancel()
+                raise
+            except Exception as e:
+                logger.error("Write batch of %d failed: %s", len(batch), e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                # start over on a fresh connection
+                if self._conn is not None:
+                    try:
+                        await self._conn.close()
+                    except Exception:
+                        pass
+                    self._conn = None
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _run_batch(self, batch: list):
+        path = self.path_getter()
+        if self._conn is not None and self._conn_path != path:
+            await self._conn.close()
+            self._conn = None
+        if self._conn is None:
+            self._conn = await self._connect(path)
+            self._conn_path = path
+        conn = self._conn
+        results = []
+        failed = 0
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            for op, future in batch:
+                if future.cancelled():
+                    results.append(None)
+                    continue
+                await conn.execute("SAVEPOINT op")
+                try:
+                    result = await op(conn)
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO op")
+                    await conn.execute("RELEASE op")
+                    failed += 1
+                    if not future.done():
+                        future.set_exception(e)
+                    results.append(None)
+                    continue
+                await conn.execute("RELEASE op")
+                results.append(result)
+            started = time.perf_counter()
+            await conn.execute("COMMIT")
+            self.commit_seconds += time.perf_counter() - started
+        except BaseException:
+            if conn.in_transaction:
+                await conn.execute("ROLLBACK")
+            raise
+        self.batches += 1
+        self.committed += len(batch) - failed
+        self.failed += failed
+        self.max_batch = max(self.max_batch, len(batch))
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
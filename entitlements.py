@@ -0,0 +1,59 @@
+"""In-memory cache of users entitled to channel access.
+
+Maps user_id -> (subscription_end, service_id) for active subscribers, and
+each service to the channels it grants, so the channel join path can decide
+without touching the database. database.py updates it on every subscription
+write; channels.refresh() loads the service -> channel mapping; main.py
+reloads both periodically to pick up changes made outside this process.
+"""
+from datetime import datetime
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+
+_active: Dict[int, Tuple[datetime, Optional[int]]] = {}
+# services without their own channel list grant the default channels
+_service_channels: Dict[int, FrozenSet[int]] = {}
+_default_channels: FrozenSet[int] = frozenset()
+
+
+def replace_all(rows: Iterable[Tuple[int, str, Optional[int]]]):
+    """Replace the cache with (user_id, subscription_end, service_id) rows"""
+    global _active
+    fresh = {}
+    for user_id, subscription_end, service_id in rows:
+        if subscription_end:
+            fresh[user_id] = (datetime.fromisoformat(subscription_end), service_id)
+    _active = fresh
+
+
+def grant(user_id: int, subscription_end: datetime, service_id: Optional[int] = None):
+    """Record an active subscription; without service_id the known plan is kept"""
+    if service_id is None and user_id in _active:
+        service_id = _active[user_id][1]
+    _active[user_id] = (subscription_end, service_id)
+
+
+def revoke(user_id: int):
+    _active.pop(user_id, None)
+
+
+def set_channel_grants(service_channels: Dict[int, Iterable[int]], default_channels: Iterable[int]):
+    """Replace the service -> channels mapping"""
+    global _service_channels, _default_channels
+    _service_channels = {service_id: frozenset(chat_ids) for service_id, chat_ids in service_channels.items()}
+    _default_channels = frozenset(default_channels)
+
+
+def channels_for_service(service_id: Optional[int]) -> FrozenSet[int]:
+    return _service_channels.get(service_id) or _default_channels
+
+
+def is_entitled(user_id: int, chat_id: Optional[int] = None) -> bool:
+    """Active subscriber; with chat_id, also one whose plan grants that channel"""
+    entry = _active.get(user_id)
+    if entry is None or entry[0] <= datetime.now():
+        return False
+    return chat_id is None or chat_id in channels_for_service(entry[1])
+
+
+def count() -> int:
+    return len(_active)
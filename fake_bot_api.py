@@ -0,0 +1,345 @@
+"""Local stand-in for the Telegram Bot API, for end-to-end runs without Telegram.
+
+Serves /bot<token>/<method> like api.telegram.org: getUpdates long-polls
+a per-bot queue of updates injected by the caller, every other call is
+recorded and answered with a plausible result, after `latency_ms` to
+stand in for the round trip to Telegram. Point the bots at it with
+BOT_API_SERVER = "http://127.0.0.1:8081" in config.py.
+
+Updates are injected from Python (push_message, push_callback, pay) or over
+HTTP while `python main.py` runs against it:
+
+    python fake_bot_api.py [--port 8081] [--latency-ms 150]
+    curl -d '{"user_id": 1, "text": "/start"}' localhost:8081/_fake/<token>/message
+    curl -d '{"messages": [{"user_id": 1, "text": "hi"}]}' localhost:8081/_fake/<token>/messages
+    curl -d '{"updates": [{"user_id": 1, "data": "buy_subscription"}, {"user_id": 1, "join_chat_id": -100}]}' \
+        localhost:8081/_fake/<token>/batch
+    curl -d '{"user_id": 1, "data": "service_1"}' localhost:8081/_fake/<token>/callback
+    curl -d '{"user_id": 1, "deliveries": 2}' localhost:8081/_fake/<token>/pay
+    curl -d '{"user_id": 1, "total_amount": 100}' localhost:8081/_fake/<token>/pay
+    curl localhost:8081/_fake/<token>/calls?method=sendMessage
+    curl localhost:8081/_fake/<token>/stats
+
+pay() answers the last invoice sent to the user the way Telegram does: a
+pre_checkout_query first, then, if the bot answered ok, a successful_payment
+message (delivered `deliveries` times to exercise idempotency). With
+`total_amount` it pays another amount than the invoice asked for. Approving a
+join request or banning/unbanning a member produces the chat_member update
+Telegram would send.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import time
+import uuid
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# string parameters that must not be decoded as JSON even when they look like numbers
+_TEXT_PARAMS = {
+    "text", "caption", "title", "description", "payload", "currency", "provider_token",
+    "name", "error_message", "invite_link", "url", "parse_mode", "callback_query_id",
+    "pre_checkout_query_id", "start_parameter", "emoji",
+}
+
+
+def _decode(key: str, value: str) -> Any:
+    if key in _TEXT_PARAMS:
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class FakeBot:
+    """State of one bot token: pending updates, recorded calls and sent invoices"""
+
+    def __init__(self, token: str, max_calls: int = 10_000):
+        self.token = token
+        self.id = int(token.split(":", 1)[0]) if token.split(":", 1)[0].isdigit() else 1
+        self.updates: Deque[dict] = deque()
+        self.calls: Deque[dict] = deque(maxlen=max_calls)
+        self.counts: Counter = Counter()
+        self.pushed = 0
+        self.invoices: Dict[int, dict] = {}
+        self.checkouts: Dict[str, asyncio.Future] = {}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._arrived = asyncio.Event()
+
+    @property
+    def user(self) -> dict:
+        return {"id": self.id, "is_bot": True, "first_name": f"bot{self.id}", "username": f"fake{self.id}_bot"}
+
+    def push(self, **update) -> dict:
+        update["update_id"] = next(self._update_ids)
+        self.pushed += 1
+        self.updates.append(update)
+        self._arrived.set()
+        return update
+
+    async def get_updates(self, offset: int = 0, limit: int = 100, timeout: float = 0) -> List[dict]:
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.updates, limit))
+
+    def message(self, chat_id: int, **fields) -> dict:
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "channel"}
+        return {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat, "from": self.user, **fields}
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+class FakeBotAPI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, latency_ms: float = 0):
+        self.host = host
+        self.port = port
+        self.latency = latency_ms / 1000
+        self.bots: Dict[str, FakeBot] = {}
+        self._runner: Optional[web.AppRunner] = None
+        self._charges = itertools.count(1)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def bot(self, token: str) -> FakeBot:
+        if token not in self.bots:
+            self.bots[token] = FakeBot(token)
+        return self.bots[token]
+
+    # ---- server ----
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle_method)
+        app.router.add_post("/_fake/{token}/message", self._control_message)
+        app.router.add_post("/_fake/{token}/messages", self._control_messages)
+        app.router.add_post("/_fake/{token}/batch", self._control_batch)
+        app.router.add_post("/_fake/{token}/callback", self._control_callback)
+        app.router.add_post("/_fake/{token}/pay", self._control_pay)
+        app.router.add_get("/_fake/{token}/calls", self._control_calls)
+        app.router.add_get("/_fake/{token}/stats", self._control_stats)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if not self.port:
+            self.port = site._server.sockets[0].getsockname()[1]
+        logger.info("Fake Bot API listening on %s", self.url)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        bot = self.bot(request.match_info["token"])
+        method = request.match_info["method"]
+        form = await request.post()
+        params = {key: _decode(key, value) for key, value in form.items() if isinstance(value, str)}
+        bot.calls.append({"method": method, "params": params})
+        bot.counts[method] += 1
+        if method == "getUpdates":
+            result = await bot.get_updates(
+                int(params.get("offset", 0)), int(params.get("limit", 100)), float(params.get("timeout", 0))
+            )
+        else:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            result = self._result(bot, method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    def _result(self, bot: FakeBot, method: str, params: dict) -> Any:
+        chat_id = params.get("chat_id", 0)
+        if method == "getMe":
+            return bot.user
+        if method in ("sendMessage", "editMessageText"):
+            return bot.message(chat_id, text=params.get("text", ""))
+        if method in ("sendPhoto", "editMessageCaption"):
+            return bot.message(chat_id, caption=params.get("caption", ""))
+        if method == "copyMessage":
+            return {"message_id": next(bot._message_ids)}
+        if method == "sendInvoice":
+            invoice = {
+                "title": params.get("title", ""), "description": params.get("description", ""),
+                "start_parameter": "", "currency": params["currency"],
+                "total_amount": sum(price["amount"] for price in params.get("prices", [])),
+            }
+            bot.invoices[chat_id] = {**invoice, "payload": params.get("payload", "")}
+            return bot.message(chat_id, invoice=invoice)
+        if method == "answerPreCheckoutQuery":
+            future = bot.checkouts.pop(params.get("pre_checkout_query_id"), None)
+            if future is not None and not future.done():
+                future.set_result((params.get("ok"), params.get("error_message")))
+            return True
+        if method == "getUserProfilePhotos":
+            return {"total_count": 0, "photos": []}
+        if method == "createChatInviteLink":
+            return {
+                "invite_link": f"https://t.me/+fake{uuid.uuid4().hex[:12]}", "creator": bot.user,
+                "creates_join_request": bool(params.get("creates_join_request")),
+                "is_primary": False, "is_revoked": False, "name": params.get("name"),
+            }
+        if method in ("approveChatJoinRequest", "banChatMember", "unbanChatMember"):
+            status = {"approveChatJoinRequest": "member", "banChatMember": "kicked", "unbanChatMember": "left"}[method]
+            self.push_chat_member(bot, chat_id, params.get("user_id", 0), status)
+            return True
+        if method == "getChatMember":
+            return {"status": "left", "user": _user(params.get("user_id", 0))}
+        if method == "getChat":
+            return {"id": chat_id, "type": "channel", "title": f"channel {chat_id}", "accent_color_id": 0, "max_reaction_count": 0}
+        return True
+
+    # ---- update injection ----
+
+    def push_message(self, token: str, user_id: int, text: str) -> dict:
+        bot = self.bot(token)
+        message = bot.message(user_id, text=text)
+        message["from"] = _user(user_id)
+        message["chat"].update(first_name=f"user{user_id}")
+        return bot.push(message=message)
+
+    def push_callback(self, token: str, user_id: int, data: str) -> dict:
+        bot = self.bot(token)
+        return bot.push(callback_query={
+            "id": uuid.uuid4().hex, "from": _user(user_id), "chat_instance": str(user_id),
+            "data": data, "message": bot.message(user_id, text="menu"),
+        })
+
+    def push_join_request(self, token: str, chat_id: int, user_id: int) -> dict:
+        return self.bot(token).push(chat_join_request={
+            "chat": {"id": chat_id, "type": "channel", "title": f"channel {chat_id}"},
+            "from": _user(user_id), "user_chat_id": user_id, "date": int(time.time()),
+        })
+
+    def push_chat_member(self, bot: FakeBot, chat_id: int, user_id: int, status: str) -> dict:
+        old = {"member": "left", "kicked": "member", "left": "kicked"}[status]
+        user = _user(user_id)
+        if status == "kicked":
+            new_member = {"status": "kicked", "user": user, "until_date": 0}
+        else:
+            new_member = {"status": status, "user": user}
+        old_member = {"status": old, "user": user, **({"until_date": 0} if old == "kicked" else {})}
+        return bot.push(chat_member={
+            "chat": {"id": chat_id, "type": "channel", "title": f"channel {chat_id}"},
+            "from": bot.user, "date": int(time.time()),
+            "old_chat_member": old_member, "new_chat_member": new_member,
+        })
+
+    async def pay(self, token: str, user_id: int, deliveries: int = 1, timeout: float = 10,
+                  total_amount: Optional[int] = None) -> dict:
+        """Pay the last invoice sent to the user; returns the checkout outcome and charge id"""
+        bot = self.bot(token)
+        invoice = bot.invoices.get(user_id)
+        if invoice is None:
+            return {"ok": False, "error": "no invoice"}
+        if total_amount is not None:
+            invoice = {**invoice, "total_amount": total_amount}
+        query_id = uuid.uuid4().hex
+        future = bot.checkouts[query_id] = asyncio.get_running_loop().create_future()
+        bot.push(pre_checkout_query={
+            "id": query_id, "from": _user(user_id), "currency": invoice["currency"],
+            "total_amount": invoice["total_amount"], "invoice_payload": invoice["payload"],
+        })
+        try:
+            ok, error = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            bot.checkouts.pop(query_id, None)
+            return {"ok": False, "error": "pre_checkout_query not answered"}
+        if not ok:
+            return {"ok": False, "error": error}
+        charge_id = f"fake-charge-{next(self._charges)}"
+        for _ in range(deliveries):
+            message = bot.message(user_id, successful_payment={
+                "currency": invoice["currency"], "total_amount": invoice["total_amount"],
+                "invoice_payload": invoice["payload"],
+                "telegram_payment_charge_id": charge_id, "provider_payment_charge_id": f"provider-{charge_id}",
+            })
+            message["from"] = _user(user_id)
+            bot.push(message=message)
+        return {"ok": True, "charge_id": charge_id}
+
+    async def _control_message(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response(self.push_message(request.match_info["token"], body["user_id"], body["text"]))
+
+    async def _control_messages(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        token = request.match_info["token"]
+        for message in body["messages"]:
+            self.push_message(token, message["user_id"], message["text"])
+        return web.json_response({"queued": len(body["messages"])})
+
+    async def _control_batch(self, request: web.Request) -> web.Response:
+        """Mixed updates in order: {"user_id", "text"} messages, {"user_id", "data"} button taps
+        and {"user_id", "join_chat_id"} join requests"""
+        body = await request.json()
+        token = request.match_info["token"]
+        for item in body["updates"]:
+            if "text" in item:
+                self.push_message(token, item["user_id"], item["text"])
+            elif "data" in item:
+                self.push_callback(token, item["user_id"], item["data"])
+            else:
+                self.push_join_request(token, item["join_chat_id"], item["user_id"])
+        return web.json_response({"queued": len(body["updates"])})
+
+    async def _control_callback(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response(self.push_callback(request.match_info["token"], body["user_id"], body["data"]))
+
+    async def _control_pay(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response(await self.pay(
+            request.match_info["token"], body["user_id"], body.get("deliveries", 1), total_amount=body.get("total_amount")
+        ))
+
+    async def _control_calls(self, request: web.Request) -> web.Response:
+        bot = self.bot(request.match_info["token"])
+        method = request.query.get("method")
+        return web.json_response([call for call in bot.calls if method is None or call["method"] == method])
+
+    async def _control_stats(self, request: web.Request) -> web.Response:
+        bot = self.bot(request.match_info["token"])
+        return web.json_response({"pushed": bot.pushed, "queued": len(bot.updates), "calls": dict(bot.counts)})
+
+
+async def _serve(host: str, port: int, latency_ms: float = 0):
+    server = FakeBotAPI(host, port, latency_ms)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay before answering each Bot API call")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_serve(args.host, args.port, args.latency_ms))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,35 @@
+"""In-memory FSM storage that only keeps users who are in the middle of a dialog.
+
+aiogram's MemoryStorage is a defaultdict: the FSM middleware reads the state
+of every update, so every user who ever wrote to a bot gets a record, and
+clearing a state leaves the record behind. Here reads do not create records
+and a record without state or data is dropped, so memory follows the number
+of open dialogs rather than the number of users seen.
+"""
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.storage.base import StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+
+class CompactMemoryStorage(MemoryStorage):
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await super().set_state(key, state)
+        self._prune(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self.storage.get(key)
+        return record.state if record is not None else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await super().set_data(key, data)
+        self._prune(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self.storage.get(key)
+        return record.data.copy() if record is not None else {}
+
+    def _prune(self, key: StorageKey):
+        record = self.storage.get(key)
+        if record is not None and record.state is None and not record.data:
+            del self.storage[key]
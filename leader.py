@@ -0,0 +1,117 @@
+"""Lease-based leader election between bot instances sharing one database.
+
+Every instance heartbeats `acquire_lease` every LEADER_HEARTBEAT seconds.
+The holder renews its lease for LEADER_LEASE_TTL seconds; the others take
+it over once it expires (or at once when the leader shuts down and releases
+it). Each change of holder bumps a fencing token: the singleton jobs (expiry,
+reminders, maintenance, ...) run only on the leader, and their claiming
+writes pass `election.fence`, so a leader that stalled past its lease cannot
+claim work the new leader already owns.
+
+The leader considers itself leader only until `ttl` after the start of its
+last successful renewal, which is never later than the expiry stored in the
+database, and cancels its jobs when that passes.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import config
+from repository import backend as db
+
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE_TTL = getattr(config, "LEADER_LEASE_TTL", 15)
+LEADER_HEARTBEAT = getattr(config, "LEADER_HEARTBEAT", 5)
+
+
+class LeaderElection:
+    def __init__(self, name: str = "scheduler", ttl: float = LEADER_LEASE_TTL, heartbeat: float = LEADER_HEARTBEAT):
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.token: Optional[int] = None
+        self.elected = 0
+        self.lost = 0
+        self._valid_until = 0.0
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None and time.monotonic() < self._valid_until
+
+    @property
+    def fence(self) -> tuple:
+        """(lease name, token) for fenced writes; token 0 never matches"""
+        return (self.name, self.token if self.is_leader else 0)
+
+    async def _heartbeat(self):
+        started = time.monotonic()
+        try:
+            token = await asyncio.wait_for(
+                db.acquire_lease(self.name, self.holder, self.ttl), timeout=self.heartbeat
+            )
+        except Exception as e:
+            # keep the current lease until it runs out locally
+            logger.error("Leader lease heartbeat failed: %s", e)
+            return
+        if token is None:
+            self.token = None
+            return
+        if token != self.token:
+            self.elected += 1
+            logger.info("Became leader %s (fencing token %d)", self.holder, token)
+        self.token = token
+        self._valid_until = started + self.ttl
+
+    async def run(self, jobs: List[Callable[[], Awaitable[Any]]]):
+        """Heartbeat forever; run `jobs` while leader and cancel them when the lease is lost"""
+        tasks: List[asyncio.Task] = []
+        try:
+            while True:
+                await self._heartbeat()
+                if self.is_leader and not tasks:
+                    tasks = [asyncio.create_task(job(), name=f"leader-{job.__name__}") for job in jobs]
+                elif not self.is_leader and tasks:
+                    self.lost += 1
+                    logger.warning("Lost leadership %s, stopping %d jobs", self.holder, len(tasks))
+                    await _cancel(tasks)
+                    tasks = []
+                await self._sleep_until_next_check()
+        finally:
+            await _cancel(tasks)
+            if self.token is not None:
+                self.token = None
+                try:
+                    await db.release_lease(self.name, self.holder)
+                except Exception as e:
+                    logger.error("Failed to release leader lease: %s", e)
+
+    async def _sleep_until_next_check(self):
+        delay = self.heartbeat
+        if self.token is not None:
+            # wake up in time to stop the jobs if renewals keep failing
+            delay = max(0.0, min(delay, self._valid_until - time.monotonic()))
+        await asyncio.sleep(delay)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "holder": self.holder,
+            "leader": self.is_leader,
+            "token": self.token,
+            "elected": self.elected,
+            "lost": self.lost,
+        }
+
+
+async def _cancel(tasks: List[asyncio.Task]):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+election = LeaderElection()
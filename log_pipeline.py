@@ -0,0 +1,204 @@
+"""Non-blocking structured logging.
+
+setup_logging() puts a single QueueHandler on the root logger. Callers only
+enqueue the LogRecord: the message is not formatted on the event loop, a
+QueueListener thread formats it (JSON lines by default) and writes it to
+stderr. Pass values as logging arguments (`logger.info("... %s", x)`)
+rather than f-strings so that formatting really happens on that thread.
+
+Every record carries the update_id and user_id of the update being handled
+(set by LogContextMiddleware), or an explicit `extra={"user_id": ...}`.
+
+Repetitive per-user events are sampled: records logged with
+`extra={"sample": "<key>"}` (and every record of the loggers in
+LOG_SAMPLE_LOGGERS) are written only for the first LOG_SAMPLE_FIRST events
+of a key per LOG_SAMPLE_WINDOW seconds; the rest are counted and reported
+in one summary line per key and window.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import TelegramObject, Update
+
+import config
+
+LOG_LEVEL = getattr(config, "LOG_LEVEL", "INFO")
+LOG_FORMAT = getattr(config, "LOG_FORMAT", "json")
+LOG_SAMPLE_WINDOW = getattr(config, "LOG_SAMPLE_WINDOW", 60)
+LOG_SAMPLE_FIRST = getattr(config, "LOG_SAMPLE_FIRST", 5)
+LOG_SAMPLE_LOGGERS = getattr(config, "LOG_SAMPLE_LOGGERS", ["aiogram.event"])
+
+update_id_var: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("update_id", default=None)
+user_id_var: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("user_id", default=None)
+
+# standard LogRecord attributes; anything else was passed via `extra`
+_RECORD_FIELDS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+_listener: Optional["_Listener"] = None
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records as they are: no formatting on the calling thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if not hasattr(record, "update_id"):
+            record.update_id = update_id_var.get()
+        if not hasattr(record, "user_id"):
+            record.user_id = user_id_var.get()
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _Sampler:
+    """Per-key counters for sampled records; runs on the listener thread only"""
+
+    def __init__(self, window: float, first: int, loggers: List[str]):
+        self.window = window
+        self.first = first
+        self.loggers = set(loggers)
+        # key -> [window start, events, last user_id, template record]
+        self._keys: Dict[str, list] = {}
+
+    def key(self, record: logging.LogRecord) -> Optional[str]:
+        key = getattr(record, "sample", None)
+        if key is None and record.name in self.loggers:
+            key = record.name
+        return key
+
+    def admit(self, key: str, record: logging.LogRecord) -> bool:
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = [record.created, 0, None, record]
+        state[1] += 1
+        state[2] = getattr(record, "user_id", None)
+        return state[1] <= self.first
+
+    def due(self, now: float, force: bool = False) -> List[logging.LogRecord]:
+        """Summary records for every window that has ended"""
+        summaries = []
+        for key, (started, events, last_user, template) in list(self._keys.items()):
+            if not force and now - started < self.window:
+                continue
+            del self._keys[key]
+            suppressed = events - self.first
+            if suppressed <= 0:
+                continue
+            summary = logging.makeLogRecord({
+                "name": template.name,
+                "levelno": template.levelno,
+                "levelname": template.levelname,
+                "msg": "%s: %d events in %ds, %d not logged individually (last user_id %s)",
+                "args": (key, events, round(now - started), suppressed, last_user),
+                "created": now,
+                "sample": key,
+                "sampled_events": events,
+                "update_id": None,
+                "user_id": None,
+            })
+            summaries.append(summary)
+        return summaries
+
+
+class _Listener(logging.handlers.QueueListener):
+    """QueueListener that also flushes sampling summaries while the queue is quiet"""
+
+    def __init__(self, log_queue: queue.SimpleQueue, handler: logging.Handler, sampler: _Sampler):
+        super().__init__(log_queue, handler, respect_handler_level=True)
+        self.sampler = sampler
+        self.lock = threading.Lock()
+
+    def dequeue(self, block: bool):
+        while True:
+            try:
+                return self.queue.get(timeout=1.0)
+            except queue.Empty:
+                self.flush_summaries()
+
+    def handle(self, record: logging.LogRecord):
+        key = self.sampler.key(record)
+        if key is not None and not self.sampler.admit(key, record):
+            return
+        super().handle(record)
+        self.flush_summaries()
+
+    def flush_summaries(self, force: bool = False):
+        for summary in self.sampler.due(time.time(), force):
+            super().handle(summary)
+
+    def stop(self):
+        super().stop()
+        self.flush_summaries(force=True)
+
+
+def setup_logging(level: Optional[str] = None):
+    """Route all logging through the queue; safe to call more than once"""
+    global _listener
+    if _listener is not None:
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _listener = _Listener(log_queue, handler, _Sampler(LOG_SAMPLE_WINDOW, LOG_SAMPLE_FIRST, LOG_SAMPLE_LOGGERS))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(_ContextQueueHandler(log_queue))
+    root.setLevel(level or LOG_LEVEL)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Write out everything still queued (and pending summaries), then stop the thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """Outer update middleware: binds update_id/user_id for the records of this update"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = UserContextMiddleware.resolve_event_context(event)
+        update_token = update_id_var.set(event.update_id)
+        user_token = user_id_var.set(context.user.id if context.user else None)
+        try:
+            return await handler(event, data)
+        finally:
+            update_id_var.reset(update_token)
+            user_id_var.reset(user_token)
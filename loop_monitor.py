@@ -0,0 +1,155 @@
+"""Event-loop lag monitor and blocking-call detector.
+
+A sampler task sleeps for `interval` seconds in a loop and records how late
+it wakes up: that delay is the event-loop lag every other coroutine saw.
+A watchdog thread checks the sampler's heartbeat; when the loop has not
+come back for longer than `threshold_ms`, it captures the stack of the
+loop thread at that moment — the code that is blocking it — logs it and
+keeps the last few in `stalls`. Their `blocked_ms` is filled in with the
+full duration once the loop comes back.
+
+`monitor` runs for the whole process (started by main.py, percentiles in
+the admin diagnostics and logged every LOOP_LAG_LOG_INTERVAL seconds).
+`no_blocking(max_ms)` is the test helper:
+
+    async with no_blocking(50):
+        await handler(message)
+
+raises AssertionError with the blocking stack if the body held the loop for
+more than max_ms.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL = getattr(config, "LOOP_LAG_INTERVAL", 0.1)
+LOOP_LAG_THRESHOLD_MS = getattr(config, "LOOP_LAG_THRESHOLD_MS", 100)
+LOOP_LAG_LOG_INTERVAL = getattr(config, "LOOP_LAG_LOG_INTERVAL", 300)
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold_ms: float = LOOP_LAG_THRESHOLD_MS,
+                 window: int = 3000, keep_stalls: int = 10):
+        self.interval = interval
+        self.threshold_ms = threshold_ms
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=keep_stalls)
+        self.stall_count = 0
+        self.max_lag_ms = 0.0
+        self._heartbeat = time.monotonic()
+        # stalls still waiting for the loop to come back, by the heartbeat they started after
+        self._open: Dict[float, Dict[str, Any]] = {}
+        self._resumed = (0.0, 0.0)
+        self._loop_thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    async def run(self, log_interval: Optional[float] = LOOP_LAG_LOG_INTERVAL):
+        """Sample lag until cancelled; log percentiles every log_interval seconds"""
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        last_log = time.monotonic()
+        try:
+            while True:
+                beat = self._heartbeat
+                started = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                lag_ms = max(0.0, (now - started - self.interval) * 1000)
+                # before the heartbeat moves, so the watchdog finds it if it reports late
+                self._resumed = (beat, lag_ms)
+                self._heartbeat = now
+                stall = self._open.pop(beat, None)
+                if stall is not None:
+                    self._close_stall(stall, lag_ms)
+                self.samples.append(lag_ms)
+                self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+                if log_interval and now - last_log >= log_interval:
+                    last_log = now
+                    p = self.percentiles()
+                    logger.info(
+                        "Event loop lag p50=%.1fms p95=%.1fms p99=%.1fms max=%.1fms, stalls %d",
+                        p["p50"], p["p95"], p["p99"], p["max"], self.stall_count,
+                    )
+        finally:
+            self._stop.set()
+
+    def _watch(self):
+        # runs in its own thread, so it sees the loop even while the loop is stuck
+        check = max(self.threshold_ms / 4000, 0.005)
+        limit = self.threshold_ms / 1000 + self.interval
+        reported = None
+        while not self._stop.wait(check):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat
+            if stalled < limit or reported == heartbeat:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            self.stall_count += 1
+            # so far; the sampler replaces it with the full duration when the loop comes back
+            stall = {"at": time.time(), "blocked_ms": round((stalled - self.interval) * 1000, 1), "stack": stack}
+            self._open[heartbeat] = stall
+            self.stalls.append(stall)
+            logger.warning(
+                "Event loop blocked for more than %.0fms, blocking stack:\n%s",
+                (stalled - self.interval) * 1000, stack,
+            )
+            if self._heartbeat != heartbeat and self._open.pop(heartbeat, None) is not None:
+                # the loop came back while the stack was being taken
+                beat, lag_ms = self._resumed
+                if beat == heartbeat:
+                    self._close_stall(stall, lag_ms)
+
+    def _close_stall(self, stall: Dict[str, Any], lag_ms: float):
+        stall["blocked_ms"] = round(lag_ms, 1)
+        logger.warning("Event loop was blocked for %.1fms", lag_ms)
+
+    def percentiles(self) -> Dict[str, float]:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+        def pick(q: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+        return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": round(self.max_lag_ms, 1)}
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.percentiles(), "samples": len(self.samples), "stalls": self.stall_count}
+
+
+monitor = LoopMonitor()
+
+
+@asynccontextmanager
+async def no_blocking(max_ms: float):
+    """Test helper: fail if the body blocks the event loop for more than max_ms"""
+    probe = LoopMonitor(interval=max(max_ms / 4000, 0.002), threshold_ms=max_ms)
+    task = asyncio.create_task(probe.run(log_interval=None))
+    await asyncio.sleep(0)
+    try:
+        yield probe
+    finally:
+        # one more tick so a block at the very end of the body is seen
+        await asyncio.sleep(probe.interval * 2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    if probe.stall_count:
+        stall: Dict[str, Any] = probe.stalls[-1]
+        raise AssertionError(
+            f"event loop blocked for {stall['blocked_ms']}ms (limit {max_ms}ms) at:\n{stall['stack']}"
+        )
@@ -1,86 +1,260 @@
+import time
+_STARTUP_T0 = time.perf_counter()
+
 import asyncio
 import logging
+import signal
+from contextlib import suppress
 from aiogram import Bot
-import database as db
+from repository import BACKEND_NAME, backend as db
 import config
-from admin_bot import dp as admin_dp, bot as admin_bot
-from user_bot import dp as user_dp, bot as user_bot, send_expiry_notification
+from admin_bot import dp as admin_dp, reconcile_channel_membership
+from user_bot import dp as user_dp, get_langs, send_expiry_notification
+from broadcasts import broadcast_loop
+import bots
+import channels
+from leader import election
+from log_pipeline import setup_logging
+from loop_monitor import monitor as loop_monitor
+from maintenance import maintenance_loop
+import performance
+from reminders import reminder_loop
+
+_IMPORTS_DONE = time.perf_counter()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
-PRIVATE_CHANNEL_ID = config.PRIVATE_CHANNEL_ID
 CHECK_INTERVAL = getattr(config, 'EXPIRY_CHECK_INTERVAL', 3600)
 
+# Startup phase durations in seconds; "*_ready" entries are measured from process start
+startup_timings = {}
+
+
+def log_startup_report():
+    """Log how long each startup phase took"""
+    total = max(startup_timings.values())
+    parts = ", ".join(f"{name}={value:.3f}s" for name, value in startup_timings.items())
+    logger.info("Startup report: %s (ready in %.3fs)", parts, total)
+
+
+def _ready_marker(name: str):
+    """Dispatcher startup hook: polling is about to fetch the first update"""
+    async def on_startup():
+        startup_timings[f"{name}_ready"] = time.perf_counter() - _STARTUP_T0
+        if "admin_ready" in startup_timings and "user_ready" in startup_timings:
+            log_startup_report()
+    return on_startup
+
 
 async def check_and_remove_expired_users():
-    """Check for expired subscriptions and remove users from channel"""
+    """Check for expired subscriptions and remove users from their channels"""
     while True:
         try:
-            check_interval = await db.get_shortest_active_subscription_seconds()
-            logger.info(f"Next expiry check in {check_interval} seconds")
+            # at most EXPIRY_CHECK_INTERVAL: subscriptions bought while sleeping may end sooner
+            check_interval = min(await db.get_shortest_active_subscription_seconds(), CHECK_INTERVAL)
+            logger.info("Next expiry check in %s seconds", check_interval)
             await asyncio.sleep(check_interval)
             
             logger.info("Checking for expired subscriptions...")
             
-            expired_user_ids = await db.deactivate_expired_subscriptions()
+            expired_user_ids = await db.deactivate_expired_subscriptions(fence=election.fence)
             
             if expired_user_ids:
-                logger.info(f"Found {len(expired_user_ids)} expired subscriptions")
-                
-                for user_id in expired_user_ids:
-                    try:
-                        await admin_bot.ban_chat_member(
-                            chat_id=PRIVATE_CHANNEL_ID,
-                            user_id=user_id
-                        )
-                        
-                        await admin_bot.unban_chat_member(
-                            chat_id=PRIVATE_CHANNEL_ID,
-                            user_id=user_id
+                logger.info("Found %d expired subscriptions", len(expired_user_ids))
+                # per-channel pools work in parallel; users are finished in order
+                async for user_id, errors in channels.remove_users(bots.admin(), expired_user_ids):
+                    for error in errors:
+                        logger.error(
+                            "Failed to remove user %s from channel %s", user_id, error,
+                            extra={"sample": "expiry_remove_failed", "user_id": user_id},
                         )
-                        
-                        await db.mark_user_removed_from_channel(user_id)
+                    try:
+                        if not errors:
+                            await db.mark_user_removed_from_channel(user_id)
                         
                         await send_expiry_notification(user_id)
                         
-                        logger.info(f"Removed user {user_id} from channel")
+                        logger.info(
+                            "Removed user %s from channels", user_id,
+                            extra={"sample": "expiry_removed", "user_id": user_id},
+                        )
                     except Exception as e:
-                        logger.error(f"Failed to remove user {user_id} from channel: {e}")
+                        logger.error(
+                            "Failed to finish expiry of user %s: %s", user_id, e,
+                            extra={"sample": "expiry_remove_failed", "user_id": user_id},
+                        )
             else:
                 logger.info("No expired subscriptions found")
                 
         except Exception as e:
-            logger.error(f"Error in expiry checker: {e}")
+            logger.error("Error in expiry checker: %s", e)
+
+
+async def reconcile_statistics_loop():
+    """Periodically rebuild statistics aggregates to correct any drift"""
+    interval = getattr(config, 'STATS_RECONCILE_INTERVAL', 6 * 3600)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await db.reconcile_statistics():
+                logger.warning("Statistics aggregates drifted and were rebuilt")
+            else:
+                logger.info("Statistics aggregates are consistent")
+        except Exception as e:
+            logger.error("Error reconciling statistics: %s", e)
+
+
+async def expire_stale_purchases_loop():
+    """Expire unanswered purchase requests and purge old resolved ones"""
+    ttl = getattr(config, 'PENDING_PURCHASE_TTL', 48 * 3600)
+    retention_days = getattr(config, 'PURCHASE_RETENTION_DAYS', 90)
+    while True:
+        try:
+            expired, purged = await db.expire_stale_purchases(ttl, retention_days)
+            if expired or purged:
+                logger.info("Purchase requests: %d expired, %d purged", expired, purged)
+        except Exception as e:
+            logger.error("Error expiring purchase requests: %s", e)
+        await asyncio.sleep(min(ttl, 3600))
+
+
+async def refresh_entitlements_loop():
+    """Reload the entitlement cache and channel grants to pick up writes from other processes"""
+    interval = getattr(config, 'ENTITLEMENT_REFRESH_INTERVAL', 300)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await channels.refresh()
+            await db.load_entitlements()
+        except Exception as e:
+            logger.error("Error refreshing entitlements: %s", e)
+
+
+async def reconcile_membership_loop():
+    """Low-priority verification of drifted channel membership rows"""
+    interval = getattr(config, 'MEMBERSHIP_RECONCILE_INTERVAL', 3600)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            checked = await reconcile_channel_membership()
+            if checked:
+                logger.info("Verified channel membership for %d users", checked)
+        except Exception as e:
+            logger.error("Error reconciling channel membership: %s", e)
+
+
+async def archive_users_loop():
+    """Move long-inactive users without a subscription to the archive tier"""
+    interval = getattr(config, 'USER_ARCHIVE_INTERVAL', 6 * 3600)
+    after_days = getattr(config, 'USER_ARCHIVE_AFTER_DAYS', 90)
+    batch_size = getattr(config, 'USER_ARCHIVE_BATCH', 1000)
+    while True:
+        try:
+            archived = await db.archive_inactive_users(after_days, batch_size)
+            if archived:
+                logger.info("Archived %d inactive users", archived)
+        except Exception as e:
+            logger.error("Error archiving inactive users: %s", e)
+        await asyncio.sleep(interval)
+
+
+async def stop_polling():
+    """Stop both dispatchers; one that is not polling (yet or any more) is skipped"""
+    for dp in (admin_dp, user_dp):
+        with suppress(RuntimeError):
+            await dp.stop_polling()
+
+
+def install_signal_handlers():
+    """SIGINT/SIGTERM stop both bots.
+
+    aiogram's own handlers (handle_signals=True) are per dispatcher, and the
+    second one registered replaces the first, so only one bot would stop.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = set()
+
+    def on_signal(sig: signal.Signals):
+        logger.info("Received %s, shutting down...", sig.name)
+        task = loop.create_task(stop_polling())
+        stopping.add(task)
+        task.add_done_callback(stopping.discard)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, on_signal, sig)
 
 
 async def main():
     """Main function to run both bots"""
+    startup_timings["import"] = _IMPORTS_DONE - _STARTUP_T0
+    runtime = performance.describe()
+    logger.info("Runtime: %s event loop, %s for Bot API JSON", runtime['loop'], runtime['json'])
+    db_started = time.perf_counter()
     await db.init_db()
-    await db.init_default_bot_config()
+    startup_timings["db_init"] = time.perf_counter() - db_started
     logger.info("Database initialized")
+    channel_count = await channels.refresh()
+    logger.info("Channels loaded: %d", channel_count)
+    entitled = await db.load_entitlements()
+    logger.info("Entitlement cache loaded: %d active subscribers", entitled)
+    # languages picked before they were stored in the database
+    synced = await db.sync_user_languages(list(get_langs().items()))
+    if synced:
+        logger.info("Synced %d user languages into the database", synced)
+
+    admin_dp.startup.register(_ready_marker("admin"))
+    user_dp.startup.register(_ready_marker("user"))
     
-    expiry_task = asyncio.create_task(check_and_remove_expired_users())
-    logger.info("Expiry checker started")
+    # singleton jobs run only on the instance holding the leader lease
+    leader_jobs = [
+        check_and_remove_expired_users, reconcile_statistics_loop, expire_stale_purchases_loop,
+        reconcile_membership_loop, reminder_loop, archive_users_loop, broadcast_loop,
+    ]
+    # backups and vacuum work on the SQLite file; PostgreSQL is maintained by the server
+    if BACKEND_NAME == "sqlite":
+        leader_jobs.append(maintenance_loop)
+    leader_task = asyncio.create_task(election.run(leader_jobs))
+    logger.info("Leader election started as %s", election.holder)
+
+    entitlements_task = asyncio.create_task(refresh_entitlements_loop())
+    loop_monitor_task = asyncio.create_task(loop_monitor.run())
     
-    admin_task = asyncio.create_task(admin_dp.start_polling(admin_bot))
+    install_signal_handlers()
+    # both bots share one HTTP session (bots.py), closed below rather than by each dispatcher
+    admin_task = asyncio.create_task(
+        admin_dp.start_polling(bots.admin(), close_bot_session=False, handle_signals=False)
+    )
     logger.info("Admin bot started")
     
-    user_task = asyncio.create_task(user_dp.start_polling(user_bot))
+    user_task = asyncio.create_task(
+        user_dp.start_polling(bots.user(), close_bot_session=False, handle_signals=False)
+    )
     logger.info("User bot started")
     
     logger.info("All systems running!")
     
-    await asyncio.gather(expiry_task, admin_task, user_task)
-
+    try:
+        # a signal stops both; if one bot stops on its own, the other follows
+        await asyncio.wait([admin_task, user_task], return_when=asyncio.FIRST_COMPLETED)
+        await stop_polling()
+        await asyncio.gather(admin_task, user_task)
+    finally:
+        # hand the lease over before the connections go away
+        background = [leader_task, entitlements_task, loop_monitor_task, admin_task, user_task]
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await bots.close()
+        await db.close_db()
 
 if __name__ == "__main__":
+    # uvloop (performance profile) has to be installed before the loop is created
+    performance.install_event_loop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     except Exception as e:
-        logger.error(f"Fatal error: {e}")
+        logger.error("Fatal error: %s", e)
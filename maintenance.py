@@ -0,0 +1,193 @@
+"""Online database maintenance: rotating backups, incremental vacuum, optimize.
+
+Backups use SQLite's backup API in steps of BACKUP_PAGES_PER_STEP pages and
+pause BACKUP_STEP_SLEEP seconds between steps, so the source is only locked
+for one short step at a time and bot writes get through in between. The copy
+runs on aiosqlite's worker thread, so the event loop never waits for it.
+Finished backups land in BACKUP_DIR (only the newest BACKUP_KEEP are kept).
+
+incremental_vacuum, optimize and a WAL checkpoint only run in idle windows: when no update has
+been handled for MAINTENANCE_IDLE_SECONDS. Vacuum frees pages in small
+chunks and stops as soon as updates arrive again.
+"""
+import asyncio
+import glob
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Any, Dict
+
+import aiosqlite
+
+import config
+import database as db
+import update_scheduler
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = getattr(config, "BACKUP_DIR", "backups")
+BACKUP_KEEP = getattr(config, "BACKUP_KEEP", 7)
+BACKUP_INTERVAL = getattr(config, "BACKUP_INTERVAL", 6 * 3600)
+BACKUP_PAGES_PER_STEP = getattr(config, "BACKUP_PAGES_PER_STEP", 256)
+BACKUP_STEP_SLEEP = getattr(config, "BACKUP_STEP_SLEEP", 0.02)
+MAINTENANCE_INTERVAL = getattr(config, "MAINTENANCE_INTERVAL", 3600)
+MAINTENANCE_IDLE_SECONDS = getattr(config, "MAINTENANCE_IDLE_SECONDS", 30)
+VACUUM_PAGES_PER_STEP = getattr(config, "VACUUM_PAGES_PER_STEP", 200)
+
+# Latest results, shown in the admin diagnostics
+last_report: Dict[str, Any] = {}
+
+
+def is_idle(quiet_seconds: float = MAINTENANCE_IDLE_SECONDS) -> bool:
+    """True when no bot has handled an update for quiet_seconds"""
+    return all(s.idle_seconds() >= quiet_seconds for s in update_scheduler.registry.values())
+
+
+def database_size() -> int:
+    """Main file plus WAL, in bytes"""
+    size = 0
+    for path in (db.DATABASE_FILE, db.DATABASE_FILE + "-wal"):
+        if os.path.exists(path):
+            size += os.path.getsize(path)
+    return size
+
+
+def _backup_files() -> list:
+    prefix = os.path.splitext(os.path.basename(db.DATABASE_FILE))[0]
+    return sorted(glob.glob(os.path.join(BACKUP_DIR, f"{prefix}-*.db")))
+
+
+def last_backup_age() -> float | None:
+    """Seconds since the newest backup file was written, None if there is none"""
+    files = _backup_files()
+    if not files:
+        return None
+    return time.time() - os.path.getmtime(files[-1])
+
+
+async def backup_database() -> Dict[str, Any]:
+    """Copy the live database into a new rotating backup file"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    prefix = os.path.splitext(os.path.basename(db.DATABASE_FILE))[0]
+    path = os.path.join(BACKUP_DIR, f"{prefix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    partial = path + ".part"
+    steps = 0
+
+    def progress(status, remaining, total):
+        # runs on the aiosqlite worker thread between steps: give writers a window
+        nonlocal steps
+        steps += 1
+        if remaining:
+            time.sleep(BACKUP_STEP_SLEEP)
+
+    started = time.perf_counter()
+    target = sqlite3.connect(partial, check_same_thread=False)
+    try:
+        async with aiosqlite.connect(db.DATABASE_FILE) as source:
+            await source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+    except Exception:
+        target.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    target.close()
+    os.replace(partial, path)
+    for old in _backup_files()[:-BACKUP_KEEP]:
+        os.remove(old)
+    report = {
+        "backup_at": datetime.now().isoformat(timespec="seconds"),
+        "backup_file": path,
+        "backup_seconds": round(time.perf_counter() - started, 3),
+        "backup_steps": steps,
+        "backup_bytes": os.path.getsize(path),
+        "db_bytes": database_size(),
+    }
+    last_report.update(report)
+    return report
+
+
+async def enable_incremental_vacuum() -> bool:
+    """Switch an existing database to auto_vacuum=INCREMENTAL (one full VACUUM).
+
+    New databases are created that way by init_db(); older ones need this
+    once, so it only runs in an idle window. Returns True if it ran.
+    """
+    async with aiosqlite.connect(db.DATABASE_FILE) as conn:
+        mode = (await (await conn.execute("PRAGMA auto_vacuum")).fetchone())[0]
+        if mode == 2:
+            return False
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await conn.execute("VACUUM")
+    return True
+
+
+async def incremental_vacuum() -> int:
+    """Return free pages to the filesystem in small chunks while idle"""
+    freed = 0
+    async with aiosqlite.connect(db.DATABASE_FILE) as conn:
+        mode = (await (await conn.execute("PRAGMA auto_vacuum")).fetchone())[0]
+        if mode != 2:
+            return 0
+        free = (await (await conn.execute("PRAGMA freelist_count")).fetchone())[0]
+        while free and is_idle():
+            # the pragma frees one page per VM step; executescript runs it to completion
+            await conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP});")
+            remaining = (await (await conn.execute("PRAGMA freelist_count")).fetchone())[0]
+            freed += free - remaining
+            free = remaining
+            await asyncio.sleep(0.05)
+    return freed
+
+
+async def optimize_database():
+    async with aiosqlite.connect(db.DATABASE_FILE) as conn:
+        await conn.execute("PRAGMA optimize")
+        # in WAL mode freed pages only leave the file once the WAL is checkpointed
+        await (await conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")).fetchall()
+
+
+async def run_idle_maintenance() -> Dict[str, Any]:
+    """Vacuum and optimize; callers check is_idle() first"""
+    started = time.perf_counter()
+    size_before = database_size()
+    if await enable_incremental_vacuum():
+        logger.info("Database switched to incremental auto-vacuum")
+    freed = await incremental_vacuum()
+    await optimize_database()
+    report = {
+        "maintenance_at": datetime.now().isoformat(timespec="seconds"),
+        "maintenance_seconds": round(time.perf_counter() - started, 3),
+        "vacuum_pages": freed,
+        "db_bytes_before": size_before,
+        "db_bytes": database_size(),
+    }
+    last_report.update(report)
+    return report
+
+
+async def maintenance_loop():
+    """Background task: periodic backups, plus vacuum/optimize when the bots are idle"""
+    await asyncio.sleep(MAINTENANCE_IDLE_SECONDS)
+    last_maintenance = 0.0
+    while True:
+        try:
+            age = last_backup_age()
+            if age is None or age >= BACKUP_INTERVAL:
+                report = await backup_database()
+                logger.info(
+                    "Backup %s: %s bytes in %ss (%s steps), database %s bytes",
+                    report['backup_file'], report['backup_bytes'], report['backup_seconds'],
+                    report['backup_steps'], report['db_bytes'],
+                )
+            if time.monotonic() - last_maintenance >= MAINTENANCE_INTERVAL and is_idle():
+                report = await run_idle_maintenance()
+                last_maintenance = time.monotonic()
+                logger.info(
+                    "Database maintenance: %s pages freed, %s -> %s bytes in %ss",
+                    report['vacuum_pages'], report['db_bytes_before'], report['db_bytes'], report['maintenance_seconds'],
+                )
+        except Exception as e:
+            logger.error("Error in database maintenance: %s", e)
+        await asyncio.sleep(min(60, MAINTENANCE_IDLE_SECONDS))
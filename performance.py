@@ -0,0 +1,187 @@
+"""Opt-in performance profile: uvloop event loop and orjson for Bot API JSON.
+
+With PERFORMANCE_PROFILE = True in config.py, main.py installs uvloop as the
+event loop policy before the loop starts, and bots.py gives the shared
+aiogram session orjson loads/dumps, so every getUpdates batch and every
+reply markup goes through orjson instead of the stdlib json module. Either
+package missing only turns its half off (with a warning); with the profile
+off nothing changes.
+
+Compare update-processing throughput with and without the profile:
+
+    python performance.py [--updates N] [--users N]
+
+Each profile runs in a fresh process: a dispatcher like the bots' polls
+fake_bot_api.py (running in a process of its own) and answers every update
+with a message and a keyboard. Besides updates per second it reports the
+bot process's CPU time per 1000 updates, which is what the profile saves
+when Telegram rather than the bot is the bottleneck.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+PERFORMANCE_PROFILE = getattr(config, "PERFORMANCE_PROFILE", False)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+def _orjson_dumps(value: Any) -> str:
+    # aiogram puts the result into form fields, which expect str
+    return orjson.dumps(value).decode()
+
+
+def install_event_loop(enabled: bool = PERFORMANCE_PROFILE) -> str:
+    """Make asyncio.run() use uvloop when enabled and installed; returns the loop name"""
+    if not enabled:
+        return "asyncio"
+    if uvloop is None:
+        logger.warning("Performance profile: uvloop is not installed, using the default event loop")
+        return "asyncio"
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
+
+
+def json_codecs(enabled: bool = PERFORMANCE_PROFILE) -> Tuple[Callable[..., Any], Callable[..., str]]:
+    """(loads, dumps) for the aiogram session"""
+    if enabled and orjson is not None:
+        return orjson.loads, _orjson_dumps
+    if enabled:
+        logger.warning("Performance profile: orjson is not installed, using the json module")
+    return json.loads, json.dumps
+
+
+def describe(enabled: bool = PERFORMANCE_PROFILE) -> Dict[str, str]:
+    """What the profile actually runs with, for the startup log and diagnostics"""
+    return {
+        "loop": "uvloop" if enabled and uvloop is not None else "asyncio",
+        "json": "orjson" if enabled and orjson is not None else "json",
+    }
+
+
+# ---- benchmark ----
+
+async def _bench(api_url: str, updates: int, users: int, enabled: bool) -> Dict[str, Any]:
+    import aiohttp
+    from aiogram import Bot, F, types
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+    from update_scheduler import OrderedDispatcher, UpdateScheduler
+
+    # a token of its own, so updates left over from another run are never seen
+    token = f"42:bench-{os.getpid()}"
+    async with aiohttp.ClientSession() as client:
+        for first in range(0, updates, 5000):
+            messages = [{"user_id": 1000 + i % users, "text": f"message {i}"} for i in range(first, min(first + 5000, updates))]
+            async with client.post(f"{api_url}/_fake/{token}/messages", json={"messages": messages}) as resp:
+                resp.raise_for_status()
+
+    loads, dumps = json_codecs(enabled)
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_url), json_loads=loads, json_dumps=dumps)
+    bot = Bot(token=token, session=session)
+    dp = OrderedDispatcher(scheduler=UpdateScheduler("bench", getattr(config, "UPDATE_CONCURRENCY", 64)))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"button {i}", callback_data=f"service_{i}")] for i in range(5)
+    ])
+    handled = 0
+    done = asyncio.Event()
+
+    @dp.message(F.text)
+    async def reply(message: types.Message):
+        nonlocal handled
+        await message.answer(message.text, reply_markup=keyboard)
+        handled += 1
+        if handled == updates:
+            done.set()
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    polling = asyncio.create_task(dp.start_polling(bot, polling_timeout=1, handle_signals=False))
+    await done.wait()
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+    await dp.stop_polling()
+    await polling
+    return {
+        **describe(enabled), "updates": updates, "seconds": round(elapsed, 3),
+        "per_second": round(updates / elapsed), "cpu_ms_per_1k": round(cpu / updates * 1e6),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def compare(updates: int, users: int):
+    """Run the benchmark without and with the profile, each in a fresh process.
+
+    The fake Bot API runs in a process of its own, so only the bot side is measured.
+    """
+    port = _free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen([sys.executable, os.path.join(here, "fake_bot_api.py"), "--port", str(port)], stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        results = []
+        for profile in ("off", "on"):
+            command = [
+                sys.executable, os.path.abspath(__file__), "--api", f"http://127.0.0.1:{port}",
+                "--updates", str(updates), "--users", str(users), "--profile", profile,
+            ]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        server.terminate()
+        server.wait()
+    for r in results:
+        print(
+            f"{r['loop']:>8} + {r['json']:<7} {r['updates']} updates in {r['seconds']:7.3f}s  "
+            f"{r['per_second']:>7} updates/s  bot CPU {r['cpu_ms_per_1k']:>5} ms per 1k updates"
+        )
+    off, on = results
+    # throughput is capped by the fake server; bot CPU per update is what the profile saves
+    print(f"throughput: {on['per_second'] / off['per_second']:.2f}x, bot CPU: {off['cpu_ms_per_1k'] / on['cpu_ms_per_1k']:.2f}x less")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update-processing throughput with and without the performance profile")
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--profile", choices=["on", "off"], help="run one profile in this process against --api")
+    parser.add_argument("--api", help="fake Bot API base URL")
+    args = parser.parse_args()
+    if args.profile:
+        enabled = args.profile == "on"
+        install_event_loop(enabled)
+        print(json.dumps(asyncio.run(_bench(args.api, args.updates, args.users, enabled))))
+    else:
+        compare(args.updates, args.users)
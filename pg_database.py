@@ -0,0 +1,1668 @@
+"""PostgreSQL backend (asyncpg) implementing the same API as database.py.
+
+Selected with DATABASE_BACKEND = "postgres" in config.py; several bot
+instances can share one database. Timestamps are kept as ISO-8601 text, as
+in the SQLite backend, so both return identical values. asyncpg prepares
+and caches every statement per pooled connection; bulk operations stage
+their rows with COPY (or unnest arrays) instead of row-by-row statements.
+"""
+import logging
+from datetime import datetime, timedelta
+
+import config
+import entitlements
+from database import (
+    ACTIVE_SEGMENTS,
+    BROADCAST_SEGMENTS,
+    BROADCAST_STATUSES,
+    CHANNEL_NON_MEMBER_STATUSES,
+    DEFAULT_LANGUAGE,
+    DEFAULT_BOT_CONFIG,
+    PURCHASE_STATUSES,
+    USER_COLUMNS,
+    duration_to_timedelta,
+    extend_subscription_end,
+)
+
+logger = logging.getLogger(__name__)
+
+DATABASE_DSN = getattr(config, "DATABASE_DSN", None)
+
+_pool = None
+_writes = 0
+_failed_writes = 0
+_schema_ready = False
+
+# users_archive upsert: every column but the key
+_ARCHIVE_UPDATE = ", ".join(f"{c} = EXCLUDED.{c}" for c in USER_COLUMNS.split(", ")[1:])
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        phone_number TEXT,
+        subscription_end TEXT,
+        is_active INTEGER DEFAULT 0,
+        photo_file_id TEXT,
+        added_to_channel INTEGER DEFAULT 0,
+        channel_member_removed INTEGER DEFAULT 0,
+        service_id INTEGER,
+        last_seen_at TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users_archive (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        phone_number TEXT,
+        subscription_end TEXT,
+        is_active INTEGER DEFAULT 0,
+        photo_file_id TEXT,
+        added_to_channel INTEGER DEFAULT 0,
+        channel_member_removed INTEGER DEFAULT 0,
+        service_id INTEGER,
+        last_seen_at TEXT,
+        archived_at TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS services (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        duration_days INTEGER NOT NULL,
+        price DOUBLE PRECISION NOT NULL,
+        duration_unit TEXT DEFAULT 'days'
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pending_purchases (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        username TEXT,
+        phone_number TEXT,
+        service_id INTEGER,
+        created_at TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        resolved_at TEXT
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS bot_settings (key TEXT PRIMARY KEY, value TEXT)",
+    """
+    CREATE TABLE IF NOT EXISTS channel_members (
+        chat_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        status TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        verified_at TEXT,
+        PRIMARY KEY (chat_id, user_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reminders (
+        user_id BIGINT NOT NULL,
+        offset_seconds INTEGER NOT NULL,
+        subscription_end TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, offset_seconds, subscription_end)
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS stats_counters (key TEXT PRIMARY KEY, value BIGINT NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS stats_expiry_by_day (day TEXT PRIMARY KEY, users BIGINT NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS stats_service_active (service_id INTEGER PRIMARY KEY, users BIGINT NOT NULL DEFAULT 0)",
+    """
+    CREATE TABLE IF NOT EXISTS stats_revenue_by_day (
+        day TEXT NOT NULL,
+        service_id INTEGER NOT NULL,
+        amount DOUBLE PRECISION NOT NULL DEFAULT 0,
+        purchases BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, service_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)",
+    "CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active)",
+    "CREATE INDEX IF NOT EXISTS idx_users_active_end ON users(is_active, subscription_end)",
+    "CREATE INDEX IF NOT EXISTS idx_users_inactive_seen ON users(last_seen_at) WHERE is_active = 0",
+    "CREATE INDEX IF NOT EXISTS idx_pending_purchases_user_status ON pending_purchases(user_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_pending_purchases_created ON pending_purchases(created_at)",
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_pending_purchases_open
+    ON pending_purchases(user_id, service_id) WHERE status = 'pending'
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pending_purchases_open_created ON pending_purchases(created_at) WHERE status = 'pending'",
+    "CREATE INDEX IF NOT EXISTS idx_channel_members_verified ON channel_members(chat_id, verified_at)",
+    "CREATE INDEX IF NOT EXISTS idx_reminders_status ON reminders(status, subscription_end)",
+    # statistics aggregates, kept current by triggers as in the SQLite backend
+    """
+    CREATE OR REPLACE FUNCTION stats_users_apply(r users, delta INTEGER) RETURNS void AS $$
+    BEGIN
+        UPDATE stats_counters SET value = value + delta
+            WHERE key = CASE WHEN r.is_active = 1 THEN 'active' ELSE 'inactive' END;
+        IF r.is_active = 1 AND r.subscription_end IS NOT NULL THEN
+            INSERT INTO stats_expiry_by_day (day, users) VALUES (substr(r.subscription_end, 1, 10), delta)
+            ON CONFLICT (day) DO UPDATE SET users = stats_expiry_by_day.users + delta;
+        END IF;
+        IF r.is_active = 1 AND r.service_id IS NOT NULL THEN
+            INSERT INTO stats_service_active (service_id, users) VALUES (r.service_id, delta)
+            ON CONFLICT (service_id) DO UPDATE SET users = stats_service_active.users + delta;
+        END IF;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION trg_users_stats() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' AND OLD.is_active IS NOT DISTINCT FROM NEW.is_active
+           AND OLD.subscription_end IS NOT DISTINCT FROM NEW.subscription_end
+           AND OLD.service_id IS NOT DISTINCT FROM NEW.service_id THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM stats_users_apply(OLD, -1);
+        END IF;
+        IF TG_OP IN ('UPDATE', 'INSERT') THEN
+            PERFORM stats_users_apply(NEW, 1);
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS trg_users_stats ON users",
+    """
+    CREATE TRIGGER trg_users_stats
+    AFTER INSERT OR DELETE OR UPDATE OF is_active, subscription_end, service_id ON users
+    FOR EACH ROW EXECUTE FUNCTION trg_users_stats()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION trg_users_archive_stats() RETURNS trigger AS $$
+    BEGIN
+        UPDATE stats_counters SET value = value + CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END
+            WHERE key = 'archived';
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS trg_users_archive_stats ON users_archive",
+    """
+    CREATE TRIGGER trg_users_archive_stats AFTER INSERT OR DELETE ON users_archive
+    FOR EACH ROW EXECUTE FUNCTION trg_users_archive_stats()
+    """,
+    """
+    INSERT INTO stats_counters (key, value)
+    VALUES ('active', 0), ('inactive', 0), ('archived', 0)
+    ON CONFLICT (key) DO NOTHING
+    """,
+]
+
+
+async def _migration_initial_schema(conn):
+    """v1: full schema (matches SQLite schema v8) and seed data"""
+    for statement in _SCHEMA:
+        await conn.execute(statement)
+    if not await conn.fetchval("SELECT COUNT(*) FROM services"):
+        await conn.execute(
+            "INSERT INTO services (name, duration_days, price, duration_unit) VALUES ($1, $2, $3, 'days')",
+            config.DEFAULT_SERVICE_NAME, config.DEFAULT_SERVICE_DURATION, config.DEFAULT_SERVICE_PRICE
+        )
+    await conn.executemany(
+        "INSERT INTO bot_settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
+        [(f"userbot_{key}", value) for key, value in DEFAULT_BOT_CONFIG.items()]
+    )
+
+
+async def _migration_leases(conn):
+    """v2: leases for leader election between bot instances"""
+    # expiry uses the server clock, so clock skew between nodes does not matter
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            token BIGINT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        )
+    """)
+
+
+async def _migration_broadcasts(conn):
+    """v3: user language, broadcast audience indexes and the broadcast schedule"""
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS language TEXT")
+    await conn.execute("ALTER TABLE users_archive ADD COLUMN IF NOT EXISTS language TEXT")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_language ON users(language, user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_service_active ON users(service_id, is_active, user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_never_purchased ON users(user_id) WHERE subscription_end IS NULL")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            segment TEXT NOT NULL,
+            segment_arg TEXT,
+            text TEXT,
+            source_chat_id BIGINT,
+            source_message_id BIGINT,
+            scheduled_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'scheduled',
+            created_by BIGINT,
+            created_at TEXT NOT NULL,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            sent BIGINT NOT NULL DEFAULT 0,
+            failed BIGINT NOT NULL DEFAULT 0,
+            finished_at TEXT
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status, scheduled_at)")
+
+
+async def _migration_channels(conn):
+    """v4: channels granted by services; default channels cover services without their own list"""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS channels (
+            chat_id BIGINT PRIMARY KEY,
+            title TEXT,
+            is_default INTEGER NOT NULL DEFAULT 0,
+            join_link TEXT,
+            added_at TEXT NOT NULL
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS service_channels (
+            service_id INTEGER NOT NULL REFERENCES services(id) ON DELETE CASCADE,
+            chat_id BIGINT NOT NULL REFERENCES channels(chat_id) ON DELETE CASCADE,
+            PRIMARY KEY (service_id, chat_id)
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_service_channels_chat ON service_channels(chat_id)")
+    if getattr(config, "PRIVATE_CHANNEL_ID", None) is not None:
+        # the configured channel becomes the default one and keeps its join link
+        await conn.execute(
+            """
+            INSERT INTO channels (chat_id, is_default, join_link, added_at)
+            VALUES ($1, 1, (SELECT value FROM bot_settings WHERE key = 'channel_join_link'), $2)
+            ON CONFLICT (chat_id) DO NOTHING
+            """,
+            int(config.PRIVATE_CHANNEL_ID), datetime.now().isoformat()
+        )
+
+
+async def _migration_payments(conn):
+    """v5: Telegram Payments, one row per charge so a redelivered payment is applied once"""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            telegram_payment_charge_id TEXT PRIMARY KEY,
+            provider_payment_charge_id TEXT,
+            user_id BIGINT NOT NULL,
+            service_id INTEGER,
+            currency TEXT NOT NULL,
+            total_amount BIGINT NOT NULL,
+            subscription_end TEXT,
+            created_at TEXT NOT NULL
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id)")
+
+
+async def _migration_archive_audience(conn):
+    """v6: indexes for broadcast audiences and exports that include users_archive"""
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_archive_language ON users_archive(language, user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_archive_end ON users_archive(subscription_end)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_archive_never_purchased ON users_archive(user_id) WHERE subscription_end IS NULL")
+
+
+# Ordered list of (version, migration). Never edit an applied migration —
+# append a new one instead.
+SCHEMA_MIGRATIONS = [
+    (1, _migration_initial_schema),
+    (2, _migration_leases),
+    (3, _migration_broadcasts),
+    (4, _migration_channels),
+    (5, _migration_payments),
+    (6, _migration_archive_audience),
+]
+
+
+def _rowcount(status: str) -> int:
+    """Row count from an asyncpg command tag such as 'UPDATE 3' or 'INSERT 0 5'"""
+    return int(status.rsplit(" ", 1)[-1])
+
+
+async def _get_pool():
+    global _pool
+    if _pool is None:
+        import asyncpg
+        _pool = await asyncpg.create_pool(
+            DATABASE_DSN,
+            min_size=getattr(config, "PG_POOL_MIN_SIZE", 2),
+            max_size=getattr(config, "PG_POOL_MAX_SIZE", 10),
+        )
+    return _pool
+
+
+async def _write(op):
+    """Run op(conn) in its own transaction; returns op's result after commit"""
+    global _writes, _failed_writes
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                result = await op(conn)
+        except Exception:
+            _failed_writes += 1
+            raise
+    _writes += 1
+    return result
+
+
+async def _fetch(query: str, *args):
+    pool = await _get_pool()
+    return await pool.fetch(query, *args)
+
+
+async def _fetchrow(query: str, *args):
+    pool = await _get_pool()
+    return await pool.fetchrow(query, *args)
+
+
+async def _fetchval(query: str, *args):
+    pool = await _get_pool()
+    return await pool.fetchval(query, *args)
+
+
+def write_stats() -> dict:
+    """Pool and write counters for diagnostics"""
+    return {
+        "committed": _writes,
+        "failed": _failed_writes,
+        "pool_size": _pool.get_size() if _pool is not None else 0,
+        "pool_idle": _pool.get_idle_size() if _pool is not None else 0,
+    }
+
+
+async def close_db():
+    """Close the connection pool"""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+async def get_schema_version(conn) -> int:
+    """Return the applied schema version (0 for a fresh database)"""
+    exists = await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not exists:
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+
+async def init_db():
+    """Bring the database schema up to date; a no-op when already current"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            # several instances may start at once: migrate one at a time
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    applied_at TEXT NOT NULL
+                )
+            """)
+            current = await get_schema_version(conn)
+            for version, migration in SCHEMA_MIGRATIONS:
+                if version <= current:
+                    continue
+                await migration(conn)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, applied_at) VALUES ($1, $2)",
+                    version, datetime.now().isoformat()
+                )
+                logger.info("Applied schema migration v%d", version)
+    _schema_ready = True
+
+
+async def add_service(name: str, duration_days: int, price: float, duration_unit: str = 'days'):
+    """Add a new service/plan; returns its id"""
+    return await _write(lambda conn: conn.fetchval(
+        "INSERT INTO services (name, duration_days, price, duration_unit) VALUES ($1, $2, $3, $4) RETURNING id",
+        name, duration_days, price, duration_unit
+    ))
+
+
+async def get_services():
+    """Get all available services"""
+    rows = await _fetch("SELECT id, name, duration_days, price, duration_unit FROM services ORDER BY id")
+    return [{"id": row[0], "name": row[1], "duration_days": row[2], "price": row[3], "duration_unit": row[4] or 'days'} for row in rows]
+
+
+async def update_service_price(service_id: int, new_price: float):
+    """Update service price"""
+    await _write(lambda conn: conn.execute("UPDATE services SET price = $1 WHERE id = $2", new_price, service_id))
+
+
+async def update_service_duration(service_id: int, new_duration: int, duration_unit: str = 'days'):
+    """Update service duration"""
+    await _write(lambda conn: conn.execute(
+        "UPDATE services SET duration_days = $1, duration_unit = $2 WHERE id = $3", new_duration, duration_unit, service_id
+    ))
+
+
+async def delete_service(service_id: int):
+    """Delete a service (its channel grants go with it)"""
+    await _write(lambda conn: conn.execute("DELETE FROM services WHERE id = $1", service_id))
+
+
+async def update_service_name(service_id: int, new_name: str):
+    """Update service name"""
+    await _write(lambda conn: conn.execute("UPDATE services SET name = $1 WHERE id = $2", new_name, service_id))
+
+
+async def add_pending_purchase(user_id: int, username: str, phone_number: str | None, service_id: int):
+    """Add a pending purchase for admin confirmation.
+
+    Only one open request per user and service is allowed: if one exists it is
+    returned instead. Returns (purchase_id, created).
+    """
+    async def op(conn):
+        purchase_id = await conn.fetchval(
+            """
+            INSERT INTO pending_purchases (user_id, username, phone_number, service_id, created_at, status)
+            VALUES ($1, $2, $3, $4, $5, 'pending')
+            ON CONFLICT (user_id, service_id) WHERE status = 'pending' DO NOTHING
+            RETURNING id
+            """,
+            user_id, username, phone_number, service_id, datetime.now().isoformat()
+        )
+        if purchase_id is not None:
+            return purchase_id, True
+        existing = await conn.fetchval(
+            "SELECT id FROM pending_purchases WHERE user_id = $1 AND service_id = $2 AND status = 'pending'",
+            user_id, service_id
+        )
+        return existing, False
+    return await _write(op)
+
+
+async def get_pending_purchase(purchase_id: int):
+    """Get purchase request details"""
+    row = await _fetchrow(
+        "SELECT user_id, username, phone_number, service_id, status, created_at FROM pending_purchases WHERE id = $1",
+        purchase_id
+    )
+    if row:
+        return {
+            "user_id": row[0],
+            "username": row[1],
+            "phone_number": row[2],
+            "service_id": row[3],
+            "status": row[4],
+            "created_at": row[5]
+        }
+    return None
+
+
+async def delete_pending_purchase(purchase_id: int):
+    """Delete a pending purchase"""
+    await _write(lambda conn: conn.execute("DELETE FROM pending_purchases WHERE id = $1", purchase_id))
+
+
+async def resolve_pending_purchase(purchase_id: int, status: str):
+    """Move a request out of 'pending' (approved/rejected/expired); False if it was already resolved"""
+    if status not in PURCHASE_STATUSES or status == 'pending':
+        raise ValueError(f"invalid purchase status: {status}")
+    resolved = await _write(lambda conn: conn.fetchval(
+        "UPDATE pending_purchases SET status = $1, resolved_at = $2 WHERE id = $3 AND status = 'pending' RETURNING id",
+        status, datetime.now().isoformat(), purchase_id
+    ))
+    return resolved is not None
+
+
+async def expire_stale_purchases(max_age_seconds: float, retention_days: int):
+    """Expire pending requests older than max_age and purge old expired/rejected rows.
+
+    Returns (expired, purged) row counts.
+    """
+    now = datetime.now()
+    cutoff = (now - timedelta(days=retention_days)).isoformat()
+
+    async def op(conn):
+        expired = await conn.execute(
+            "UPDATE pending_purchases SET status = 'expired', resolved_at = $1 WHERE status = 'pending' AND created_at < $2",
+            now.isoformat(), (now - timedelta(seconds=max_age_seconds)).isoformat()
+        )
+        purged = await conn.execute(
+            """
+            DELETE FROM pending_purchases
+            WHERE created_at < $1 AND resolved_at < $1 AND status IN ('expired', 'rejected')
+            """,
+            cutoff
+        )
+        return _rowcount(expired), _rowcount(purged)
+    return await _write(op)
+
+
+async def _restore_archived_users(conn, user_ids: list) -> int:
+    """Move users back from the archive into the hot table (inside a transaction)"""
+    if not user_ids:
+        return 0
+    status = await conn.execute(
+        f"""
+        WITH moved AS (
+            DELETE FROM users_archive WHERE user_id = ANY($1::bigint[])
+            RETURNING {USER_COLUMNS}
+        )
+        INSERT INTO users ({USER_COLUMNS}) SELECT {USER_COLUMNS} FROM moved
+        ON CONFLICT (user_id) DO NOTHING
+        """,
+        list(user_ids)
+    )
+    return _rowcount(status)
+
+
+async def _extend_subscription(conn, user_id: int, username: str | None, phone_number: str | None, duration_value: int, duration_unit: str = 'days', service_id: int | None = None) -> datetime:
+    """Single-statement activate/extend: the new end is computed from the row's
+    current value inside the upsert, so concurrent extensions never lose time"""
+    now = datetime.now()
+    delta = duration_to_timedelta(duration_value, duration_unit)
+    await _restore_archived_users(conn, [user_id])
+    end = await conn.fetchval(
+        """
+        INSERT INTO users (user_id, username, phone_number, subscription_end, is_active, service_id)
+        VALUES ($1, $2, $3, $4, 1, $5)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = COALESCE(EXCLUDED.username, users.username),
+            phone_number = COALESCE(EXCLUDED.phone_number, users.phone_number),
+            subscription_end = to_char(
+                GREATEST(COALESCE(users.subscription_end, ''), $6)::timestamp + $7::interval,
+                'YYYY-MM-DD"T"HH24:MI:SS.US'
+            ),
+            is_active = 1,
+            service_id = COALESCE(EXCLUDED.service_id, users.service_id)
+        RETURNING subscription_end
+        """,
+        user_id, username, phone_number, (now + delta).isoformat(), service_id, now.isoformat(), delta
+    )
+    return datetime.fromisoformat(end)
+
+
+async def activate_user_subscription(user_id: int, username: str, phone_number: str | None, duration_value: int, duration_unit: str = 'days', service_id: int | None = None):
+    """Activate or extend user subscription with flexible time units.
+
+    When service_id is given the purchase is counted as confirmed revenue.
+    """
+    async def op(conn):
+        new_end = await _extend_subscription(conn, user_id, username, phone_number, duration_value, duration_unit, service_id)
+        if service_id is not None:
+            await _record_revenue(conn, service_id)
+        return new_end
+    new_end = await _write(op)
+    entitlements.grant(user_id, new_end, service_id)
+    return new_end
+
+
+async def approve_purchases(purchase_ids: list):
+    """Approve pending requests and extend the subscriptions in one transaction.
+
+    The pending -> approved transition is a compare-and-set, so ids that are
+    already resolved are skipped and a repeated call is a no-op. Returns the
+    requests approved by this call.
+    """
+    if not purchase_ids:
+        return []
+
+    async def op(conn):
+        approved = []
+        services = {row[0]: row for row in await conn.fetch("SELECT id, name, duration_days, price, duration_unit FROM services")}
+        rows = await conn.fetch(
+            """
+            UPDATE pending_purchases SET status = 'approved', resolved_at = $1
+            WHERE status = 'pending'
+              AND id = ANY($2::bigint[])
+              AND service_id IN (SELECT id FROM services)
+            RETURNING id, user_id, username, phone_number, service_id
+            """,
+            datetime.now().isoformat(), list(purchase_ids)
+        )
+        for purchase_id, user_id, username, phone_number, service_id in rows:
+            _, name, duration, price, unit = services[service_id]
+            new_end = await _extend_subscription(conn, user_id, username, phone_number, duration, unit or 'days', service_id)
+            await _record_revenue(conn, service_id, price)
+            approved.append({
+                "purchase_id": purchase_id,
+                "user_id": user_id,
+                "username": username,
+                "service_id": service_id,
+                "service_name": name,
+                "subscription_end": new_end
+            })
+        return approved
+
+    approved = await _write(op)
+    for item in approved:
+        entitlements.grant(item["user_id"], item["subscription_end"], item["service_id"])
+    return approved
+
+
+async def record_payment(charge_id: str, provider_charge_id: str | None, user_id: int, username: str | None,
+                         service_id: int | None, currency: str, total_amount: int):
+    """Store a successful payment and extend the subscription in one transaction.
+
+    The Telegram charge id is the key, so a redelivered payment is a no-op and
+    returns None. Otherwise returns the user, service and new subscription end
+    (None when the service no longer exists and access must be granted by hand).
+    """
+    async def op(conn):
+        status = await conn.execute(
+            """
+            INSERT INTO payments
+                (telegram_payment_charge_id, provider_payment_charge_id, user_id, service_id, currency, total_amount, created_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT (telegram_payment_charge_id) DO NOTHING
+            """,
+            charge_id, provider_charge_id, user_id, service_id, currency, total_amount, datetime.now().isoformat()
+        )
+        if _rowcount(status) == 0:
+            return None
+        service = await conn.fetchrow("SELECT name, duration_days, price, duration_unit FROM services WHERE id = $1", service_id)
+        if service is None:
+            return {"user_id": user_id, "service_id": service_id, "service_name": None, "subscription_end": None}
+        name, duration, price, unit = service
+        new_end = await _extend_subscription(conn, user_id, username, None, duration, unit or 'days', service_id)
+        await _record_revenue(conn, service_id, price)
+        await conn.execute(
+            "UPDATE payments SET subscription_end = $1 WHERE telegram_payment_charge_id = $2",
+            new_end.isoformat(), charge_id
+        )
+        return {"user_id": user_id, "service_id": service_id, "service_name": name, "subscription_end": new_end}
+
+    payment = await _write(op)
+    if payment and payment["subscription_end"] is not None:
+        entitlements.grant(user_id, payment["subscription_end"], service_id)
+    return payment
+
+
+async def reject_purchase(purchase_id: int):
+    """Reject a pending request; returns its user_id, or None if already resolved"""
+    return await _write(lambda conn: conn.fetchval(
+        "UPDATE pending_purchases SET status = 'rejected', resolved_at = $1 WHERE id = $2 AND status = 'pending' RETURNING user_id",
+        datetime.now().isoformat(), purchase_id
+    ))
+
+
+async def get_pending_purchases_page(offset: int = 0, limit: int = 10):
+    """Oldest-first page of open purchase requests with service details"""
+    rows = await _fetch(
+        """
+        SELECT p.id, p.user_id, p.username, p.created_at, s.name, s.price
+        FROM pending_purchases p
+        LEFT JOIN services s ON s.id = p.service_id
+        WHERE p.status = 'pending'
+        ORDER BY p.created_at
+        LIMIT $1 OFFSET $2
+        """,
+        limit, offset
+    )
+    return [
+        {
+            "id": row[0],
+            "user_id": row[1],
+            "username": row[2],
+            "created_at": row[3],
+            "service_name": row[4],
+            "price": row[5]
+        }
+        for row in rows
+    ]
+
+
+async def count_pending_purchases() -> int:
+    """Number of open purchase requests"""
+    return await _fetchval("SELECT COUNT(*) FROM pending_purchases WHERE status = 'pending'")
+
+
+async def get_user_subscription(user_id: int):
+    """Get user subscription status"""
+    row = await _fetchrow("SELECT subscription_end, is_active FROM users WHERE user_id = $1", user_id)
+    if row:
+        return {
+            "subscription_end": row[0],
+            "is_active": row[1]
+        }
+    return None
+
+
+async def get_all_users():
+    """Get all users with their subscription status, archived ones included"""
+    rows = await _fetch(
+        """
+        SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id FROM users
+        UNION ALL
+        SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id FROM users_archive
+        """
+    )
+    return [
+        {
+            "user_id": row[0],
+            "username": row[1],
+            "phone_number": row[2],
+            "subscription_end": row[3],
+            "is_active": row[4],
+            "photo_file_id": row[5]
+        }
+        for row in rows
+    ]
+
+
+async def deactivate_expired_subscriptions(fence: tuple | None = None):
+    """Deactivate expired subscriptions and return list of expired user IDs.
+
+    fence=(lease_name, token): do nothing unless that lease token is still current.
+    """
+    async def op(conn):
+        if fence and not await _holds_lease(conn, *fence):
+            return []
+        return await conn.fetch(
+            "UPDATE users SET is_active = 0 WHERE subscription_end < $1 AND is_active = 1 RETURNING user_id",
+            datetime.now().isoformat()
+        )
+    rows = await _write(op)
+    expired_users = [row[0] for row in rows]
+    for user_id in expired_users:
+        entitlements.revoke(user_id)
+    return expired_users
+
+
+async def deactivate_user_subscription(user_id: int):
+    """Deactivate a single user's subscription (user-initiated cancel)"""
+    await _write(lambda conn: conn.execute("UPDATE users SET is_active = 0 WHERE user_id = $1", user_id))
+    entitlements.revoke(user_id)
+
+
+async def load_entitlements():
+    """Reload the in-memory entitlement cache from active subscriptions"""
+    rows = await _fetch("SELECT user_id, subscription_end, service_id FROM users WHERE is_active = 1")
+    entitlements.replace_all((row[0], row[1], row[2]) for row in rows)
+    return entitlements.count()
+
+
+async def load_user_entitlement(user_id: int) -> bool:
+    """Refresh one user's cache entry from the database; True if they have an active subscription"""
+    row = await _fetchrow("SELECT subscription_end, service_id FROM users WHERE user_id = $1 AND is_active = 1", user_id)
+    if not row or not row[0]:
+        entitlements.revoke(user_id)
+        return False
+    entitlements.grant(user_id, datetime.fromisoformat(row[0]), row[1])
+    return True
+
+
+async def get_service_by_id(service_id: int):
+    """Get service by ID"""
+    row = await _fetchrow("SELECT id, name, duration_days, price, duration_unit FROM services WHERE id = $1", service_id)
+    if row:
+        return {
+            "id": row[0],
+            "name": row[1],
+            "duration_days": row[2],
+            "price": row[3],
+            "duration_unit": row[4] or 'days'
+        }
+    return None
+
+
+async def upsert_user_profile(user_id: int, username: str | None, phone_number: str | None, photo_file_id: str | None):
+    """Create or update user profile fields and mark the user as seen"""
+    async def op(conn):
+        await _restore_archived_users(conn, [user_id])
+        await conn.execute(
+            """
+            INSERT INTO users (user_id, username, phone_number, subscription_end, is_active, photo_file_id, last_seen_at)
+            VALUES ($1, $2, $3, NULL, 0, $4, $5)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = COALESCE(EXCLUDED.username, users.username),
+                phone_number = COALESCE(EXCLUDED.phone_number, users.phone_number),
+                photo_file_id = COALESCE(EXCLUDED.photo_file_id, users.photo_file_id),
+                last_seen_at = EXCLUDED.last_seen_at
+            """,
+            user_id, username, phone_number, photo_file_id, datetime.now().isoformat()
+        )
+    await _write(op)
+
+
+async def get_user(user_id: int):
+    """Get single user by id, restoring them from the archive if needed"""
+    query = "SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id, added_to_channel FROM users WHERE user_id = $1"
+    row = await _fetchrow(query, user_id)
+    if not row and await _fetchval("SELECT 1 FROM users_archive WHERE user_id = $1", user_id):
+        async def restore(conn):
+            if await _restore_archived_users(conn, [user_id]):
+                return await conn.fetchrow(query, user_id)
+        row = await _write(restore)
+    if not row:
+        return None
+    return {
+        "user_id": row[0],
+        "username": row[1],
+        "phone_number": row[2],
+        "subscription_end": row[3],
+        "is_active": row[4],
+        "photo_file_id": row[5],
+        "added_to_channel": row[6]
+    }
+
+
+def _users_listing_source(include_archived: bool) -> str:
+    """FROM clause for admin listings: the hot tier, optionally with the archive"""
+    columns = "user_id, username, phone_number, subscription_end, is_active, photo_file_id"
+    if not include_archived:
+        return f"(SELECT {columns}, 0 AS archived FROM users) AS listing"
+    return f"""(
+        SELECT {columns}, 0 AS archived FROM users
+        UNION ALL
+        SELECT {columns}, 1 AS archived FROM users_archive
+    ) AS listing"""
+
+
+def _listing_row(row) -> dict:
+    return {
+        "user_id": row[0],
+        "username": row[1],
+        "phone_number": row[2],
+        "subscription_end": row[3],
+        "is_active": row[4],
+        "photo_file_id": row[5],
+        "archived": row[6]
+    }
+
+
+async def search_users_by_username(query: str, offset: int = 0, limit: int = 20, include_archived: bool = False):
+    """Search users by username (case-insensitive, contains) with pagination"""
+    rows = await _fetch(
+        f"""
+        SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id, archived
+        FROM {_users_listing_source(include_archived)}
+        WHERE LOWER(COALESCE(username, '')) LIKE $1
+        ORDER BY username IS NULL, username
+        LIMIT $2 OFFSET $3
+        """,
+        f"%{query.lower()}%", limit, offset
+    )
+    return [_listing_row(row) for row in rows]
+
+
+async def get_users_paginated(offset: int = 0, limit: int = 20, include_archived: bool = False):
+    """Get users with pagination (alphabetical by username)"""
+    rows = await _fetch(
+        f"""
+        SELECT user_id, username, phone_number, subscription_end, is_active, photo_file_id, archived
+        FROM {_users_listing_source(include_archived)}
+        ORDER BY username IS NULL, username
+        LIMIT $1 OFFSET $2
+        """,
+        limit, offset
+    )
+    return [_listing_row(row) for row in rows]
+
+
+async def archive_inactive_users(inactive_days: int, batch_size: int = 1000) -> int:
+    """Move users with no subscription and no activity for inactive_days into
+    users_archive, one short transaction per batch. Users with an open
+    purchase request stay hot. Returns the number of archived users.
+    """
+    now = datetime.now().isoformat()
+    cutoff = (datetime.now() - timedelta(days=inactive_days)).isoformat()
+    archived = 0
+
+    async def op(conn):
+        status = await conn.execute(
+            f"""
+            WITH picked AS (
+                SELECT user_id FROM users u
+                WHERE is_active = 0
+                  AND (last_seen_at < $1 OR last_seen_at IS NULL)
+                  AND (subscription_end IS NULL OR subscription_end < $1)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM pending_purchases p WHERE p.user_id = u.user_id AND p.status = 'pending'
+                  )
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            ), moved AS (
+                DELETE FROM users WHERE user_id IN (SELECT user_id FROM picked)
+                RETURNING {USER_COLUMNS}
+            )
+            INSERT INTO users_archive ({USER_COLUMNS}, archived_at)
+            SELECT {USER_COLUMNS}, $3 FROM moved
+            ON CONFLICT (user_id) DO UPDATE SET {_ARCHIVE_UPDATE}, archived_at = EXCLUDED.archived_at
+            """,
+            cutoff, batch_size, now
+        )
+        return _rowcount(status)
+
+    while True:
+        moved = await _write(op)
+        archived += moved
+        if moved < batch_size:
+            return archived
+
+
+async def mark_user_added_to_channel(user_id: int):
+    """Mark user as added to channel"""
+    await _write(lambda conn: conn.execute(
+        "UPDATE users SET added_to_channel = 1, channel_member_removed = 0 WHERE user_id = $1", user_id
+    ))
+
+
+async def mark_user_removed_from_channel(user_id: int):
+    """Mark user as removed from channel"""
+    await _write(lambda conn: conn.execute("UPDATE users SET channel_member_removed = 1 WHERE user_id = $1", user_id))
+
+
+async def get_bot_setting(key: str, default: str = None):
+    """Get bot setting value"""
+    row = await _fetchrow("SELECT value FROM bot_settings WHERE key = $1", key)
+    return row[0] if row else default
+
+
+async def set_bot_setting(key: str, value: str):
+    """Set bot setting value"""
+    await _write(lambda conn: conn.execute(
+        "INSERT INTO bot_settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+        key, value
+    ))
+
+
+async def get_shortest_active_subscription_seconds():
+    """Get the time in seconds until the next subscription expires"""
+    now = datetime.now()
+    end = await _fetchval(
+        "SELECT subscription_end FROM users WHERE is_active = 1 AND subscription_end > $1 ORDER BY subscription_end ASC LIMIT 1",
+        now.isoformat()
+    )
+    if end:
+        seconds_until_expiry = (datetime.fromisoformat(end) - now).total_seconds()
+        return max(30, min(seconds_until_expiry, 3600))
+    return 3600
+
+
+async def get_bot_config(key: str, default: str = None):
+    """Get user bot configuration value"""
+    return await get_bot_setting(f"userbot_{key}", default)
+
+
+async def set_bot_config(key: str, value: str):
+    """Set user bot configuration value"""
+    await set_bot_setting(f"userbot_{key}", value)
+
+
+async def init_default_bot_config():
+    """Initialize default bot configuration (missing keys only)"""
+    await _write(lambda conn: conn.executemany(
+        "INSERT INTO bot_settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
+        [(f"userbot_{key}", value) for key, value in DEFAULT_BOT_CONFIG.items()]
+    ))
+
+
+async def bulk_update_subscriptions(extensions: list, deactivations: list):
+    """Apply many subscription changes in a single transaction.
+
+    extensions: list of (user_id, duration_value, duration_unit); repeated
+    user_ids are applied cumulatively. deactivations: list of user_ids.
+    The new ends are loaded into a temporary table with COPY and applied in
+    one statement. Returns {user_id: new_end} for the extended users.
+    """
+    async def op(conn):
+        new_ends = {}
+        ext_ids = list({row[0] for row in extensions})
+        await _restore_archived_users(conn, ext_ids)
+        rows = await conn.fetch(
+            "SELECT user_id, subscription_end FROM users WHERE user_id = ANY($1::bigint[]) FOR UPDATE",
+            ext_ids
+        )
+        current = {row[0]: row[1] for row in rows}
+        for user_id, duration_value, duration_unit in extensions:
+            end = new_ends[user_id].isoformat() if user_id in new_ends else current.get(user_id)
+            new_ends[user_id] = extend_subscription_end(end, duration_value, duration_unit)
+
+        if new_ends:
+            await conn.execute("CREATE TEMP TABLE bulk_extensions (user_id BIGINT, subscription_end TEXT) ON COMMIT DROP")
+            await conn.copy_records_to_table(
+                "bulk_extensions",
+                records=[(user_id, end.isoformat()) for user_id, end in new_ends.items()]
+            )
+            await conn.execute(
+                """
+                INSERT INTO users (user_id, subscription_end, is_active)
+                SELECT user_id, subscription_end, 1 FROM bulk_extensions
+                ON CONFLICT (user_id) DO UPDATE SET
+                    subscription_end = EXCLUDED.subscription_end,
+                    is_active = 1
+                """
+            )
+        if deactivations:
+            await conn.execute("UPDATE users SET is_active = 0 WHERE user_id = ANY($1::bigint[])", list(deactivations))
+        return new_ends
+
+    new_ends = await _write(op)
+    for user_id, end in new_ends.items():
+        entitlements.grant(user_id, end)
+    for user_id in deactivations:
+        entitlements.revoke(user_id)
+    return new_ends
+
+
+async def mark_users_removed_from_channel(user_ids: list):
+    """Mark many users as removed from channel in one transaction"""
+    await _write(lambda conn: conn.execute(
+        "UPDATE users SET channel_member_removed = 1 WHERE user_id = ANY($1::bigint[])", list(user_ids)
+    ))
+
+
+async def iter_users_export(active_only: bool = False, expiring_within_days: int | None = None,
+                            language: str | None = None, chunk_size: int = 1000):
+    """Yield users joined with their latest purchase, chunk by chunk.
+
+    Uses keyset pagination on user_id; a pooled connection is borrowed per
+    chunk only, so a slow consumer never pins a connection. Without an
+    active/expiring filter archived users are exported too.
+    """
+    conditions = ["user_id > $1"]
+    params = []
+    if active_only:
+        conditions.append("is_active = 1")
+    if expiring_within_days is not None:
+        now = datetime.now()
+        conditions.append(f"is_active = 1 AND subscription_end BETWEEN ${len(params) + 3} AND ${len(params) + 4}")
+        params += [now.isoformat(), (now + timedelta(days=expiring_within_days)).isoformat()]
+    if language is not None:
+        where, language_params = _segment_filter('language', language, first=len(params) + 3)
+        conditions.append(where)
+        params += language_params
+    tables = ('users',) if active_only or expiring_within_days is not None else ('users', 'users_archive')
+    # each tier yields its own next chunk from an index, the merge keeps the first chunk_size
+    source = " UNION ALL ".join(
+        f"""(
+            SELECT user_id, username, phone_number, subscription_end, is_active, added_to_channel, language
+            FROM {table} WHERE {" AND ".join(conditions)} ORDER BY user_id LIMIT $2
+        )"""
+        for table in tables
+    )
+    query = f"""
+        SELECT u.user_id, u.username, u.phone_number, u.subscription_end, u.is_active,
+               u.added_to_channel,
+               (SELECT COUNT(*) FROM pending_purchases p WHERE p.user_id = u.user_id AND p.status = 'approved'),
+               lp.created_at, lp.status, s.name, s.price, u.language
+        FROM ({source}) AS u
+        LEFT JOIN pending_purchases lp
+            ON lp.id = (SELECT MAX(p.id) FROM pending_purchases p WHERE p.user_id = u.user_id)
+        LEFT JOIN services s ON s.id = lp.service_id
+        ORDER BY u.user_id
+        LIMIT $2
+    """
+    last_id = -1
+    while True:
+        rows = await _fetch(query, last_id, chunk_size, *params)
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [
+            {
+                "user_id": row[0],
+                "username": row[1],
+                "phone_number": row[2],
+                "subscription_end": row[3],
+                "is_active": row[4],
+                "added_to_channel": row[5],
+                "purchases": row[6],
+                "last_purchase_at": row[7],
+                "last_purchase_status": row[8],
+                "last_service": row[9],
+                "last_service_price": row[10],
+                "language": row[11] or ""
+            }
+            for row in rows
+        ]
+        if len(rows) < chunk_size:
+            return
+
+
+async def _record_revenue(conn, service_id: int, amount: float | None = None):
+    """Add one confirmed purchase of a service to today's revenue aggregate"""
+    if amount is None:
+        amount = await conn.fetchval("SELECT price FROM services WHERE id = $1", service_id) or 0
+    await conn.execute(
+        """
+        INSERT INTO stats_revenue_by_day (day, service_id, amount, purchases)
+        VALUES ($1, $2, $3, 1)
+        ON CONFLICT (day, service_id) DO UPDATE SET
+            amount = stats_revenue_by_day.amount + EXCLUDED.amount,
+            purchases = stats_revenue_by_day.purchases + 1
+        """,
+        datetime.now().date().isoformat(), service_id, amount
+    )
+
+
+async def _rebuild_user_statistics(conn):
+    """Recompute the users-derived aggregates from scratch (inside a transaction)"""
+    await conn.execute("DELETE FROM stats_counters")
+    await conn.execute("""
+        INSERT INTO stats_counters (key, value)
+        SELECT 'active', COUNT(*) FROM users WHERE is_active = 1
+        UNION ALL
+        SELECT 'inactive', COUNT(*) FROM users WHERE is_active IS DISTINCT FROM 1
+        UNION ALL
+        SELECT 'archived', COUNT(*) FROM users_archive
+    """)
+    await conn.execute("DELETE FROM stats_expiry_by_day")
+    await conn.execute("""
+        INSERT INTO stats_expiry_by_day (day, users)
+        SELECT substr(subscription_end, 1, 10), COUNT(*) FROM users
+        WHERE is_active = 1 AND subscription_end IS NOT NULL
+        GROUP BY 1
+    """)
+    await conn.execute("DELETE FROM stats_service_active")
+    await conn.execute("""
+        INSERT INTO stats_service_active (service_id, users)
+        SELECT service_id, COUNT(*) FROM users
+        WHERE is_active = 1 AND service_id IS NOT NULL
+        GROUP BY service_id
+    """)
+
+
+async def _snapshot_user_statistics(conn):
+    counters = await conn.fetch("SELECT key, value FROM stats_counters ORDER BY key")
+    expiry = await conn.fetch("SELECT day, users FROM stats_expiry_by_day WHERE users != 0 ORDER BY day")
+    services = await conn.fetch("SELECT service_id, users FROM stats_service_active WHERE users != 0 ORDER BY service_id")
+    return [tuple(r) for r in counters], [tuple(r) for r in expiry], [tuple(r) for r in services]
+
+
+async def reconcile_statistics():
+    """Rebuild users-derived aggregates to correct drift; returns True if drift was found"""
+    async def op(conn):
+        # writers wait for the rebuild instead of racing it
+        await conn.execute("LOCK TABLE users, users_archive IN SHARE MODE")
+        before = await _snapshot_user_statistics(conn)
+        await _rebuild_user_statistics(conn)
+        after = await _snapshot_user_statistics(conn)
+        await conn.execute(
+            "DELETE FROM stats_expiry_by_day WHERE users <= 0 AND day < $1",
+            datetime.now().date().isoformat()
+        )
+        return before != after
+    return await _write(op)
+
+
+async def get_statistics(expiry_days: int = 7, revenue_days: int = 30):
+    """Read the admin statistics from the aggregate tables (no scans of users)"""
+    today = datetime.now().date()
+    counters = {row[0]: row[1] for row in await _fetch("SELECT key, value FROM stats_counters")}
+    by_service = [
+        {"service_id": row[0], "name": row[1], "users": row[2]}
+        for row in await _fetch(
+            """
+            SELECT a.service_id, s.name, a.users FROM stats_service_active a
+            LEFT JOIN services s ON s.id = a.service_id
+            WHERE a.users > 0 ORDER BY a.users DESC
+            """
+        )
+    ]
+    expiry = [
+        {"day": row[0], "users": row[1]}
+        for row in await _fetch(
+            "SELECT day, users FROM stats_expiry_by_day WHERE day BETWEEN $1 AND $2 AND users > 0 ORDER BY day",
+            today.isoformat(), (today + timedelta(days=expiry_days - 1)).isoformat()
+        )
+    ]
+    revenue = [
+        {"day": row[0], "service_id": row[1], "name": row[2], "amount": row[3], "purchases": row[4]}
+        for row in await _fetch(
+            """
+            SELECT r.day, r.service_id, s.name, r.amount, r.purchases FROM stats_revenue_by_day r
+            LEFT JOIN services s ON s.id = r.service_id
+            WHERE r.day >= $1 ORDER BY r.day DESC
+            """,
+            (today - timedelta(days=revenue_days - 1)).isoformat()
+        )
+    ]
+    return {
+        "active": counters.get("active", 0),
+        "inactive": counters.get("inactive", 0),
+        "archived": counters.get("archived", 0),
+        "by_service": by_service,
+        "expiry_by_day": expiry,
+        "revenue": revenue,
+    }
+
+
+async def set_channel_member_statuses(chat_id: int, statuses: list, verified: bool = False):
+    """Record channel membership for [(user_id, status)] and sync the users flags"""
+    now = datetime.now().isoformat()
+    verified_at = now if verified else None
+    # one row per user: ON CONFLICT cannot touch the same row twice
+    latest = dict(statuses)
+    user_ids, states = list(latest.keys()), list(latest.values())
+
+    async def op(conn):
+        await conn.execute(
+            """
+            INSERT INTO channel_members (chat_id, user_id, status, updated_at, verified_at)
+            SELECT $1, t.user_id, t.status, $4, $5 FROM unnest($2::bigint[], $3::text[]) AS t(user_id, status)
+            ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                status = EXCLUDED.status,
+                updated_at = EXCLUDED.updated_at,
+                verified_at = COALESCE(EXCLUDED.verified_at, channel_members.verified_at)
+            """,
+            chat_id, user_ids, states, now, verified_at
+        )
+        await conn.execute(
+            """
+            UPDATE users u SET
+                added_to_channel = CASE WHEN t.status = ANY($3::text[]) THEN u.added_to_channel ELSE 1 END,
+                channel_member_removed = CASE WHEN t.status = ANY($3::text[]) THEN 1 ELSE 0 END
+            FROM unnest($1::bigint[], $2::text[]) AS t(user_id, status)
+            WHERE u.user_id = t.user_id
+            """,
+            user_ids, states, list(CHANNEL_NON_MEMBER_STATUSES)
+        )
+    await _write(op)
+
+
+async def get_known_non_members(chat_id: int, user_ids: list) -> set:
+    """Subset of user_ids known to be outside the channel (unknown users are not included)"""
+    if not user_ids:
+        return set()
+    rows = await _fetch(
+        """
+        SELECT user_id FROM channel_members
+        WHERE chat_id = $1 AND status IN ('left', 'kicked') AND user_id = ANY($2::bigint[])
+        """,
+        chat_id, list(user_ids)
+    )
+    return {row[0] for row in rows}
+
+
+async def get_membership_drift(chat_id: int, stale_after_days: int = 7, limit: int = 200):
+    """Membership rows worth re-checking with get_chat_member: never verified,
+    verified long ago, or members without an active subscription"""
+    stale = (datetime.now() - timedelta(days=stale_after_days)).isoformat()
+    rows = await _fetch(
+        """
+        SELECT m.user_id, m.status FROM channel_members m
+        LEFT JOIN users u ON u.user_id = m.user_id
+        WHERE m.chat_id = $1
+          AND (m.verified_at IS NULL OR m.verified_at < $2
+               OR (m.status = 'member' AND COALESCE(u.is_active, 0) = 0))
+        ORDER BY m.verified_at IS NOT NULL, m.verified_at
+        LIMIT $3
+        """,
+        chat_id, stale, limit
+    )
+    return [{"user_id": row[0], "status": row[1]} for row in rows]
+
+
+async def claim_due_reminders(offset_seconds: int, next_offset_seconds: int, limit: int = 500, fence: tuple | None = None):
+    """Claim up to `limit` users whose subscription_end entered the reminder
+    window (now + next_offset, now + offset].
+
+    Same keyset watermark as the SQLite backend; the watermark row is locked
+    for the transaction, so instances sharing the database never claim the
+    same users. With fence=(lease_name, token) nothing is claimed unless the
+    token is current.
+    """
+    now = datetime.now()
+    upper = (now + timedelta(seconds=offset_seconds)).isoformat()
+    floor = (now + timedelta(seconds=next_offset_seconds)).isoformat()
+    key = f"reminder_watermark_{offset_seconds}"
+
+    async def op(conn):
+        if fence and not await _holds_lease(conn, *fence):
+            return []
+        await conn.execute("INSERT INTO bot_settings (key, value) VALUES ($1, NULL) ON CONFLICT (key) DO NOTHING", key)
+        value = await conn.fetchval("SELECT value FROM bot_settings WHERE key = $1 FOR UPDATE", key)
+        mark_end, mark_user = floor, -1
+        if value:
+            end, user = value.rsplit("|", 1)
+            if end > floor:
+                mark_end, mark_user = end, int(user)
+        rows = await conn.fetch(
+            """
+            SELECT user_id, subscription_end FROM users
+            WHERE is_active = 1
+              AND (subscription_end, user_id) > ($1, $2)
+              AND subscription_end <= $3
+            ORDER BY subscription_end, user_id
+            LIMIT $4
+            """,
+            mark_end, mark_user, upper, limit
+        )
+        if rows:
+            await conn.execute(
+                """
+                INSERT INTO reminders (user_id, offset_seconds, subscription_end, status, updated_at)
+                SELECT t.user_id, $3, t.subscription_end, 'queued', $4
+                FROM unnest($1::bigint[], $2::text[]) AS t(user_id, subscription_end)
+                ON CONFLICT DO NOTHING
+                """,
+                [r[0] for r in rows], [r[1] for r in rows], offset_seconds, now.isoformat()
+            )
+        # a short batch means the window is drained up to `upper`
+        if len(rows) == limit:
+            mark = f"{rows[-1][1]}|{rows[-1][0]}"
+        else:
+            mark = f"{upper}|{2**63 - 1}"
+        await conn.execute("UPDATE bot_settings SET value = $2 WHERE key = $1", key, mark)
+        return [(r[0], r[1]) for r in rows]
+
+    rows = await _write(op)
+    return [{"user_id": user_id, "subscription_end": end, "offset_seconds": offset_seconds} for user_id, end in rows]
+
+
+async def get_queued_reminders(limit: int = 500):
+    """Reminders claimed but never confirmed sent (e.g. the process stopped mid-batch)"""
+    rows = await _fetch(
+        """
+        SELECT user_id, offset_seconds, subscription_end FROM reminders
+        WHERE status = 'queued' AND subscription_end > $1
+        ORDER BY subscription_end
+        LIMIT $2
+        """,
+        datetime.now().isoformat(), limit
+    )
+    return [{"user_id": row[0], "offset_seconds": row[1], "subscription_end": row[2]} for row in rows]
+
+
+async def mark_reminders(reminders: list, status: str):
+    """Set the status of claimed reminders ('sent' or 'failed')"""
+    if not reminders:
+        return
+    await _write(lambda conn: conn.execute(
+        """
+        UPDATE reminders r SET status = $1, updated_at = $2
+        FROM unnest($3::bigint[], $4::int[], $5::text[]) AS t(user_id, offset_seconds, subscription_end)
+        WHERE r.user_id = t.user_id AND r.offset_seconds = t.offset_seconds AND r.subscription_end = t.subscription_end
+        """,
+        status, datetime.now().isoformat(),
+        [r["user_id"] for r in reminders], [r["offset_seconds"] for r in reminders], [r["subscription_end"] for r in reminders]
+    ))
+
+
+async def purge_old_reminders(days: int = 7):
+    """Drop reminder rows for subscriptions that ended more than `days` ago"""
+    status = await _write(lambda conn: conn.execute(
+        "DELETE FROM reminders WHERE status IN ('queued', 'sent', 'failed') AND subscription_end < $1",
+        (datetime.now() - timedelta(days=days)).isoformat()
+    ))
+    return _rowcount(status)
+
+
+async def acquire_lease(name: str, holder: str, ttl_seconds: float):
+    """Take or renew the named lease for ttl_seconds.
+
+    Succeeds when the lease is free, expired or already ours. Every change of
+    holder increments the fencing token. Returns the token, or None while
+    another holder's lease is still valid.
+    """
+    return await _write(lambda conn: conn.fetchval(
+        """
+        INSERT INTO leases (name, holder, token, expires_at)
+        VALUES ($1, $2, 1, clock_timestamp() + make_interval(secs => $3))
+        ON CONFLICT (name) DO UPDATE SET
+            token = CASE WHEN leases.holder = EXCLUDED.holder THEN leases.token ELSE leases.token + 1 END,
+            holder = EXCLUDED.holder,
+            expires_at = EXCLUDED.expires_at
+        WHERE leases.holder = EXCLUDED.holder OR leases.expires_at < clock_timestamp()
+        RETURNING token
+        """,
+        name, holder, float(ttl_seconds)
+    ))
+
+
+async def release_lease(name: str, holder: str):
+    """Give up the lease if we hold it, so a standby can take over at once"""
+    await _write(lambda conn: conn.execute(
+        "UPDATE leases SET expires_at = '-infinity' WHERE name = $1 AND holder = $2", name, holder
+    ))
+
+
+async def get_lease(name: str):
+    """Current holder, fencing token and expiry of a lease (None if never taken)"""
+    row = await _fetchrow("SELECT holder, token, expires_at FROM leases WHERE name = $1", name)
+    if row:
+        return {"holder": row[0], "token": row[1], "expires_at": str(row[2])}
+    return None
+
+
+async def _holds_lease(conn, name: str, token: int) -> bool:
+    """Fencing check inside a write: is `token` still the current one?
+
+    FOR SHARE makes a concurrent takeover wait until this transaction ends.
+    """
+    current = await conn.fetchval("SELECT token FROM leases WHERE name = $1 FOR SHARE", name)
+    return current == token
+
+
+async def set_user_language(user_id: int, language: str):
+    """Remember the user's interface language (used for broadcast targeting)"""
+    await _write(lambda conn: conn.execute("UPDATE users SET language = $1 WHERE user_id = $2", language, user_id))
+
+
+async def sync_user_languages(languages: list) -> int:
+    """Copy [(user_id, language)] into users and users_archive where it differs; returns rows changed"""
+    if not languages:
+        return 0
+    user_ids = [int(user_id) for user_id, _ in languages]
+    codes = [language for _, language in languages]
+
+    async def op(conn):
+        changed = 0
+        for table in ("users", "users_archive"):
+            status = await conn.execute(
+                f"""
+                UPDATE {table} u SET language = t.language
+                FROM unnest($1::bigint[], $2::text[]) AS t(user_id, language)
+                WHERE u.user_id = t.user_id AND u.language IS DISTINCT FROM t.language
+                """,
+                user_ids, codes
+            )
+            changed += _rowcount(status)
+        return changed
+    return await _write(op)
+
+
+def _segment_filter(segment: str, arg: str | None, first: int = 1):
+    """WHERE clause (parameters numbered from $first) and params selecting a broadcast audience"""
+    if segment == 'all':
+        return "TRUE", []
+    if segment == 'active':
+        return "is_active = 1", []
+    if segment == 'expired':
+        now = datetime.now()
+        since = (now - timedelta(days=int(arg or 7))).isoformat()
+        return f"is_active = 0 AND subscription_end >= ${first} AND subscription_end < ${first + 1}", [since, now.isoformat()]
+    if segment == 'never_purchased':
+        return "subscription_end IS NULL", []
+    if segment == 'language':
+        if arg == DEFAULT_LANGUAGE:
+            return f"(language = ${first} OR language IS NULL)", [arg]
+        return f"language = ${first}", [arg]
+    if segment == 'service':
+        return f"service_id = ${first} AND is_active = 1", [int(arg)]
+    raise ValueError(f"unknown broadcast segment: {segment}")
+
+
+def _segment_tables(segment: str) -> tuple:
+    """Tables a segment reads: the hot tier, plus the archive unless it targets active subscribers"""
+    return ('users',) if segment in ACTIVE_SEGMENTS else ('users', 'users_archive')
+
+
+async def get_segment_user_ids(segment: str, arg: str | None = None, after_user_id: int = 0, limit: int = 500) -> list:
+    """Next page of a segment's user ids (keyset on user_id across the hot and archive tiers)"""
+    where, params = _segment_filter(segment, arg, first=3)
+    # each tier yields its own next page from its index; the merge keeps the first `limit`
+    query = " UNION ALL ".join(
+        f"(SELECT user_id FROM {table} WHERE {where} AND user_id > $1 ORDER BY user_id LIMIT $2)"
+        for table in _segment_tables(segment)
+    )
+    rows = await _fetch(f"SELECT user_id FROM ({query}) AS page ORDER BY user_id LIMIT $2", after_user_id, limit, *params)
+    return [row[0] for row in rows]
+
+
+async def count_segment(segment: str, arg: str | None = None) -> int:
+    """Number of users in a broadcast segment"""
+    where, params = _segment_filter(segment, arg)
+    counts = " + ".join(f"(SELECT COUNT(*) FROM {table} WHERE {where})" for table in _segment_tables(segment))
+    return await _fetchval(f"SELECT {counts}", *params)
+
+
+async def create_broadcast(segment: str, segment_arg: str | None, scheduled_at: datetime, created_by: int,
+                           text: str | None = None, source_chat_id: int | None = None,
+                           source_message_id: int | None = None) -> int:
+    """Persist a broadcast: either HTML text or a stored message to copy"""
+    _segment_filter(segment, segment_arg)
+    return await _write(lambda conn: conn.fetchval(
+        """
+        INSERT INTO broadcasts (segment, segment_arg, text, source_chat_id, source_message_id, scheduled_at, status, created_by, created_at)
+        VALUES ($1, $2, $3, $4, $5, $6, 'scheduled', $7, $8)
+        RETURNING id
+        """,
+        segment, segment_arg, text, source_chat_id, source_message_id, scheduled_at.isoformat(), created_by, datetime.now().isoformat()
+    ))
+
+
+_BROADCAST_COLUMNS = (
+    "id, segment, segment_arg, text, source_chat_id, source_message_id, scheduled_at, "
+    "status, created_by, last_user_id, sent, failed, finished_at"
+)
+
+
+async def get_due_broadcasts() -> list:
+    """Broadcasts whose time has come, plus ones interrupted mid-send"""
+    rows = await _fetch(
+        f"""
+        SELECT {_BROADCAST_COLUMNS} FROM broadcasts
+        WHERE status = 'sending' OR (status = 'scheduled' AND scheduled_at <= $1)
+        ORDER BY scheduled_at
+        """,
+        datetime.now().isoformat()
+    )
+    return [dict(row) for row in rows]
+
+
+async def get_broadcasts(limit: int = 10) -> list:
+    """Pending broadcasts first, then the most recent finished ones"""
+    rows = await _fetch(
+        f"""
+        SELECT {_BROADCAST_COLUMNS} FROM broadcasts
+        ORDER BY status IN ('scheduled', 'sending') DESC, scheduled_at DESC
+        LIMIT $1
+        """,
+        limit
+    )
+    return [dict(row) for row in rows]
+
+
+async def start_broadcast(broadcast_id: int) -> bool:
+    """scheduled -> sending; False if it was cancelled or already started"""
+    status = await _write(lambda conn: conn.execute(
+        "UPDATE broadcasts SET status = 'sending' WHERE id = $1 AND status = 'scheduled'", broadcast_id
+    ))
+    return _rowcount(status) == 1
+
+
+async def record_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int) -> bool:
+    """Advance the resume cursor and counters; False once the broadcast was cancelled"""
+    status = await _write(lambda conn: conn.execute(
+        """
+        UPDATE broadcasts SET last_user_id = $1, sent = sent + $2, failed = failed + $3
+        WHERE id = $4 AND status = 'sending'
+        """,
+        last_user_id, sent, failed, broadcast_id
+    ))
+    return _rowcount(status) == 1
+
+
+async def finish_broadcast(broadcast_id: int, status: str = 'done'):
+    """Close a broadcast (done/cancelled) unless it was already closed"""
+    if status not in BROADCAST_STATUSES:
+        raise ValueError(f"invalid broadcast status: {status}")
+    result = await _write(lambda conn: conn.execute(
+        "UPDATE broadcasts SET status = $1, finished_at = $2 WHERE id = $3 AND status IN ('scheduled', 'sending')",
+        status, datetime.now().isoformat(), broadcast_id
+    ))
+    return _rowcount(result) == 1
+
+
+async def get_channels() -> list:
+    """Registered channels with the ids of the services granting each one"""
+    rows = await _fetch(
+        """
+        SELECT c.chat_id, c.title, c.is_default, c.join_link,
+               COALESCE(array_agg(s.service_id ORDER BY s.service_id) FILTER (WHERE s.service_id IS NOT NULL), '{}') AS services
+        FROM channels c
+        LEFT JOIN service_channels s ON s.chat_id = c.chat_id
+        GROUP BY c.chat_id
+        ORDER BY c.added_at, c.chat_id
+        """
+    )
+    return [
+        {"chat_id": row[0], "title": row[1], "is_default": bool(row[2]), "join_link": row[3], "services": list(row[4])}
+        for row in rows
+    ]
+
+
+async def add_channel(chat_id: int, title: str | None = None, is_default: bool = False) -> bool:
+    """Register a channel, or refresh the title of a known one; True if it is new"""
+    return await _write(lambda conn: conn.fetchval(
+        """
+        INSERT INTO channels (chat_id, title, is_default, added_at) VALUES ($1, $2, $3, $4)
+        ON CONFLICT (chat_id) DO UPDATE SET title = COALESCE(EXCLUDED.title, channels.title)
+        RETURNING xmax = 0
+        """,
+        chat_id, title, int(is_default), datetime.now().isoformat()
+    ))
+
+
+async def remove_channel(chat_id: int):
+    """Forget a channel (its service grants go with it)"""
+    await _write(lambda conn: conn.execute("DELETE FROM channels WHERE chat_id = $1", chat_id))
+
+
+async def set_channel_default(chat_id: int, is_default: bool):
+    """Default channels are granted by services without their own channel list"""
+    await _write(lambda conn: conn.execute("UPDATE channels SET is_default = $1 WHERE chat_id = $2", int(is_default), chat_id))
+
+
+async def set_channel_join_link(chat_id: int, join_link: str):
+    await _write(lambda conn: conn.execute("UPDATE channels SET join_link = $1 WHERE chat_id = $2", join_link, chat_id))
+
+
+async def set_service_channel(service_id: int, chat_id: int, granted: bool):
+    """Grant or withdraw a channel for a service"""
+    if granted:
+        await _write(lambda conn: conn.execute(
+            "INSERT INTO service_channels (service_id, chat_id) VALUES ($1, $2) ON CONFLICT DO NOTHING", service_id, chat_id
+        ))
+    else:
+        await _write(lambda conn: conn.execute(
+            "DELETE FROM service_channels WHERE service_id = $1 AND chat_id = $2", service_id, chat_id
+        ))
+
+
+async def get_channel_removals(user_ids: list) -> dict:
+    """{chat_id: [user_id]} of channels each user may be in: known members, plus
+    channels their service grants where membership is unknown"""
+    if not user_ids:
+        return {}
+    rows = await _fetch(
+        """
+        SELECT c.chat_id, ids.user_id FROM unnest($1::bigint[]) AS ids(user_id)
+        CROSS JOIN channels c
+        LEFT JOIN users u ON u.user_id = ids.user_id
+        LEFT JOIN channel_members m ON m.chat_id = c.chat_id AND m.user_id = ids.user_id
+        WHERE CASE WHEN m.status IS NOT NULL THEN m.status <> ALL($2::text[])
+              ELSE EXISTS (SELECT 1 FROM service_channels s WHERE s.service_id = u.service_id AND s.chat_id = c.chat_id)
+                   OR (c.is_default = 1 AND NOT EXISTS (SELECT 1 FROM service_channels s WHERE s.service_id = u.service_id))
+              END
+        ORDER BY c.chat_id, ids.user_id
+        """,
+        list(user_ids), list(CHANNEL_NON_MEMBER_STATUSES)
+    )
+    removals = {}
+    for chat_id, user_id in rows:
+        removals.setdefault(chat_id, []).append(user_id)
+    return removals
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+def _mark_retrieved(future: asyncio.Future):
+    # failures are already logged by the worker; fire-and-forget callers
+    # should not trigger "exception was never retrieved" warnings
+    if not future.cancelled():
+        future.exception()
+
+
+class RateLimitedQueue:
+    """FIFO of Bot API jobs executed by background workers at a bounded rate.
+
+    `put()` returns a future resolved with the job's result (or exception), so
+    callers can either fire-and-forget or wait for the outcome. The workers are
+    started lazily on the first `put()` from a running event loop. With several
+    workers, calls overlap (a slow response does not hold up the next job) while
+    their start times still follow the shared rate.
+    """
+
+    def __init__(self, name: str, rate_per_second: float, maxsize: int = 0, workers: int = 1):
+        self.name = name
+        self.interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self.maxsize = maxsize
+        self.workers = max(1, workers)
+        self.processed = 0
+        self.failed = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._next_slot = 0.0
+
+    def _ensure_worker(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < self.workers:
+            self._workers.append(asyncio.create_task(self._run(), name=f"rate-queue-{self.name}-{len(self._workers)}"))
+
+    async def put(self, job: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """Enqueue a zero-argument coroutine function; waits if the queue is full"""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_mark_retrieved)
+        await self._queue.put((job, future))
+        return future
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def join(self):
+        """Wait until every queued job has finished"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self):
+        """Drain pending jobs and stop the workers"""
+        await self.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _run(self):
+        while True:
+            job, future = await self._queue.get()
+            try:
+                # reserve the next start slot before sleeping, so workers never share one
+                now = time.monotonic()
+                slot = max(self._next_slot, now)
+                self._next_slot = slot + self.interval
+                if slot > now:
+                    await asyncio.sleep(slot - now)
+                result = await self._call(job)
+                self.processed += 1
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.warning("[%s] job failed: %s", self.name, e, extra={"sample": f"rate_queue_{self.name}_failed"})
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _call(self, job: Callable[[], Awaitable[Any]]):
+        try:
+            return await job()
+        except TelegramRetryAfter as e:
+            # Telegram asked us to slow down: honour it once, then retry
+            logger.warning("[%s] flood control, sleeping %ss", self.name, e.retry_after)
+            await asyncio.sleep(e.retry_after)
+            return await job()
@@ -0,0 +1,132 @@
+"""Reminder throughput against the fake Bot API.
+
+Seeds a temporary database with subscriptions ending within the next hour,
+runs one reminder cycle as the elected leader against fake_bot_api.py
+(answering every call after --latency-ms) and reports the send rate and
+how long 100k reminders due in the same hour would take:
+
+    python reminder_bench.py [--reminders 3000] [--latency-ms 150] [--rate 30] [--workers 30]
+
+At the configured rate a run takes reminders / rate seconds, so the default
+measures a few minutes' worth; --reminders 100000 with a raised --rate
+shows how far claiming and marking keep up beyond the send rate.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict
+
+import aiohttp
+
+import config
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TARGET_PER_HOUR = 100_000
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _bench(args: argparse.Namespace, api_url: str) -> Dict[str, Any]:
+    import bots
+    import reminders
+    from leader import election
+    from repository import backend as db
+
+    await db.init_db()
+    # subscriptions end over the next hour, after the first 2 minutes
+    for first in range(0, args.reminders, 1000):
+        await asyncio.gather(*(
+            db.activate_user_subscription(
+                1_000_000 + i, f"user{i}", None, 120 + i * 3300 // args.reminders, "seconds"
+            )
+            for i in range(first, min(first + 1000, args.reminders))
+        ))
+
+    done = asyncio.get_running_loop().create_future()
+
+    async def cycle():
+        started = time.perf_counter()
+        sent, failed = await reminders.run_reminder_cycle()
+        done.set_result((sent, failed, time.perf_counter() - started))
+        await asyncio.Event().wait()
+
+    leader = asyncio.create_task(election.run([cycle]))
+    try:
+        sent, failed, elapsed = await done
+    finally:
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        await reminders.reminder_queue.close()
+        await bots.close()
+        await db.close_db()
+    async with aiohttp.ClientSession() as client:
+        async with client.get(f"{api_url}/_fake/{config.USER_BOT_TOKEN}/stats") as resp:
+            delivered = (await resp.json())["calls"].get("sendMessage", 0)
+    per_second = sent / elapsed if elapsed else 0.0
+    return {
+        "reminders": args.reminders, "sent": sent, "failed": failed, "delivered": delivered,
+        "seconds": round(elapsed, 1), "per_second": round(per_second, 1), "per_hour": round(per_second * 3600),
+        "rate": args.rate, "workers": args.workers, "latency_ms": args.latency_ms,
+    }
+
+
+def run_bench(args: argparse.Namespace) -> Dict[str, Any]:
+    """Start the fake Bot API and run the benchmark in a temporary directory"""
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_bot_api.py"), "--port", str(port), "--latency-ms", str(args.latency_ms)],
+        stderr=subprocess.DEVNULL,
+    )
+    workdir = tempfile.mkdtemp(prefix="reminder-bench-")
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        # settings are read at import time, so they go in before the bot modules load
+        settings = {
+            "BOT_API_SERVER": f"http://127.0.0.1:{port}", "LOG_LEVEL": "WARNING", "REMINDER_OFFSETS": [3600],
+            "REMINDER_SEND_RATE": args.rate, "REMINDER_WORKERS": args.workers,
+        }
+        for key, value in settings.items():
+            setattr(config, key, value)
+        os.chdir(workdir)
+        return asyncio.run(_bench(args, f"http://127.0.0.1:{port}"))
+    finally:
+        server.terminate()
+        server.wait()
+        os.chdir(HERE)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reminder send rate against a fake Bot API")
+    parser.add_argument("--reminders", type=int, default=3000)
+    parser.add_argument("--latency-ms", type=float, default=150, help="Bot API round trip simulated by the fake server")
+    parser.add_argument("--rate", type=float, default=getattr(config, "REMINDER_SEND_RATE", 30))
+    parser.add_argument("--workers", type=int, default=getattr(config, "REMINDER_WORKERS", 30))
+    args = parser.parse_args()
+    r = run_bench(args)
+    print(
+        f"{r['sent']}/{r['reminders']} reminders sent ({r['failed']} failed, {r['delivered']} reached the API) "
+        f"in {r['seconds']}s: {r['per_second']}/s, {r['per_hour']}/hour "
+        f"at rate {r['rate']}/s, {r['workers']} workers, {r['latency_ms']} ms round trip"
+    )
+    minutes = TARGET_PER_HOUR / r["per_second"] / 60 if r["per_second"] else float("inf")
+    print(f"{TARGET_PER_HOUR} reminders due in the same hour: {minutes:.1f} minutes")
+    sys.exit(0 if minutes <= 60 else 1)
@@ -0,0 +1,114 @@
+"""Pre-expiry reminder engine.
+
+For every offset in config.REMINDER_OFFSETS users whose subscription_end
+enters the window are claimed in batches (database.claim_due_reminders),
+sent through a rate-limited queue in the user's language and then marked
+as sent. Claims are persisted before sending, so after a restart only the
+reminders that were claimed but not confirmed are sent again.
+
+Sizing: 100k reminders coming due in the same hour need 100000 / 3600 =
+27.8 messages/s. Telegram lets a bot send about 30 messages/s in bulk, so
+REMINDER_SEND_RATE defaults to 30: 108k/hour, 100k in 56 minutes. One
+worker sends one message per round trip, 1/RTT per second (6.7/s, 24k/hour
+at 150 ms), and by Little's law holding 30/s takes rate x RTT calls in
+flight: REMINDER_WORKERS = 30 sustains the full rate for round trips up to
+1 s. The next batch is claimed while the previous one is still sending, so
+the queue does not run dry at batch boundaries. reminder_bench.py checks
+these numbers against fake_bot_api.py.
+"""
+import asyncio
+import logging
+
+import config
+from repository import backend as db
+from leader import election
+from rate_queue import RateLimitedQueue
+from user_bot import send_expiry_reminder
+
+logger = logging.getLogger(__name__)
+
+REMINDER_OFFSETS = sorted(getattr(config, "REMINDER_OFFSETS", [3 * 86400, 86400, 3600]), reverse=True)
+BATCH_SIZE = getattr(config, "REMINDER_BATCH_SIZE", 500)
+
+reminder_queue = RateLimitedQueue(
+    "reminders", getattr(config, "REMINDER_SEND_RATE", 30), maxsize=BATCH_SIZE,
+    workers=getattr(config, "REMINDER_WORKERS", 30),
+)
+
+
+async def _send_batch(batch: list):
+    futures = [
+        await reminder_queue.put(lambda r=r: send_expiry_reminder(r["user_id"], r["subscription_end"]))
+        for r in batch
+    ]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    sent = [r for r, result in zip(batch, results) if not isinstance(result, BaseException)]
+    failed = [r for r, result in zip(batch, results) if isinstance(result, BaseException)]
+    if sent:
+        await db.mark_reminders(sent, "sent")
+    if failed:
+        await db.mark_reminders(failed, "failed")
+    return len(sent), len(failed)
+
+
+async def resume_queued_reminders():
+    """Send reminders a previous process claimed but did not confirm"""
+    sent = failed = 0
+    while True:
+        batch = await db.get_queued_reminders(limit=BATCH_SIZE)
+        if not batch:
+            break
+        s, f = await _send_batch(batch)
+        sent, failed = sent + s, failed + f
+    return sent, failed
+
+
+async def run_reminder_cycle():
+    """Claim and send every reminder that is currently due"""
+    sent = failed = 0
+    # at most two batches in flight: one sending, the next one queueing behind it
+    sending = queued = None
+    try:
+        for i, offset in enumerate(REMINDER_OFFSETS):
+            next_offset = REMINDER_OFFSETS[i + 1] if i + 1 < len(REMINDER_OFFSETS) else 0
+            while True:
+                batch = await db.claim_due_reminders(offset, next_offset, limit=BATCH_SIZE, fence=election.fence)
+                if not batch:
+                    break
+                queued = asyncio.create_task(_send_batch(batch))
+                if sending is not None:
+                    s, f = await sending
+                    sent, failed = sent + s, failed + f
+                sending, queued = queued, None
+                if len(batch) < BATCH_SIZE:
+                    break
+        if sending is not None:
+            s, f = await sending
+            sent, failed = sent + s, failed + f
+    except BaseException:
+        # claimed but unconfirmed reminders are resumed on the next start
+        for task in (sending, queued):
+            if task is not None:
+                task.cancel()
+        raise
+    return sent, failed
+
+
+async def reminder_loop():
+    """Background task: resume unfinished reminders, then poll for due ones"""
+    interval = getattr(config, "REMINDER_CHECK_INTERVAL", 60)
+    try:
+        sent, failed = await resume_queued_reminders()
+        if sent or failed:
+            logger.info("Resumed reminders: %d sent, %d failed", sent, failed)
+    except Exception as e:
+        logger.error("Error resuming reminders: %s", e)
+    while True:
+        try:
+            sent, failed = await run_reminder_cycle()
+            if sent or failed:
+                logger.info("Expiry reminders: %d sent, %d failed", sent, failed)
+            await db.purge_old_reminders()
+        except Exception as e:
+            logger.error("Error in reminder engine: %s", e)
+        await asyncio.sleep(interval)
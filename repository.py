@@ -0,0 +1,81 @@
+"""Storage backend selection.
+
+The bots talk to storage only through the functions listed in INTERFACE.
+database.py (SQLite, single process) and pg_database.py (PostgreSQL via
+asyncpg, several instances sharing one database) both implement all of
+them with the same signatures and return values. DATABASE_BACKEND in
+config.py picks one; call sites use `from repository import backend as db`.
+"""
+import importlib
+from types import ModuleType
+
+import config
+import tracing
+
+BACKENDS = {
+    "sqlite": "database",
+    "postgres": "pg_database",
+}
+
+# The storage contract shared by every backend
+INTERFACE = (
+    "init_db", "close_db", "write_stats", "get_schema_version",
+    # services
+    "add_service", "get_services", "get_service_by_id", "update_service_price",
+    "update_service_duration", "update_service_name", "delete_service",
+    # purchase requests
+    "add_pending_purchase", "get_pending_purchase", "delete_pending_purchase",
+    "resolve_pending_purchase", "expire_stale_purchases", "approve_purchases",
+    "reject_purchase", "get_pending_purchases_page", "count_pending_purchases",
+    # Telegram Payments
+    "record_payment",
+    # users and subscriptions
+    "activate_user_subscription", "get_user_subscription", "get_all_users",
+    "deactivate_expired_subscriptions", "deactivate_user_subscription",
+    "load_entitlements", "load_user_entitlement", "upsert_user_profile", "get_user",
+    "search_users_by_username", "get_users_paginated", "archive_inactive_users",
+    "bulk_update_subscriptions", "iter_users_export",
+    "get_shortest_active_subscription_seconds",
+    # channels granted by services
+    "get_channels", "add_channel", "remove_channel", "set_channel_default",
+    "set_channel_join_link", "set_service_channel", "get_channel_removals",
+    # channel membership
+    "mark_user_added_to_channel", "mark_user_removed_from_channel",
+    "mark_users_removed_from_channel", "set_channel_member_statuses",
+    "get_known_non_members", "get_membership_drift",
+    # settings
+    "get_bot_setting", "set_bot_setting", "get_bot_config", "set_bot_config",
+    "init_default_bot_config",
+    # statistics
+    "reconcile_statistics", "get_statistics",
+    # reminders
+    "claim_due_reminders", "get_queued_reminders", "mark_reminders", "purge_old_reminders",
+    # broadcasts
+    "set_user_language", "sync_user_languages", "get_segment_user_ids", "count_segment",
+    "create_broadcast", "get_due_broadcasts", "get_broadcasts", "start_broadcast",
+    "record_broadcast_progress", "finish_broadcast",
+    # leader election
+    "acquire_lease", "release_lease", "get_lease",
+    # shared helpers and constants
+    "duration_to_timedelta", "extend_subscription_end",
+    "PURCHASE_STATUSES", "CHANNEL_NON_MEMBER_STATUSES", "DEFAULT_BOT_CONFIG",
+    "BROADCAST_SEGMENTS", "BROADCAST_STATUSES",
+)
+
+BACKEND_NAME = getattr(config, "DATABASE_BACKEND", "sqlite")
+
+
+def load_backend(name: str) -> ModuleType:
+    """Import a backend module and check that it implements INTERFACE"""
+    if name not in BACKENDS:
+        raise ValueError(f"unknown DATABASE_BACKEND {name!r}, expected one of {', '.join(BACKENDS)}")
+    module = importlib.import_module(BACKENDS[name])
+    missing = [attr for attr in INTERFACE if not hasattr(module, attr)]
+    if missing:
+        raise TypeError(f"storage backend {name!r} is missing: {', '.join(missing)}")
+    return module
+
+
+backend = load_backend(BACKEND_NAME)
+if tracing.TRACE_ENABLED:
+    tracing.instrument_module(backend, INTERFACE)
@@ -0,0 +1,428 @@
+"""Soak test: both bots against a fake Bot API in compressed time, tracking memory growth.
+
+    python soak.py [--updates 500000] [--users 5000] [--budget-mb 50] [--out soak_report]
+
+main.main() runs in this process (both dispatchers, leader loops, expiry,
+reminders) in a temporary directory with its own database; fake_bot_api.py
+runs in a process of its own, so its memory does not count. Time is
+compressed: subscriptions last SERVICE_MINUTES, loop intervals are cut to
+seconds, and waves of simulated users start the bot, pick a language, buy,
+pay, join the channel, check their subscription and write to the admin, as
+fast as the bots keep up. The admin browses the panel now and then. Users
+come from a population of --users: new ones keep arriving (mixed with
+returning ones) until all have, then everyone is returning, so per-user state
+(language map, throttling buckets) stops growing and what grows after
+--warmup is a leak.
+
+Every --sample-every updates it records RSS, asyncio tasks, open file
+descriptors, tracemalloc totals and the sizes of the usual suspects (FSM
+states in MemoryStorage, language dicts, aiohttp sessions and connections,
+throttling buckets, scheduler lanes), and diffs the tracemalloc snapshot
+against the previous one to attribute growth to allocation sites.
+
+Writes samples.csv, chart.svg (RSS, tasks, fds), report.txt (growth per
+100k updates as a least-squares slope after --warmup, allocation sites grown
+since then, the most common live tasks per sample) and the baseline
+snapshot to --out; exits with status 1 when RSS, traced heap (MB), task or
+fd growth per 100k updates exceeds its budget. Growth is measured with nothing in flight,
+against the update count the fake reports (/_fake/<token>/stats).
+"""
+import argparse
+import asyncio
+import contextlib
+import csv
+import gc
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+import config
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVICE_MINUTES = 2
+
+# compressed time: background loops every few seconds instead of hours
+SOAK_CONFIG = {
+    "LOG_LEVEL": "WARNING",
+    "PAYMENT_PROVIDER_TOKEN": "soak",
+    "PAYMENT_CURRENCY": "RUB",
+    "THROTTLE_RATE": 1000.0,
+    "THROTTLE_BURST": 1000,
+    "EXPIRY_CHECK_INTERVAL": 10,
+    "ENTITLEMENT_REFRESH_INTERVAL": 5,
+    "MEMBERSHIP_RECONCILE_INTERVAL": 30,
+    "REMINDER_OFFSETS": [60, 30],
+    "REMINDER_CHECK_INTERVAL": 5,
+    "STATS_RECONCILE_INTERVAL": 60,
+    "PENDING_PURCHASE_TTL": 60,
+    "USER_ARCHIVE_AFTER_DAYS": 0,
+    "USER_ARCHIVE_INTERVAL": 60,
+    "BROADCAST_CHECK_INTERVAL": 5,
+    "BACKUP_INTERVAL": 300,
+    "LOOP_LAG_LOG_INTERVAL": 3600,
+    # tracemalloc slows everything down; only report real stalls
+    "LOOP_LAG_THRESHOLD_MS": 2000,
+}
+
+# tracemalloc lines that are the harness itself
+_IGNORED_SITES = (tracemalloc.__file__, __file__, "<frozen importlib._bootstrap>", "<unknown>")
+
+
+def _rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def _task_kinds(top: int = 3) -> str:
+    """The most common coroutines among live tasks, to tell which kind piles up"""
+    kinds = Counter(getattr(task.get_coro(), "__qualname__", "?") for task in asyncio.all_tasks())
+    return ", ".join(f"{name} x{count}" for name, count in kinds.most_common(top))
+
+
+def _slope(xs: List[float], ys: List[float]) -> float:
+    n = len(xs)
+    if n < 2:
+        return 0.0
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread if spread else 0.0
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Soak:
+    def __init__(self, args: argparse.Namespace, api_url: str):
+        self.args = args
+        self.api_url = api_url
+        self.client: Optional[aiohttp.ClientSession] = None
+        self.next_user = 10_000_000
+        self.known: List[int] = []
+        self.samples: List[Dict[str, Any]] = []
+        self.site_growth: List[str] = []
+        self.task_kinds: List[str] = []
+        self.previous: Optional[tracemalloc.Snapshot] = None
+        self.baseline_path: Optional[str] = None
+        self.service_id: Optional[int] = None
+
+    # ---- bot internals ----
+
+    @staticmethod
+    def processed() -> int:
+        import update_scheduler
+        return sum(scheduler.processed for scheduler in update_scheduler.registry.values())
+
+    @staticmethod
+    def suspects() -> Dict[str, int]:
+        import admin_bot
+        import bots
+        import entitlements
+        import throttling
+        import update_scheduler
+        import user_bot
+        sessions = sum(1 for obj in gc.get_objects() if isinstance(obj, aiohttp.ClientSession) and not obj.closed)
+        return {
+            "fsm_admin": len(admin_bot.storage.storage),
+            "fsm_user": len(user_bot.storage.storage),
+            "langs_admin": len(admin_bot.get_langs()),
+            "langs_user": len(user_bot.get_langs()),
+            "http_sessions": sessions,
+            "http_connections": bots.session().pool_stats()["open"],
+            "throttle_users": sum(len(m._buckets) for m in throttling.registry.values()),
+            "lanes": sum(len(s._lanes) for s in update_scheduler.registry.values()),
+            "entitled": entitlements.count(),
+        }
+
+    # ---- traffic ----
+
+    async def _post(self, token: str, path: str, body: dict) -> dict:
+        async with self.client.post(f"{self.api_url}/_fake/{token}/{path}", json=body) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def _batch(self, token: str, updates: List[dict]):
+        if updates:
+            await self._post(token, "batch", {"updates": updates})
+
+    async def pushed(self) -> int:
+        """Updates the fake has queued for both bots, including the chat_member ones it makes itself"""
+        total = 0
+        for token in (config.USER_BOT_TOKEN, config.ADMIN_BOT_TOKEN):
+            async with self.client.get(f"{self.api_url}/_fake/{token}/stats") as resp:
+                total += (await resp.json())["pushed"]
+        return total
+
+    async def _drain(self, backlog: int = 0, timeout: float = 60):
+        """Wait until the bots have caught up with what the fake has sent them"""
+        deadline = time.monotonic() + timeout
+        while True:
+            behind = await self.pushed() - self.processed()
+            if behind <= backlog:
+                return
+            if time.monotonic() > deadline:
+                # reported rather than waited out, so the run still ends
+                print(f"backlog of {behind} updates after {timeout}s", flush=True)
+                return
+            await asyncio.sleep(0.05)
+
+    async def _pay(self, user_id: int):
+        await self._post(config.USER_BOT_TOKEN, "pay", {"user_id": user_id})
+
+    async def wave(self, number: int):
+        size = self.args.wave
+        users = []
+        for _ in range(size):
+            arriving = len(self.known) < self.args.users
+            if self.known and (not arriving or random.random() < self.args.returning):
+                users.append(random.choice(self.known))
+            else:
+                self.next_user += 1
+                self.known.append(self.next_user)
+                users.append(self.next_user)
+        user_token, admin_token = config.USER_BOT_TOKEN, config.ADMIN_BOT_TOKEN
+        lang = ["lang_ru", "lang_en", "lang_ar", "lang_uz"]
+        await self._batch(user_token, [
+            update for uid in users for update in (
+                {"user_id": uid, "text": "/start"},
+                {"user_id": uid, "data": random.choice(lang)},
+                {"user_id": uid, "data": "buy_subscription"},
+                {"user_id": uid, "data": f"service_{self.service_id}"},
+            )
+        ])
+        await self._drain()
+        payers = [uid for uid in users if random.random() < self.args.pay_share]
+        await asyncio.gather(*(self._pay(uid) for uid in payers))
+        await self._drain()
+        await self._batch(admin_token, [{"user_id": uid, "join_chat_id": config.PRIVATE_CHANNEL_ID} for uid in payers])
+        tail = []
+        for uid in users:
+            tail.append({"user_id": uid, "data": "my_subscription"})
+            if random.random() < 0.1:
+                tail += [{"user_id": uid, "data": "contact_admin"}, {"user_id": uid, "text": "soak question"}]
+        await self._batch(user_token, tail)
+        if number % 10 == 0:
+            admin_id = (getattr(config, "ADMIN_USER_IDS", []) or [1])[0]
+            await self._batch(admin_token, [
+                {"user_id": admin_id, "text": "/start"},
+                {"user_id": admin_id, "data": "statistics"},
+                {"user_id": admin_id, "data": "pending_queue"},
+                {"user_id": admin_id, "data": "channels_menu"},
+                {"user_id": admin_id, "data": "diagnostics"},
+            ])
+        await self._drain(backlog=size)
+
+    # ---- measurements ----
+
+    def sample(self, started: float):
+        gc.collect()
+        # measured before the snapshot, which is itself tens of MB
+        traced, _ = tracemalloc.get_traced_memory()
+        row = {
+            "updates": self.processed(),
+            "elapsed_s": round(time.monotonic() - started, 1),
+            "rss_mb": round(_rss_bytes() / 2**20, 2),
+            "traced_mb": round(traced / 2**20, 2),
+            "tasks": len(asyncio.all_tasks()),
+            "fds": _open_fds(),
+            **self.suspects(),
+        }
+        self.samples.append(row)
+        self.task_kinds.append(f"at {row['updates']} updates: {_task_kinds()}")
+        print(" ".join(f"{key}={value}" for key, value in row.items()), flush=True)
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, pattern) for pattern in _IGNORED_SITES]
+        )
+        if self.previous is not None:
+            top = snapshot.compare_to(self.previous, "lineno")[:5]
+            self.site_growth.append(
+                f"at {row['updates']} updates: "
+                + "; ".join(f"{stat.traceback[0].filename.rsplit('/', 1)[-1]}:{stat.traceback[0].lineno} "
+                            f"{stat.size_diff / 1024:+.0f} KiB" for stat in top)
+            )
+        self.previous = snapshot
+        if self.baseline_path is None and row["updates"] >= self.args.warmup:
+            # on disk, so holding it does not show up as growth
+            self.baseline_path = os.path.join(self.args.out, "baseline.snapshot")
+            snapshot.dump(self.baseline_path)
+
+    async def run(self) -> int:
+        import admin_bot
+        import main
+        import user_bot
+        from repository import backend as db
+
+        await db.init_db()
+        self.service_id = await db.add_service("soak", SERVICE_MINUTES, 100.0, "minutes")
+        main_task = asyncio.create_task(main.main())
+        self.client = aiohttp.ClientSession()
+        started = time.monotonic()
+        next_sample = 0
+        number = 0
+        try:
+            while self.processed() < self.args.updates:
+                if main_task.done():
+                    main_task.result()
+                number += 1
+                await self.wave(number)
+                if self.processed() >= next_sample:
+                    # measured with nothing in flight, so tasks and fds compare between samples
+                    await self._drain()
+                    self.sample(started)
+                    next_sample = self.processed() + self.args.sample_every
+            await self._drain()
+            if self.processed() - self.samples[-1]["updates"] >= self.args.sample_every // 2:
+                self.sample(started)
+        finally:
+            await self.client.close()
+            # cancelling start_polling would leave aiogram's polling tasks running
+            for dp in (admin_bot.dp, user_bot.dp):
+                with contextlib.suppress(RuntimeError):
+                    await dp.stop_polling()
+            main_task.cancel()
+            await asyncio.gather(main_task, return_exceptions=True)
+        return self.report()
+
+    # ---- results ----
+
+    def report(self) -> int:
+        out = self.args.out
+        with open(os.path.join(out, "samples.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.samples[0]))
+            writer.writeheader()
+            writer.writerows(self.samples)
+        write_chart(self.samples, os.path.join(out, "chart.svg"))
+
+        steady = [s for s in self.samples if s["updates"] >= self.args.warmup] or self.samples
+        base, last = steady[0], steady[-1]
+        # least-squares slope after warm-up, so one allocator step does not read as a trend
+        per_100k = {
+            key: _slope([s["updates"] for s in steady], [s[key] for s in steady]) * 100_000
+            for key in last if key not in ("updates", "elapsed_s")
+        }
+        budgets = {
+            "rss_mb": self.args.budget_mb, "traced_mb": self.args.budget_traced_mb,
+            "tasks": self.args.budget_tasks, "fds": self.args.budget_fds,
+        }
+        failures = [f"{key} grew {per_100k[key]:.1f} per 100k updates (budget {limit})"
+                    for key, limit in budgets.items() if per_100k[key] > limit]
+        lines = [
+            f"{last['updates']} updates in {last['elapsed_s']}s; baseline at {base['updates']} updates",
+            "",
+            "Growth per 100k updates after warm-up:",
+            *(f"  {key:<16} {value:+10.2f}   ({base[key]} -> {last[key]})" for key, value in per_100k.items()),
+            "",
+            "Top allocation sites grown since warm-up:",
+        ]
+        if self.baseline_path is not None and self.previous is not None:
+            baseline = tracemalloc.Snapshot.load(self.baseline_path)
+            for stat in self.previous.compare_to(baseline, "traceback")[:15]:
+                frame = stat.traceback[0]
+                lines.append(f"  {stat.size_diff / 1024:+9.0f} KiB {stat.count_diff:+8d} blocks  {frame.filename}:{frame.lineno}")
+        lines += ["", "Most common tasks per sample:", *(f"  {k}" for k in self.task_kinds)]
+        lines += ["", "Per-sample growth (top sites since the previous sample):", *(f"  {g}" for g in self.site_growth)]
+        lines += ["", "FAILED: " + "; ".join(failures) if failures else "PASSED: growth within budget"]
+        text = "\n".join(lines)
+        with open(os.path.join(out, "report.txt"), "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(text)
+        return 1 if failures else 0
+
+
+def write_chart(samples: List[Dict[str, Any]], path: str):
+    """RSS, task and fd counts against updates processed, as a dependency-free SVG"""
+    panels = [("rss_mb", "RSS, MB", "#c0392b"), ("tasks", "asyncio tasks", "#2980b9"), ("fds", "open fds", "#27ae60")]
+    width, height, pad = 720, 180, 40
+    xs = [s["updates"] for s in samples]
+    x0, x1 = min(xs), max(xs) or 1
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height * len(panels)}" font-family="sans-serif" font-size="11">']
+    for i, (key, label, color) in enumerate(panels):
+        top = i * height
+        ys = [s[key] for s in samples]
+        y0, y1 = min(ys), max(ys)
+        y1 = y1 if y1 > y0 else y0 + 1
+
+        def point(x, y):
+            px = pad + (x - x0) / max(1, x1 - x0) * (width - 2 * pad)
+            py = top + height - pad / 2 - (y - y0) / (y1 - y0) * (height - pad * 1.5)
+            return f"{px:.1f},{py:.1f}"
+
+        parts.append(f'<rect x="{pad}" y="{top + pad}" width="{width - 2 * pad}" height="{height - pad * 1.5}" fill="none" stroke="#ccc"/>')
+        parts.append(f'<text x="{pad}" y="{top + pad - 6}">{label}: {ys[0]} → {ys[-1]} (min {min(ys)}, max {max(ys)})</text>')
+        parts.append(f'<text x="{width - pad}" y="{top + height - 4}" text-anchor="end">{x1} updates</text>')
+        parts.append(f'<polyline fill="none" stroke="{color}" stroke-width="1.5" points="{" ".join(point(x, y) for x, y in zip(xs, ys))}"/>')
+    parts.append("</svg>")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(parts))
+
+
+def run_soak(args: argparse.Namespace) -> int:
+    """Start the fake Bot API, soak the bots against it and write the report; returns the exit status"""
+    os.makedirs(args.out, exist_ok=True)
+    random.seed(args.seed)
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_bot_api.py"), "--port", str(port)], stderr=subprocess.DEVNULL
+    )
+    workdir = tempfile.mkdtemp(prefix="soak-")
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        # settings are read at import time, so they go in before the bot modules load;
+        # the database, language file and backups live in the temporary directory
+        for key, value in {**SOAK_CONFIG, "BOT_API_SERVER": f"http://127.0.0.1:{port}"}.items():
+            setattr(config, key, value)
+        os.chdir(workdir)
+        tracemalloc.start(args.frames)
+        status = asyncio.run(Soak(args, f"http://127.0.0.1:{port}").run())
+    finally:
+        server.terminate()
+        server.wait()
+    print(f"Working directory: {workdir}; report in {args.out}")
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Soak both bots against a fake Bot API and track memory growth")
+    parser.add_argument("--updates", type=int, default=500_000, help="stop after this many updates")
+    parser.add_argument("--sample-every", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=5000, help="simulated user population")
+    parser.add_argument("--warmup", type=int, default=50_000, help="updates before the growth baseline; past the arrival of all users")
+    parser.add_argument("--wave", type=int, default=200, help="users per wave")
+    parser.add_argument("--returning", type=float, default=0.3, help="share of returning users per wave while users still arrive")
+    parser.add_argument("--pay-share", type=float, default=0.5)
+    # RSS also carries allocator high-water marks; the traced heap is the sharper leak signal
+    parser.add_argument("--budget-mb", type=float, default=50.0, help="max RSS growth per 100k updates")
+    parser.add_argument("--budget-traced-mb", type=float, default=10.0, help="max tracemalloc heap growth per 100k updates")
+    parser.add_argument("--budget-tasks", type=float, default=50)
+    parser.add_argument("--budget-fds", type=float, default=20)
+    parser.add_argument("--frames", type=int, default=1, help="tracemalloc traceback depth")
+    parser.add_argument("--out", default="soak_report")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    args.out = os.path.abspath(args.out)
+    sys.exit(run_soak(args))
+
@@ -0,0 +1,163 @@
+"""Shared fixtures: each storage backend on a fresh, empty database.
+
+SQLite runs on a file in the test's temporary directory. PostgreSQL runs
+when PG_TEST_DSN points at a server the tests may create databases on, or
+when pgserver is installed (`pip install pgserver` bundles a local server);
+otherwise the postgres cases are skipped.
+
+End-to-end tests run fake_bot_api.py (`fake_api`) and main.py processes
+(`start_node`) on the backend's database.
+"""
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import repository  # noqa: E402
+
+BACKEND_NAMES = list(repository.BACKENDS)
+
+
+@pytest.fixture(scope="session")
+def postgres_dsn(tmp_path_factory):
+    """DSN of a PostgreSQL server the tests may create databases on"""
+    dsn = os.environ.get("PG_TEST_DSN")
+    if dsn:
+        return dsn
+    try:
+        import pgserver
+    except ImportError:
+        pytest.skip("PostgreSQL: set PG_TEST_DSN or install pgserver")
+    return pgserver.get_server(str(tmp_path_factory.mktemp("pgdata")), cleanup_mode="stop").get_uri()
+
+
+async def _admin(dsn: str, statement: str):
+    import asyncpg
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(statement)
+    finally:
+        await conn.close()
+
+
+@pytest.fixture(params=BACKEND_NAMES)
+def backend(request, tmp_path, monkeypatch):
+    """A storage backend module pointed at an empty database of its own"""
+    module = repository.load_backend(request.param)
+    monkeypatch.setattr(module, "_schema_ready", False)
+    if request.param == "sqlite":
+        monkeypatch.setattr(module, "DATABASE_FILE", str(tmp_path / "bot_database.db"))
+        yield module
+        return
+    server = request.getfixturevalue("postgres_dsn")
+    name = f"test_{uuid.uuid4().hex[:12]}"
+    asyncio.run(_admin(server, f"CREATE DATABASE {name}"))
+    monkeypatch.setattr(module, "DATABASE_DSN", urlsplit(server)._replace(path=f"/{name}").geturl())
+    try:
+        yield module
+    finally:
+        asyncio.run(_admin(server, f"DROP DATABASE IF EXISTS {name} WITH (FORCE)"))
+
+
+@pytest.fixture
+def run(backend):
+    """run(body): await `body()` on a fresh event loop with the schema in place, then close the backend"""
+    def run_body(body):
+        async def main():
+            await backend.init_db()
+            try:
+                return await body()
+            finally:
+                await backend.close_db()
+        return asyncio.run(main())
+    return run_body
+
+
+# a bot process: config.py as deployed, with `settings` overriding it
+NODE_SCRIPT = """
+import asyncio, os, sys
+sys.path.insert(0, {root!r})
+os.chdir({workdir!r})
+import config
+for key, value in {settings!r}.items():
+    setattr(config, key, value)
+import main
+asyncio.run(main.main())
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _stop(process: subprocess.Popen):
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+@pytest.fixture
+def fake_api():
+    """URL of a fake_bot_api.py server running for the test"""
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "fake_bot_api.py"), "--port", str(port)], stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                server.kill()
+                raise
+            time.sleep(0.1)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait()
+
+
+@pytest.fixture
+def start_node(backend, tmp_path):
+    """start_node(settings) -> (process, log path): main.py on the backend's database, stopped after the test"""
+    started = []
+
+    def start(settings: dict):
+        settings = dict(settings)
+        if backend.__name__ == "pg_database":
+            settings.update(DATABASE_BACKEND="postgres", DATABASE_DSN=backend.DATABASE_DSN)
+        else:
+            # the nodes open bot_database.db in their working directory
+            assert os.path.dirname(backend.DATABASE_FILE) == str(tmp_path)
+        script = NODE_SCRIPT.format(root=ROOT, workdir=str(tmp_path), settings=settings)
+        path = tmp_path / f"node{len(started)}.log"
+        log = open(path, "w")
+        process = subprocess.Popen([sys.executable, "-c", script], stderr=log, stdout=subprocess.DEVNULL)
+        started.append((process, log))
+        return process, path
+
+    try:
+        yield start
+    finally:
+        for process, log in started:
+            _stop(process)
+            log.close()
@@ -0,0 +1,134 @@
+"""Leader failover between bot processes sharing one database.
+
+Starts NODES instances of main.py against fake_bot_api.py and one database.
+SIGKILLing the leader (a crash: the lease is not released) must hand the
+lease to exactly one survivor within the lease TTL, and the dead leader's
+fencing token can no longer claim expiries or reminders. SIGINT (a clean
+shutdown) must stop both bots, release the lease and let a standby take
+over within one heartbeat.
+"""
+import asyncio
+import signal
+import time
+
+NODES = 3
+LEADER_TTL = 3
+LEADER_HEARTBEAT = 0.5
+
+
+def _wait_until(check, timeout: float, interval: float = 0.1):
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.monotonic() > deadline:
+            raise AssertionError(f"timed out after {timeout}s")
+        time.sleep(interval)
+
+
+def _lease(db):
+    async def read():
+        try:
+            return await db.get_lease("scheduler")
+        finally:
+            await db.close_db()
+    lease = asyncio.run(read())
+    if lease is None:
+        return None
+    # holder is "host:pid:suffix"
+    return int(lease["holder"].split(":")[1]), lease["token"]
+
+
+def _start_cluster(backend, run, fake_api, start_node):
+    """NODES main.py processes; returns ({pid: (process, log path)}, leader pid, token)"""
+    # schema first, as a deployment would, so the nodes start on a migrated database
+    run(lambda: asyncio.sleep(0))
+    settings = {
+        "BOT_API_SERVER": fake_api,
+        "LEADER_LEASE_TTL": LEADER_TTL,
+        "LEADER_HEARTBEAT": LEADER_HEARTBEAT,
+        "LOG_LEVEL": "INFO",
+        # the leader's own jobs must not touch the users this test seeds
+        "EXPIRY_CHECK_INTERVAL": 3600,
+        "REMINDER_OFFSETS": [60],
+    }
+    nodes = {}
+    for _ in range(NODES):
+        process, log = start_node(settings)
+        nodes[process.pid] = (process, log)
+
+    leader, token = _wait_until(lambda: _lease(backend), timeout=60)
+    assert leader in nodes
+    # every node is up and heartbeating, and the lease has not moved
+    _wait_until(lambda: all("Leader election started" in path.read_text() for _, path in nodes.values()), timeout=60)
+    time.sleep(4 * LEADER_HEARTBEAT)
+    assert _lease(backend) == (leader, token)
+    return nodes, leader, token
+
+
+def _new_holder(backend, leader):
+    return _wait_until(
+        lambda: (lease := _lease(backend)) and lease[0] != leader and lease, timeout=LEADER_TTL + 10, interval=0.05
+    )
+
+
+def test_one_survivor_takes_over_and_fences_out_the_dead_leader(backend, run, fake_api, start_node):
+    nodes, leader, token = _start_cluster(backend, run, fake_api, start_node)
+    nodes[leader][0].kill()
+    killed_at = time.monotonic()
+    nodes[leader][0].wait()
+
+    # the dead leader renewed at most LEADER_HEARTBEAT before dying, so its lease
+    # runs out within LEADER_TTL; a standby notices at its next heartbeat
+    successor, new_token = _new_holder(backend, leader)
+    took_over = time.monotonic() - killed_at
+    assert took_over <= LEADER_TTL + LEADER_HEARTBEAT + 0.5, f"takeover took {took_over:.2f}s"
+    survivors = [pid for pid in nodes if pid != leader]
+    assert successor in survivors
+    assert new_token == token + 1
+
+    # exactly one survivor took over, and nobody takes it from it afterwards
+    time.sleep(LEADER_TTL)
+    assert _lease(backend) == (successor, new_token)
+    assert all(nodes[pid][0].poll() is None for pid in survivors)
+    elected = [pid for pid in survivors if "Became leader" in nodes[pid][1].read_text()]
+    assert elected == [successor]
+
+    async def fenced_writes():
+        await backend.activate_user_subscription(900, "expired", None, 1, "seconds")
+        await backend.activate_user_subscription(901, "due", None, 30, "minutes")
+        await asyncio.sleep(1.1)
+        stale, current = ("scheduler", token), ("scheduler", new_token)
+        rejected = (
+            await backend.deactivate_expired_subscriptions(fence=stale),
+            await backend.claim_due_reminders(3600, 0, fence=stale),
+            (await backend.get_user_subscription(900))["is_active"],
+        )
+        accepted = (
+            await backend.deactivate_expired_subscriptions(fence=current),
+            [row["user_id"] for row in await backend.claim_due_reminders(3600, 0, fence=current)],
+        )
+        return rejected, accepted
+
+    rejected, accepted = run(fenced_writes)
+    assert rejected == ([], [], 1)
+    assert accepted == ([900], [901])
+
+
+def test_shutdown_releases_the_lease_to_a_standby(backend, run, fake_api, start_node):
+    nodes, leader, token = _start_cluster(backend, run, fake_api, start_node)
+    process, log = nodes[leader]
+    process.send_signal(signal.SIGINT)
+    process.wait(10)
+    exited_at = time.monotonic()
+    assert process.returncode == 0
+    # both dispatchers stopped, not just the one whose signal handler won
+    assert log.read_text().count("Polling stopped for bot") == 2
+
+    # released rather than left to expire: a standby takes it at its next heartbeat
+    successor, new_token = _new_holder(backend, leader)
+    took_over = time.monotonic() - exited_at
+    assert took_over <= LEADER_HEARTBEAT + 0.5, f"takeover took {took_over:.2f}s"
+    assert successor in nodes and successor != leader
+    assert new_token == token + 1
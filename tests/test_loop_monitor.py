@@ -0,0 +1,37 @@
+"""loop_monitor.no_blocking, the test helper for code that must not hold the event loop."""
+import asyncio
+import re
+import time
+
+import pytest
+
+from loop_monitor import no_blocking
+
+
+def test_awaiting_does_not_count_as_blocking():
+    async def body():
+        async with no_blocking(50) as probe:
+            for _ in range(20):
+                await asyncio.sleep(0.01)
+        return probe
+
+    probe = asyncio.run(body())
+    assert probe.stall_count == 0
+    assert probe.samples
+
+
+def test_a_blocking_call_is_reported_with_its_full_duration_and_stack():
+    async def body():
+        probe = None
+        with pytest.raises(AssertionError) as failure:
+            async with no_blocking(50) as probe:
+                time.sleep(0.2)
+        return probe, str(failure.value)
+
+    probe, message = asyncio.run(body())
+    # measured when the loop came back, not when the watchdog first noticed
+    (stall,) = probe.stalls
+    assert 180 <= stall["blocked_ms"] < 400
+    blocked_ms = float(re.match(r"event loop blocked for ([\d.]+)ms \(limit 50ms\)", message).group(1))
+    assert blocked_ms == stall["blocked_ms"]
+    assert "time.sleep(0.2)" in message
@@ -0,0 +1,142 @@
+"""Telegram Payments end to end: main.py against fake_bot_api.py.
+
+A user picks a service, gets an invoice and pays it; fake_bot_api.py sends
+the pre_checkout_query and then the successful_payment, several times over
+like a Telegram redelivery. The subscription, payment and revenue are
+checked in the database and the invite and join-request approval in the
+calls the bots made.
+"""
+import json
+import time
+import urllib.request
+from datetime import datetime, timedelta
+
+import config
+
+PRICE = 100.0
+PAYER, CHEAPSKATE, STRANGER = 701, 702, 703
+
+
+def _wait_until(check, timeout: float = 20, interval: float = 0.1):
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.monotonic() > deadline:
+            raise AssertionError(f"timed out after {timeout}s")
+        time.sleep(interval)
+
+
+def _post(url: str, body: dict):
+    request = urllib.request.Request(url, json.dumps(body).encode(), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)
+
+
+def _get(url: str):
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return json.load(response)
+
+
+def _calls(fake_api: str, token: str, method: str, chat_id: int):
+    calls = _get(f"{fake_api}/_fake/{token}/calls?method={method}")
+    return [call["params"] for call in calls if call["params"].get("chat_id") == chat_id]
+
+
+def _end(value) -> datetime:
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+async def _payment_rows(backend, user_id: int) -> int:
+    if backend.__name__ == "pg_database":
+        return (await backend._fetchrow("SELECT COUNT(*) FROM payments WHERE user_id = $1", user_id))[0]
+    async with backend._read() as db:
+        cursor = await db.execute("SELECT COUNT(*) FROM payments WHERE user_id = ?", (user_id,))
+        return (await cursor.fetchone())[0]
+
+
+def _start_bot(run, backend, fake_api, start_node):
+    """Payments enabled, one service; returns its id and the bot's log once both bots are polling"""
+    service_id = run(lambda: backend.add_service("Month", 30, PRICE))
+    _, log = start_node({
+        "BOT_API_SERVER": fake_api,
+        "PAYMENT_PROVIDER_TOKEN": "fake-provider",
+        "PAYMENT_CURRENCY": "RUB",
+        "LOG_LEVEL": "INFO",
+        "EXPIRY_CHECK_INTERVAL": 3600,
+    })
+    _wait_until(lambda: "All systems running" in log.read_text(), timeout=60)
+    for token in (config.ADMIN_BOT_TOKEN, config.USER_BOT_TOKEN):
+        _wait_until(lambda: _get(f"{fake_api}/_fake/{token}/stats")["calls"].get("getUpdates"))
+    return service_id, log
+
+
+def _invoice(fake_api: str, user_id: int, service_id: int) -> dict:
+    _post(f"{fake_api}/_fake/{config.USER_BOT_TOKEN}/callback", {"user_id": user_id, "data": f"service_{service_id}"})
+    return _wait_until(lambda: _calls(fake_api, config.USER_BOT_TOKEN, "sendInvoice", user_id))[-1]
+
+
+def test_payment_activates_once_however_often_it_is_delivered(backend, run, fake_api, start_node):
+    service_id, log = _start_bot(run, backend, fake_api, start_node)
+    invoice = _invoice(fake_api, PAYER, service_id)
+    assert invoice["currency"] == "RUB"
+    assert [price["amount"] for price in invoice["prices"]] == [10000]
+
+    # Telegram delivers the same successful_payment three times
+    paid = _post(f"{fake_api}/_fake/{config.USER_BOT_TOKEN}/pay", {"user_id": PAYER, "deliveries": 3})
+    assert paid["ok"], paid
+    activated = _wait_until(lambda: [
+        params for params in _calls(fake_api, config.USER_BOT_TOKEN, "sendMessage", PAYER)
+        if "Подписка активирована" in params["text"]
+    ])
+    # the invite carries the channel's join-request link
+    assert "https://t.me/+fake" in json.dumps(activated[0]["reply_markup"])
+    # the other two deliveries are recognised and skipped
+    _wait_until(lambda: log.read_text().count("Повторная доставка оплаты") == 2)
+
+    # an active subscriber's join request is approved, a stranger's declined
+    for user_id in (PAYER, STRANGER):
+        _post(f"{fake_api}/_fake/{config.ADMIN_BOT_TOKEN}/batch", {
+            "updates": [{"user_id": user_id, "join_chat_id": config.PRIVATE_CHANNEL_ID}]
+        })
+    approved = _wait_until(lambda: _calls(fake_api, config.ADMIN_BOT_TOKEN, "approveChatJoinRequest", config.PRIVATE_CHANNEL_ID))
+    declined = _wait_until(lambda: _calls(fake_api, config.ADMIN_BOT_TOKEN, "declineChatJoinRequest", config.PRIVATE_CHANNEL_ID))
+    assert [params["user_id"] for params in approved] == [PAYER]
+    assert [params["user_id"] for params in declined] == [STRANGER]
+
+    # the redeliveries changed nothing: one invite, one admin notice, one extension
+    assert len(activated) == 1
+    assert len(_calls(fake_api, config.USER_BOT_TOKEN, "sendMessage", PAYER)) == 1
+    notices = [
+        params for admin_id in config.ADMIN_USER_IDS
+        for params in _calls(fake_api, config.ADMIN_BOT_TOKEN, "sendMessage", admin_id)
+        if "Оплата" in params["text"]
+    ]
+    assert len(notices) == len(config.ADMIN_USER_IDS)
+
+    async def stored():
+        subscription = await backend.get_user_subscription(PAYER)
+        revenue = (await backend.get_statistics())["revenue"]
+        return subscription, await _payment_rows(backend, PAYER), revenue
+
+    subscription, payments, revenue = run(stored)
+    assert subscription["is_active"] == 1
+    assert abs(_end(subscription["subscription_end"]) - (datetime.now() + timedelta(days=30))) < timedelta(minutes=1)
+    assert payments == 1
+    assert [(row["service_id"], row["purchases"], row["amount"]) for row in revenue] == [(service_id, 1, PRICE)]
+
+
+def test_checkout_with_a_different_amount_is_rejected(backend, run, fake_api, start_node):
+    service_id, _ = _start_bot(run, backend, fake_api, start_node)
+    _invoice(fake_api, CHEAPSKATE, service_id)
+
+    paid = _post(f"{fake_api}/_fake/{config.USER_BOT_TOKEN}/pay", {"user_id": CHEAPSKATE, "total_amount": 100})
+    assert paid == {"ok": False, "error": "Цена или услуга изменились. Откройте покупку заново через /start."}
+
+    async def stored():
+        return await backend.get_user_subscription(CHEAPSKATE), await _payment_rows(backend, CHEAPSKATE)
+
+    subscription, payments = run(stored)
+    assert subscription is None or not subscription["is_active"]
+    assert payments == 0
@@ -0,0 +1,181 @@
+"""The storage contract from repository.py, checked against every backend.
+
+Each test runs once per backend (see conftest.py) with the same calls and
+the same expected results, so the SQLite and PostgreSQL implementations
+cannot drift apart.
+"""
+import asyncio
+import inspect
+from datetime import datetime, timedelta
+
+import pytest
+
+import repository
+
+
+def _end(value) -> datetime:
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+def _close(actual, expected, slack=timedelta(minutes=1)):
+    return abs(_end(actual) - expected) < slack
+
+
+def test_backends_share_signatures_and_constants():
+    sqlite, *others = [repository.load_backend(name) for name in repository.BACKENDS]
+    for other in others:
+        for attr in repository.INTERFACE:
+            expected, actual = getattr(sqlite, attr), getattr(other, attr)
+            if attr == "get_schema_version":
+                # takes the backend's own connection object
+                continue
+            if callable(expected):
+                assert inspect.signature(actual) == inspect.signature(expected), attr
+            else:
+                assert actual == expected, attr
+
+
+def test_approve_purchases_is_compare_and_set(backend, run):
+    async def body():
+        service_id = await backend.add_service("Month", 30, 100.0)
+        purchase_id, created = await backend.add_pending_purchase(1, "alice", None, service_id)
+        assert created
+        # a second request for the same service returns the open one
+        assert await backend.add_pending_purchase(1, "alice", None, service_id) == (purchase_id, False)
+
+        # two admins approving at once: exactly one extends the subscription
+        first, second = await asyncio.gather(
+            backend.approve_purchases([purchase_id]), backend.approve_purchases([purchase_id, purchase_id])
+        )
+        approved = first + second
+        assert [item["purchase_id"] for item in approved] == [purchase_id]
+        assert await backend.approve_purchases([purchase_id]) == []
+        assert await backend.reject_purchase(purchase_id) is None
+        assert (await backend.get_pending_purchase(purchase_id))["status"] == "approved"
+
+        subscription = await backend.get_user_subscription(1)
+        assert subscription["is_active"] == 1
+        assert _close(subscription["subscription_end"], datetime.now() + timedelta(days=30))
+        assert _end(subscription["subscription_end"]) == _end(approved[0]["subscription_end"])
+    run(body)
+
+
+def test_duplicate_payment_is_a_no_op(backend, run):
+    async def body():
+        service_id = await backend.add_service("Week", 7, 50.0)
+        payment = await backend.record_payment("charge-1", "provider-1", 2, "bob", service_id, "RUB", 5000)
+        assert payment["service_name"] == "Week"
+        assert _close(payment["subscription_end"], datetime.now() + timedelta(days=7))
+
+        # Telegram redelivers the same successful_payment, sequentially and concurrently
+        again = await asyncio.gather(*(
+            backend.record_payment("charge-1", "provider-1", 2, "bob", service_id, "RUB", 5000) for _ in range(3)
+        ))
+        assert again == [None, None, None]
+        subscription = await backend.get_user_subscription(2)
+        assert _end(subscription["subscription_end"]) == _end(payment["subscription_end"])
+
+        # a different charge extends from the current end
+        second = await backend.record_payment("charge-2", None, 2, "bob", service_id, "RUB", 5000)
+        assert _close(second["subscription_end"], _end(payment["subscription_end"]) + timedelta(days=7))
+    run(body)
+
+
+def test_concurrent_extensions_add_up(backend, run):
+    async def body():
+        await asyncio.gather(*(backend.activate_user_subscription(3, "carol", None, 1, "days") for _ in range(10)))
+        subscription = await backend.get_user_subscription(3)
+        assert _close(subscription["subscription_end"], datetime.now() + timedelta(days=10))
+
+        # a running subscription is extended from its end, an expired one from now
+        await backend.activate_user_subscription(4, "dave", None, 1, "seconds")
+        assert _close(await backend.activate_user_subscription(4, "dave", None, 1, "days"), datetime.now() + timedelta(days=1))
+        await backend.activate_user_subscription(5, "erin", None, 1, "seconds")
+        await asyncio.sleep(1.1)
+        assert _close(await backend.activate_user_subscription(5, "erin", None, 30, "minutes"), datetime.now() + timedelta(minutes=30))
+    run(body)
+
+
+def test_bulk_update_subscriptions(backend, run):
+    async def body():
+        await backend.activate_user_subscription(5, "erin", None, 2, "days")
+        await backend.activate_user_subscription(6, "frank", None, 2, "days")
+        new_ends = await backend.bulk_update_subscriptions(
+            [(5, 1, "days"), (5, 1, "days"), (7, 90, "minutes"), (8, 3, "days")], [6]
+        )
+        assert set(new_ends) == {5, 7, 8}
+        now = datetime.now()
+        assert _close(new_ends[5], now + timedelta(days=4))
+        assert _close(new_ends[7], now + timedelta(minutes=90))
+        assert _close(new_ends[8], now + timedelta(days=3))
+        for user_id, end in new_ends.items():
+            subscription = await backend.get_user_subscription(user_id)
+            assert subscription["is_active"] == 1
+            assert _end(subscription["subscription_end"]) == end
+        assert (await backend.get_user_subscription(6))["is_active"] == 0
+    run(body)
+
+
+def test_archive_and_restore(backend, run):
+    async def body():
+        await backend.activate_user_subscription(10, "active", None, 5, "days")
+        for user_id in (11, 12, 13):
+            await backend.upsert_user_profile(user_id, f"idle{user_id}", None, None)
+        service_id = await backend.add_service("Month", 30, 100.0)
+        await backend.add_pending_purchase(13, "idle13", None, service_id)
+
+        # inactive, unsubscribed and without an open request: 11 and 12 only
+        assert await backend.archive_inactive_users(0) == 2
+        listed = {row["user_id"] for row in await backend.get_users_paginated(0, 50)}
+        assert listed == {10, 13}
+        with_archive = {row["user_id"] for row in await backend.get_users_paginated(0, 50, include_archived=True)}
+        assert with_archive == {10, 11, 12, 13}
+        assert await backend.count_segment("all") == 4
+        assert await backend.get_segment_user_ids("never_purchased") == [11, 12, 13]
+        exported = [row["user_id"] async for chunk in backend.iter_users_export(chunk_size=2) for row in chunk]
+        assert exported == [10, 11, 12, 13]
+
+        # reading an archived user brings them back to the hot tier
+        user = await backend.get_user(11)
+        assert user["username"] == "idle11"
+        assert {row["user_id"] for row in await backend.get_users_paginated(0, 50)} == {10, 11, 13}
+        # so does a purchase
+        await backend.activate_user_subscription(12, None, None, 1, "days")
+        subscription = await backend.get_user_subscription(12)
+        assert subscription["is_active"] == 1
+        # restored but still idle: archived again on the next pass, the subscriber is not
+        assert await backend.archive_inactive_users(0) == 1
+        assert await backend.count_segment("all") == 4
+    run(body)
+
+
+def test_lease_fencing(backend, run):
+    async def body():
+        first = await backend.acquire_lease("scheduler", "node-a", 30)
+        assert await backend.acquire_lease("scheduler", "node-b", 30) is None
+        assert await backend.acquire_lease("scheduler", "node-a", 30) == first
+
+        # a stale leader: its lease ran out and another node took over
+        assert await backend.acquire_lease("scheduler", "node-a", 0.2) == first
+        await asyncio.sleep(0.3)
+        second = await backend.acquire_lease("scheduler", "node-b", 30)
+        assert second == first + 1
+        assert (await backend.get_lease("scheduler"))["holder"] == "node-b"
+
+        await backend.activate_user_subscription(20, "expired", None, 1, "seconds")
+        await backend.activate_user_subscription(21, "due", None, 30, "minutes")
+        await asyncio.sleep(1.1)
+        stale, current = ("scheduler", first), ("scheduler", second)
+
+        assert await backend.deactivate_expired_subscriptions(fence=stale) == []
+        assert (await backend.get_user_subscription(20))["is_active"] == 1
+        assert await backend.claim_due_reminders(3600, 0, fence=stale) == []
+
+        assert await backend.deactivate_expired_subscriptions(fence=current) == [20]
+        claimed = await backend.claim_due_reminders(3600, 0, fence=current)
+        assert [row["user_id"] for row in claimed] == [21]
+
+        # releasing hands the lease over at once, with a new token
+        await backend.release_lease("scheduler", "node-b")
+        assert await backend.acquire_lease("scheduler", "node-a", 30) == second + 1
+    run(body)
@@ -0,0 +1,116 @@
+"""Per-user anti-flood middleware for aiogram dispatchers.
+
+Each user has a token bucket (capacity `burst`, refilled at `rate` tokens per
+second); every update costs tokens according to `costs` (matched by prefix
+of the callback data or message text). Repeated taps on the same callback
+button within `duplicate_window` seconds are coalesced into one; successful
+payment messages always pass. Both maps are LRU-bounded, so memory does not
+grow with the number of users seen.
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+logger = logging.getLogger(__name__)
+
+# name -> middleware, for diagnostics
+registry: Dict[str, "ThrottlingMiddleware"] = {}
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(
+        self,
+        name: str,
+        rate: float = 1.0,
+        burst: float = 5.0,
+        costs: Optional[Dict[str, float]] = None,
+        duplicate_window: float = 1.0,
+        max_users: int = 100_000,
+    ):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.costs = costs or {}
+        self.duplicate_window = duplicate_window
+        self.max_users = max_users
+        # user_id -> (tokens, last refill timestamp)
+        self._buckets: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()
+        # (user_id, callback data) -> timestamp of the last accepted tap
+        self._recent_taps: "OrderedDict[Tuple[int, str], float]" = OrderedDict()
+        self.metrics = {"passed": 0, "throttled": 0, "coalesced": 0}
+        registry[name] = self
+
+    def cost_for(self, event: TelegramObject) -> float:
+        if isinstance(event, CallbackQuery):
+            key = event.data or ""
+        elif isinstance(event, Message):
+            key = event.text or ""
+        else:
+            return 1
+        for prefix, cost in self.costs.items():
+            if key.startswith(prefix):
+                return cost
+        return 1
+
+    def _take(self, user_id: int, cost: float, now: float) -> bool:
+        tokens, last = self._buckets.pop(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[user_id] = (tokens, now)
+        if len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    def _is_duplicate(self, user_id: int, data: str, now: float) -> bool:
+        # entries are kept in time order, so expired ones sit at the front
+        while self._recent_taps:
+            key, ts = next(iter(self._recent_taps.items()))
+            if now - ts < self.duplicate_window and len(self._recent_taps) < self.max_users:
+                break
+            self._recent_taps.popitem(last=False)
+        key = (user_id, data)
+        if key in self._recent_taps:
+            return True
+        self._recent_taps[key] = now
+        return False
+
+    def snapshot(self) -> Dict[str, int]:
+        return {**self.metrics, "tracked_users": len(self._buckets)}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        # Telegram does not redeliver a payment confirmation, so it is never dropped
+        if user is None or (isinstance(event, Message) and event.successful_payment):
+            return await handler(event, data)
+        now = time.monotonic()
+        is_callback = isinstance(event, CallbackQuery)
+        if is_callback and self._is_duplicate(user.id, event.data or "", now):
+            self.metrics["coalesced"] += 1
+            await self._answer(event)
+            return None
+        if not self._take(user.id, self.cost_for(event), now):
+            self.metrics["throttled"] += 1
+            if is_callback:
+                await self._answer(event, "⏳")
+            return None
+        self.metrics["passed"] += 1
+        return await handler(event, data)
+
+    @staticmethod
+    async def _answer(callback: CallbackQuery, text: Optional[str] = None):
+        # stop the client-side spinner; failures here are irrelevant
+        try:
+            await callback.answer(text)
+        except Exception:
+            pass
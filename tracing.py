@@ -0,0 +1,260 @@
+"""Lightweight per-update tracing.
+
+With TRACE_ENABLED, TracingMiddleware opens a trace for every update and
+keeps it in a contextvar; storage calls (every coroutine of the storage
+backend) and outgoing Bot API requests are recorded as child spans. Traces
+slower than TRACE_SLOW_MS are appended to TRACE_FILE as JSON lines, from a
+worker thread. When tracing is disabled nothing is registered or wrapped,
+so it costs nothing.
+
+Summarise the file with:
+
+    python tracing.py [TRACE_FILE] [--top N]
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from types import ModuleType
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import TelegramObject, Update
+
+import config
+
+logger = logging.getLogger(__name__)
+
+TRACE_ENABLED = getattr(config, "TRACE_ENABLED", False)
+TRACE_SLOW_MS = getattr(config, "TRACE_SLOW_MS", 1000)
+TRACE_FILE = getattr(config, "TRACE_FILE", "traces.jsonl")
+# spans kept per trace; a runaway handler cannot grow a trace without bound
+MAX_SPANS = 200
+
+_current: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+_file_lock = threading.Lock()
+
+stats = {"traces": 0, "slow": 0}
+
+
+class Trace:
+    __slots__ = ("name", "update_id", "user_id", "started", "spans", "dropped")
+
+    def __init__(self, name: str, update_id: Optional[int], user_id: Optional[int]):
+        self.name = name
+        self.update_id = update_id
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.spans: List[list] = []
+        self.dropped = 0
+
+    def to_dict(self, duration_ms: float, error: Optional[str]) -> Dict[str, Any]:
+        return {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "name": self.name,
+            "update_id": self.update_id,
+            "user_id": self.user_id,
+            "duration_ms": round(duration_ms, 2),
+            "error": error,
+            "spans": [
+                {"name": name, "start_ms": round(start, 2), "duration_ms": round(duration, 2), "error": err}
+                for name, start, duration, err in self.spans
+            ],
+            "dropped_spans": self.dropped,
+        }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "started")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        if len(trace.spans) >= MAX_SPANS:
+            trace.dropped += 1
+            return False
+        now = time.perf_counter()
+        trace.spans.append([
+            self.name,
+            (self.started - trace.started) * 1000,
+            (now - self.started) * 1000,
+            exc_type.__name__ if exc_type else None,
+        ])
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str):
+    """Context manager recording a child span of the current trace (no-op outside one)"""
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name)
+
+
+def _traced(name: str, func: Callable[..., Awaitable[Any]]):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        trace = _current.get()
+        if trace is None:
+            return await func(*args, **kwargs)
+        with _Span(trace, name):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+def instrument_module(module: ModuleType, names: Iterable[str], prefix: str = "db"):
+    """Replace the module's coroutine functions in `names` with span-recording wrappers"""
+    for name in names:
+        func = getattr(module, name, None)
+        if inspect.iscoroutinefunction(func):
+            setattr(module, name, _traced(f"{prefix}.{name}", func))
+
+
+class _RequestSpanMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot: Bot, method):
+        trace = _current.get()
+        if trace is None:
+            return await make_request(bot, method)
+        with _Span(trace, f"api.{method.__api_method__}"):
+            return await make_request(bot, method)
+
+
+def instrument_session(session: BaseSession) -> BaseSession:
+    """Record Bot API requests sent through the session as spans (when tracing is enabled)"""
+    if TRACE_ENABLED:
+        session.middleware(_RequestSpanMiddleware())
+    return session
+
+
+def _trace_name(update: Update) -> str:
+    event = update.event
+    detail = ""
+    if update.callback_query is not None and update.callback_query.data:
+        # callback data usually ends with ids: keep the stable prefix
+        detail = update.callback_query.data.rstrip("0123456789-_")
+    elif update.message is not None and update.message.text:
+        detail = update.message.text.split()[0] if update.message.text.startswith("/") else "text"
+    elif update.message is not None:
+        detail = update.message.content_type
+    name = update.event_type if event is not None else "update"
+    return f"{name}:{detail}" if detail else name
+
+
+def _append(line: str):
+    try:
+        with _file_lock:
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        logger.warning("Failed to write trace: %s", e)
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Outer update middleware: one trace per update, slow ones written to TRACE_FILE"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = UserContextMiddleware.resolve_event_context(event)
+        trace = Trace(_trace_name(event), event.update_id, context.user.id if context.user else None)
+        token = _current.set(trace)
+        error = None
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            duration_ms = (time.perf_counter() - trace.started) * 1000
+            stats["traces"] += 1
+            if duration_ms >= TRACE_SLOW_MS:
+                stats["slow"] += 1
+                line = json.dumps(trace.to_dict(duration_ms, error), ensure_ascii=False)
+                asyncio.get_running_loop().run_in_executor(None, _append, line)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(path: str, top: int = 10) -> str:
+    """Text report over a slow-trace file: per update type, per span, slowest traces"""
+    traces = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                traces.append(json.loads(line))
+    if not traces:
+        return "no traces"
+    by_name: Dict[str, List[float]] = defaultdict(list)
+    span_total: Dict[str, float] = defaultdict(float)
+    span_count: Dict[str, int] = defaultdict(int)
+    total = 0.0
+    for trace in traces:
+        by_name[trace["name"]].append(trace["duration_ms"])
+        total += trace["duration_ms"]
+        for s in trace["spans"]:
+            span_total[s["name"]] += s["duration_ms"]
+            span_count[s["name"]] += 1
+
+    lines = [f"{len(traces)} slow traces, {total / 1000:.1f}s in total", "", "By update:"]
+    for name, values in sorted(by_name.items(), key=lambda item: -sum(item[1])):
+        lines.append(
+            f"  {name:<40} n={len(values):<5} p50={_percentile(values, 0.5):8.0f}ms "
+            f"p95={_percentile(values, 0.95):8.0f}ms max={max(values):8.0f}ms"
+        )
+    lines += ["", "By span (share of slow-trace time):"]
+    for name, spent in sorted(span_total.items(), key=lambda item: -item[1])[:top * 2]:
+        lines.append(
+            f"  {name:<40} n={span_count[name]:<5} total={spent:9.0f}ms "
+            f"avg={spent / span_count[name]:7.1f}ms {spent / total * 100:5.1f}%"
+        )
+    lines += ["", f"Slowest {top}:"]
+    for trace in sorted(traces, key=lambda t: -t["duration_ms"])[:top]:
+        spans = ", ".join(f"{s['name']} {s['duration_ms']:.0f}ms" for s in sorted(trace["spans"], key=lambda s: -s["duration_ms"])[:3])
+        lines.append(f"  {trace['ts']} {trace['name']} user={trace['user_id']} {trace['duration_ms']:.0f}ms: {spans}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise slow update traces")
+    parser.add_argument("file", nargs="?", default=TRACE_FILE)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+    print(summarize(args.file, args.top))
@@ -0,0 +1,123 @@
+"""Per-user ordered, cross-user parallel update processing.
+
+Polling hands every update to its own task, so two quick taps from one user
+could run concurrently and race on FSM state. OrderedDispatcher routes each
+update through an UpdateScheduler lane keyed by the sender (or chat):
+updates of one lane run strictly one after another in arrival order, while
+different lanes run in parallel up to `max_concurrency`. The lane sits in
+front of the whole middleware chain, so FSM state is read only after the
+previous update of the same user has finished. A lane is dropped as soon as
+its last queued update completes, so idle users cost nothing.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+# name -> scheduler, for diagnostics
+registry: Dict[str, "UpdateScheduler"] = {}
+
+
+class _Lane:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        # asyncio.Lock wakes waiters in FIFO order, which keeps the lane ordered
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class UpdateScheduler:
+    def __init__(self, name: str, max_concurrency: int = 64):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._lanes: Dict[Hashable, _Lane] = {}
+        self.running = 0
+        self.processed = 0
+        self.peak_depth = 0
+        self.peak_lanes = 0
+        self.last_activity = time.monotonic()
+        registry[name] = self
+
+    async def run(self, key: Optional[Hashable], job: Callable[[], Awaitable[Any]]) -> Any:
+        """Run `job` after every earlier job with the same key; `None` means unordered"""
+        if key is None:
+            return await self._run_slot(job)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane()
+            self.peak_lanes = max(self.peak_lanes, len(self._lanes))
+        lane.depth += 1
+        self.peak_depth = max(self.peak_depth, lane.depth)
+        try:
+            async with lane.lock:
+                return await self._run_slot(job)
+        finally:
+            lane.depth -= 1
+            if lane.depth == 0 and self._lanes.get(key) is lane:
+                del self._lanes[key]
+
+    async def _run_slot(self, job: Callable[[], Awaitable[Any]]) -> Any:
+        # lane lock first, global slot second: a user with a long backlog
+        # holds at most one slot while the rest of its updates wait
+        async with self._slots:
+            self.running += 1
+            try:
+                return await job()
+            finally:
+                self.running -= 1
+                self.processed += 1
+                self.last_activity = time.monotonic()
+
+    def idle_seconds(self) -> float:
+        """Seconds since the last update finished; 0 while any update is pending"""
+        if self.running or self._lanes:
+            return 0.0
+        return time.monotonic() - self.last_activity
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "lanes": len(self._lanes),
+            "queued": sum(lane.depth for lane in self._lanes.values()),
+            "running": self.running,
+            "max_depth": max((lane.depth for lane in self._lanes.values()), default=0),
+            "peak_depth": self.peak_depth,
+            "peak_lanes": self.peak_lanes,
+            "processed": self.processed,
+            "limit": self.max_concurrency,
+        }
+
+
+def update_key(update: Update) -> Optional[Hashable]:
+    """Lane for an update: its sender, otherwise its chat, otherwise none"""
+    if update.chat_member is not None:
+        # ordered per member: the sender is whoever changed it, for approved
+        # join requests the bot itself, which would put every member in one lane
+        return update.chat_member.new_chat_member.user.id
+    context = UserContextMiddleware.resolve_event_context(update)
+    if context.user is not None:
+        return context.user.id
+    if context.chat is not None:
+        return ("chat", context.chat.id)
+    return None
+
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher that feeds updates through an UpdateScheduler"""
+
+    def __init__(self, *args: Any, scheduler: UpdateScheduler, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        return await self.scheduler.run(
+            update_key(update),
+            lambda: super(OrderedDispatcher, self).feed_update(bot, update, **kwargs),
+        )
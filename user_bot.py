@@ -1,24 +1,26 @@
 # Полный исправленный user_bot.py — замените текущий файл этим содержимым
-import asyncio
 import json
 import logging
 import os
 from datetime import datetime
 from typing import Optional, Dict
 
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.enums import ParseMode
-from aiogram.client.default import DefaultBotProperties
+from aiogram import types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
 
+import bots
+import channels
 import config
-import database as db
+from fsm_storage import CompactMemoryStorage
+from log_pipeline import LogContextMiddleware
+import tracing
+from repository import backend as db
+from throttling import ThrottlingMiddleware
+from update_scheduler import OrderedDispatcher, UpdateScheduler
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Токены
@@ -27,18 +29,42 @@ ADMIN_BOT_TOKEN = getattr(config, "ADMIN_BOT_TOKEN", None)
 if USER_BOT_TOKEN is None or ADMIN_BOT_TOKEN is None:
     raise RuntimeError("USER_BOT_TOKEN и ADMIN_BOT_TOKEN должны быть заданы в config.py")
 
-# PRIVATE_CHANNEL_ID (опционально)
-try:
-    PRIVATE_CHANNEL_ID = int(config.PRIVATE_CHANNEL_ID) if config.PRIVATE_CHANNEL_ID is not None else None
-except Exception:
-    PRIVATE_CHANNEL_ID = None
-
-# Инициализация ботов (aiogram >=3.7)
-bot = Bot(token=USER_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-admin_bot = Bot(token=ADMIN_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+# Боты и общая HTTP-сессия — из реестра bots.py (один Bot на токен)
+get_bot = bots.user
+get_admin_bot = bots.admin
+
+
+def __getattr__(name: str):
+    # обратная совместимость: `from user_bot import bot`
+    if name == "bot":
+        return get_bot()
+    if name == "admin_bot":
+        return get_admin_bot()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+storage = CompactMemoryStorage()
+# Апдейты одного пользователя — строго по очереди, разных — параллельно до лимита
+dp = OrderedDispatcher(
+    storage=storage,
+    scheduler=UpdateScheduler("user_bot", getattr(config, "UPDATE_CONCURRENCY", 64)),
+)
+# update_id/user_id текущего апдейта попадают в каждую запись лога
+dp.update.outer_middleware(LogContextMiddleware())
+# Трассировка апдейтов (БД и Bot API как дочерние спаны), только если включена
+if tracing.TRACE_ENABLED:
+    dp.update.outer_middleware(tracing.TracingMiddleware())
+
+# Антифлуд: токен-бакет на пользователя + склейка повторных нажатий одной кнопки
+throttling = ThrottlingMiddleware(
+    "user_bot",
+    rate=getattr(config, "THROTTLE_RATE", 1.0),
+    burst=getattr(config, "THROTTLE_BURST", 5),
+    costs=getattr(config, "THROTTLE_COSTS", {}),
+    duplicate_window=getattr(config, "THROTTLE_DUPLICATE_WINDOW", 1.0),
+)
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
 
 # Файл с языковыми настройками (используется и admin_bot)
 LANG_FILE = "user_languages.json"
@@ -49,7 +75,7 @@ def load_langs() -> Dict[str, str]:
             with open(LANG_FILE, "r", encoding="utf-8") as f:
                 return json.load(f)
         except Exception as e:
-            logger.warning(f"Не удалось загрузить {LANG_FILE}: {e}")
+            logger.warning("Не удалось загрузить %s: %s", LANG_FILE, e)
     return {}
 
 def save_langs(m: Dict[str, str]):
@@ -57,9 +83,17 @@ def save_langs(m: Dict[str, str]):
         with open(LANG_FILE, "w", encoding="utf-8") as f:
             json.dump(m, f, ensure_ascii=False, indent=2)
     except Exception as e:
-        logger.warning(f"Не удалось сохранить {LANG_FILE}: {e}")
+        logger.warning("Не удалось сохранить %s: %s", LANG_FILE, e)
+
+# Языки читаются с диска при первом обращении, а не при импорте
+_user_langs: Optional[Dict[str, str]] = None
+
 
-user_langs = load_langs()
+def get_langs() -> Dict[str, str]:
+    global _user_langs
+    if _user_langs is None:
+        _user_langs = load_langs()
+    return _user_langs
 
 # Набор переводов (минимальный; можно расширить)
 translations = {
@@ -79,7 +113,11 @@ translations = {
         "cancel_done": "✅ Ваша подписка отменена. Доступ к каналу закрыт.",
         "choose_lang": "Выберите язык / Choose language / اختر اللغة / Tilni tanlang:",
         "lang_set": "Язык установлен: {lang}",
-        "no_admin_notify": "❗ Не удалось отправить уведомление админам. Проверьте ADMIN_USER_IDS."
+        "no_admin_notify": "❗ Не удалось отправить уведомление админам. Проверьте ADMIN_USER_IDS.",
+        "expiry_reminder": "⏰ <b>Подписка скоро закончится</b>\n\n📅 До: {date}\n\nПродлите заранее, чтобы не потерять доступ к каналу.",
+        "invoice_sent": "💳 Счёт на оплату отправлен ниже. Доступ откроется сразу после оплаты.",
+        "checkout_failed": "Цена или услуга изменились. Откройте покупку заново через /start.",
+        "payment_manual": "✅ Оплата получена. Администратор откроет доступ вручную в ближайшее время."
     },
     "en": {
         "welcome": "👋 <b>Welcome!</b>\n\nThis bot provides access to a private channel.\n\nChoose an action:",
@@ -97,7 +135,11 @@ translations = {
         "cancel_done": "✅ Your subscription has been cancelled. Channel access closed.",
         "choose_lang": "Выберите язык / Choose language / اختر اللغة / Tilni tanlang:",
         "lang_set": "Language set: {lang}",
-        "no_admin_notify": "❗ Failed to notify admins. Check ADMIN_USER_IDS."
+        "no_admin_notify": "❗ Failed to notify admins. Check ADMIN_USER_IDS.",
+        "expiry_reminder": "⏰ <b>Your subscription ends soon</b>\n\n📅 Until: {date}\n\nRenew in advance to keep channel access.",
+        "invoice_sent": "💳 The invoice is below. Access opens right after payment.",
+        "checkout_failed": "The price or plan has changed. Start the purchase again with /start.",
+        "payment_manual": "✅ Payment received. An admin will open access for you shortly."
     },
     "ar": {
         "welcome": "👋 <b>مرحباً!</b>\n\nهذا البوت يمنحك الوصول إلى القناة الخاصة.\n\nاختر إجراء:",
@@ -115,7 +157,11 @@ translations = {
         "cancel_done": "✅ تم إلغاء اشتراكك. تم إغلاق الوصول إلى القناة.",
         "choose_lang": "Выберите язык / Choose language / اختر اللغة / Tilni tanlang:",
         "lang_set": "تم ضبط اللغة: {lang}",
-        "no_admin_notify": "❗ فشل في إبلاغ المشرفين. تحقق من ADMIN_USER_IDS."
+        "no_admin_notify": "❗ فشل في إبلاغ المشرفين. تحقق من ADMIN_USER_IDS.",
+        "expiry_reminder": "⏰ <b>اشتراكك سينتهي قريباً</b>\n\n📅 حتى: {date}\n\nجدد مسبقاً للحفاظ على الوصول إلى القناة.",
+        "invoice_sent": "💳 الفاتورة أدناه. يُفتح الوصول فور الدفع.",
+        "checkout_failed": "تغيّر السعر أو الخدمة. ابدأ الشراء من جديد عبر /start.",
+        "payment_manual": "✅ تم استلام الدفع. سيفتح المشرف الوصول قريباً."
     },
     "uz": {
         "welcome": "👋 <b>Xush kelibsiz!</b>\n\nUshbu bot sizga xususiy kanalga kirish imkonini beradi.\n\nHarakatni tanlang:",
@@ -133,12 +179,16 @@ translations = {
         "cancel_done": "✅ Obunangiz bekor qilindi. Kanalga kirish yopildi.",
         "choose_lang": "Выберите язык / Choose language / اختر اللغة / Tilni tanlang:",
         "lang_set": "Til o'rnatildi: {lang}",
-        "no_admin_notify": "❗ Adminlarga xabar jo'natilmadi. ADMIN_USER_IDS ni tekshiring."
+        "no_admin_notify": "❗ Adminlarga xabar jo'natilmadi. ADMIN_USER_IDS ni tekshiring.",
+        "expiry_reminder": "⏰ <b>Obunangiz tez orada tugaydi</b>\n\n📅 Gacha: {date}\n\nKanalga kirishni saqlab qolish uchun oldindan yangilang.",
+        "invoice_sent": "💳 To'lov hisobi quyida. Kirish to'lovdan so'ng darhol ochiladi.",
+        "checkout_failed": "Narx yoki xizmat o'zgardi. Xaridni /start orqali qaytadan boshlang.",
+        "payment_manual": "✅ To'lov qabul qilindi. Admin tez orada kirishni ochadi."
     }
 }
 
 def get_user_lang(user_id: int) -> str:
-    code = user_langs.get(str(user_id))
+    code = get_langs().get(str(user_id))
     return code if code in translations else "ru"
 
 def tr(user_id: int, key: str, **kwargs) -> str:
@@ -185,8 +235,9 @@ async def set_language(callback: types.CallbackQuery):
     if code not in translations:
         await callback.answer("Unsupported language", show_alert=True)
         return
-    user_langs[str(callback.from_user.id)] = code
-    save_langs(user_langs)
+    get_langs()[str(callback.from_user.id)] = code
+    save_langs(get_langs())
+    await db.set_user_language(callback.from_user.id, code)
     await callback.answer()
     active = await _is_active(callback.from_user.id)
     await callback.message.edit_text(tr(callback.from_user.id, "lang_set", lang=code), reply_markup=get_main_keyboard(callback.from_user.id, active=active))
@@ -225,7 +276,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
     # save profile photo if possible
     photo_file_id = None
     try:
-        photos = await bot.get_user_profile_photos(user.id, limit=1)
+        photos = await get_bot().get_user_profile_photos(user.id, limit=1)
         if photos.total_count > 0:
             photo_file_id = photos.photos[0][-1].file_id
     except Exception:
@@ -237,7 +288,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
         logger.debug("upsert_user_profile failed (ignored)")
 
     # ask language if not set
-    if str(user.id) not in user_langs:
+    if str(user.id) not in get_langs():
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🇷🇺 Рус", callback_data="lang_ru"),
              InlineKeyboardButton(text="🇬🇧 En", callback_data="lang_en"),
@@ -252,12 +303,125 @@ async def cmd_start(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer(tr(user.id, "welcome"), reply_markup=get_main_keyboard(user.id, active=active))
 
+# PAYMENTS — Telegram Payments вместо заявки админам, если задан PAYMENT_PROVIDER_TOKEN.
+# Обработчики стоят до обработчиков по состояниям FSM, чтобы оплата не ушла в чужой хендлер.
+PAYMENT_PROVIDER_TOKEN = getattr(config, "PAYMENT_PROVIDER_TOKEN", None)
+PAYMENT_CURRENCY = getattr(config, "PAYMENT_CURRENCY", "RUB")
+PAYMENTS_ENABLED = PAYMENT_PROVIDER_TOKEN is not None
+
+
+def invoice_amount(price) -> int:
+    # Bot API принимает суммы в минимальных единицах валюты; у звёзд (XTR) дробной части нет
+    return int(round(float(price) * (1 if PAYMENT_CURRENCY == "XTR" else 100)))
+
+
+def invoice_payload(service_id: int, user_id: int) -> str:
+    return f"sub:{service_id}:{user_id}"
+
+
+def _payload_service_id(payload: str, user_id: int) -> Optional[int]:
+    try:
+        kind, service_id, payer_id = payload.split(":")
+        if kind == "sub" and int(payer_id) == user_id:
+            return int(service_id)
+    except ValueError:
+        pass
+    return None
+
+
+async def send_service_invoice(user_id: int, service: dict):
+    unit = service.get("duration_unit", "days")
+    unit_text = {"minutes": "минут", "days": "дней", "months": "месяцев"}.get(unit, "дней")
+    await get_bot().send_invoice(
+        chat_id=user_id,
+        title=service["name"][:32],
+        description=f"Доступ к приватному каналу на {service['duration_days']} {unit_text}",
+        payload=invoice_payload(service["id"], user_id),
+        provider_token=PAYMENT_PROVIDER_TOKEN,
+        currency=PAYMENT_CURRENCY,
+        prices=[LabeledPrice(label=service["name"][:32], amount=invoice_amount(service["price"]))],
+    )
+
+
+@dp.pre_checkout_query()
+async def pre_checkout(query: types.PreCheckoutQuery):
+    # Telegram ждёт ответа не дольше 10 секунд — только сверка услуги и суммы
+    service_id = _payload_service_id(query.invoice_payload, query.from_user.id)
+    try:
+        service = await db.get_service_by_id(service_id) if service_id is not None else None
+    except Exception:
+        service = None
+    if (
+        service is None
+        or query.currency != PAYMENT_CURRENCY
+        or query.total_amount != invoice_amount(service["price"])
+    ):
+        await query.answer(ok=False, error_message=tr(query.from_user.id, "checkout_failed"))
+        return
+    await query.answer(ok=True)
+
+
+async def _notify_admins_payment(text: str):
+    for admin_id in getattr(config, "ADMIN_USER_IDS", []) or []:
+        try:
+            await get_admin_bot().send_message(admin_id, text)
+        except Exception as e:
+            logger.warning(
+                "Не удалось уведомить админа %s об оплате: %s", admin_id, e,
+                extra={"sample": "payment_notify_failed", "user_id": admin_id},
+            )
+
+
+@dp.message(F.successful_payment)
+async def successful_payment(message: types.Message, state: FSMContext):
+    payment = message.successful_payment
+    user = message.from_user
+    service_id = _payload_service_id(payment.invoice_payload, user.id)
+    try:
+        # подписка и доход — одной транзакцией; повторная доставка того же charge_id ничего не меняет
+        result = await db.record_payment(
+            payment.telegram_payment_charge_id, payment.provider_payment_charge_id,
+            user.id, user.username, service_id, payment.currency, payment.total_amount,
+        )
+    except Exception as e:
+        logger.exception("Не удалось записать оплату %s", payment.telegram_payment_charge_id)
+        await _notify_admins_payment(
+            f"❗ <b>Оплата не записана</b>\n\n👤 @{user.username or 'user'} (ID {user.id})\n"
+            f"💳 {payment.telegram_payment_charge_id}\nОшибка: {e}"
+        )
+        await message.answer(tr(user.id, "payment_manual"))
+        return
+    if result is None:
+        logger.info("Повторная доставка оплаты %s — пропущена", payment.telegram_payment_charge_id)
+        return
+    await state.clear()
+    amount = f"{payment.total_amount / (1 if payment.currency == 'XTR' else 100):g} {payment.currency}"
+    if result["subscription_end"] is None:
+        await message.answer(tr(user.id, "payment_manual"))
+        await _notify_admins_payment(
+            f"❗ <b>Оплата за удалённую услугу</b>\n\n👤 @{user.username or 'user'} (ID {user.id})\n"
+            f"💰 {amount}\n💳 {payment.telegram_payment_charge_id}\nВыдайте доступ вручную."
+        )
+        return
+    try:
+        await channels.deliver_access(get_admin_bot(), get_bot(), user.id, result["subscription_end"], service_id)
+    except Exception as e:
+        logger.warning(
+            "Не удалось отправить доступ пользователю %s: %s", user.id, e,
+            extra={"sample": "invite_link_failed", "user_id": user.id},
+        )
+    await _notify_admins_payment(
+        f"💳 <b>Оплата</b>\n\n👤 @{user.username or 'user'} (ID {user.id})\n"
+        f"📦 {result['service_name']} — {amount}\n📅 До: {result['subscription_end']:%d.%m.%Y %H:%M}"
+    )
+
+
 # contact admin
 @dp.callback_query(F.data == "contact_admin")
-async def contact_admin_start(callback: types.CallbackQuery):
+async def contact_admin_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     await callback.message.edit_text(tr(callback.from_user.id, "contact_admin"))
-    await dp.current_state(user=callback.from_user.id).set_state(ContactAdmin.waiting_for_message)
+    await state.set_state(ContactAdmin.waiting_for_message)
 
 @dp.message(ContactAdmin.waiting_for_message)
 async def contact_admin_send(message: types.Message, state: FSMContext):
@@ -266,10 +430,10 @@ async def contact_admin_send(message: types.Message, state: FSMContext):
     sent_any = False
     for admin_id in admins:
         try:
-            await admin_bot.send_message(admin_id, f"💬 Сообщение от @{message.from_user.username or 'user'} (ID {message.from_user.id}):\n\n{text}")
+            await get_admin_bot().send_message(admin_id, f"💬 Сообщение от @{message.from_user.username or 'user'} (ID {message.from_user.id}):\n\n{text}")
             sent_any = True
         except Exception as e:
-            logger.warning(f"Не удалось отправить сообщение админу {admin_id}: {e}")
+            logger.warning("Не удалось отправить сообщение админу %s: %s", admin_id, e)
     if not sent_any:
         await message.answer(tr(message.from_user.id, "no_admin_notify"))
     try:
@@ -327,7 +491,7 @@ async def service_selected(callback: types.CallbackQuery):
     username = user.username or f"id{user.id}"
     photo_file_id = None
     try:
-        photos = await bot.get_user_profile_photos(user.id, limit=1)
+        photos = await get_bot().get_user_profile_photos(user.id, limit=1)
         if photos.total_count > 0:
             photo_file_id = photos.photos[0][-1].file_id
     except Exception:
@@ -337,12 +501,27 @@ async def service_selected(callback: types.CallbackQuery):
             await db.upsert_user_profile(user.id, user.username, None, photo_file_id)
     except Exception:
         logger.debug("upsert_user_profile failed (ignored)")
+    if PAYMENTS_ENABLED:
+        # оплата без участия админов: доступ выдаёт обработчик successful_payment
+        try:
+            await send_service_invoice(user.id, service)
+        except Exception as e:
+            logger.error(
+                "Не удалось выставить счёт пользователю %s: %s", user.id, e,
+                extra={"sample": "invoice_failed", "user_id": user.id},
+            )
+            await callback.message.edit_text("❌ Ошибка создания счёта. Попробуйте позже.")
+            return
+        await callback.message.edit_text(tr(user.id, "invoice_sent"))
+        return
     try:
-        purchase_id = await db.add_pending_purchase(user.id, username, None, service_id)
+        purchase_id, created = await db.add_pending_purchase(user.id, username, None, service_id)
     except Exception:
         await callback.message.edit_text("❌ Ошибка создания заявки. Попробуйте позже.")
         return
-    await send_admin_notification(user.id, username, None, service, purchase_id, photo_file_id)
+    # повторное нажатие возвращает уже открытую заявку — админов не дёргаем
+    if created:
+        await send_admin_notification(user.id, username, None, service, purchase_id, photo_file_id)
     unit = service.get("duration_unit", "days")
     unit_text = {"minutes": "минут", "days": "дней", "months": "месяцев"}.get(unit, "дней")
     await callback.message.edit_text(
@@ -375,12 +554,12 @@ async def send_admin_notification(user_id: int, username: str, phone_number: Opt
     for admin_id in admins:
         try:
             if photo_file_id:
-                await admin_bot.send_photo(admin_id, photo_file_id, caption=text, reply_markup=kb)
+                await get_admin_bot().send_photo(admin_id, photo_file_id, caption=text, reply_markup=kb)
             else:
-                await admin_bot.send_message(admin_id, text, reply_markup=kb)
+                await get_admin_bot().send_message(admin_id, text, reply_markup=kb)
             sent_any = True
         except Exception as e:
-            logger.warning(f"Не удалось уведомить админа {admin_id}: {e}")
+            logger.warning("Не удалось уведомить админа %s: %s", admin_id, e)
     if not sent_any:
         logger.error("Не удалось уведомить ни одного админа о заявке.")
 
@@ -467,18 +646,15 @@ async def confirm_cancel_subscription(callback: types.CallbackQuery):
         logger.exception("Ошибка деактивации подписки")
         await callback.message.edit_text(tr(user_id, "cancel_done"), reply_markup=get_main_keyboard(user_id, active=True))
         return
-    if PRIVATE_CHANNEL_ID is not None:
-        try:
-            await admin_bot.ban_chat_member(chat_id=PRIVATE_CHANNEL_ID, user_id=user_id)
-            await asyncio.sleep(0.3)
-            await admin_bot.unban_chat_member(chat_id=PRIVATE_CHANNEL_ID, user_id=user_id)
-            if hasattr(db, "mark_user_removed_from_channel"):
-                try:
-                    await db.mark_user_removed_from_channel(user_id)
-                except Exception:
-                    logger.debug("Не удалось отметить удаление в БД")
-        except Exception as e:
-            logger.warning(f"Не удалось удалить из канала: {e}")
+    # из всех каналов услуги (и тех, где пользователь точно есть) — пулами каналов параллельно
+    async for _, errors in channels.remove_users(get_admin_bot(), [user_id]):
+        for error in errors:
+            logger.warning("Не удалось удалить из канала %s", error)
+        if not errors:
+            try:
+                await db.mark_user_removed_from_channel(user_id)
+            except Exception:
+                logger.debug("Не удалось отметить удаление в БД")
     try:
         await callback.message.edit_text(tr(user_id, "cancel_done"), reply_markup=get_main_keyboard(user_id, active=False))
     except Exception:
@@ -488,7 +664,7 @@ async def confirm_cancel_subscription(callback: types.CallbackQuery):
     sent_any = False
     for admin_id in admins:
         try:
-            await admin_bot.send_message(admin_id, notif_text)
+            await get_admin_bot().send_message(admin_id, notif_text)
             sent_any = True
         except Exception:
             logger.warning("Не удалось уведомить админа об отмене подписки.")
@@ -499,9 +675,23 @@ async def confirm_cancel_subscription(callback: types.CallbackQuery):
 async def send_expiry_notification(user_id: int):
     """Отправляет юзеру уведомление об истечении подписки."""
     try:
-        await bot.send_message(user_id, "⚠️ <b>Ваша подписка истекла</b>\n\nДоступ к каналу закрыт.\n\nДля покупки/продления используйте /start")
+        await get_bot().send_message(user_id, "⚠️ <b>Ваша подписка истекла</b>\n\nДоступ к каналу закрыт.\n\nДля покупки/продления используйте /start")
     except Exception as e:
-        logger.warning(f"Не удалось отправить уведомление об истечении подписки пользователю {user_id}: {e}")
+        logger.warning(
+            "Не удалось отправить уведомление об истечении подписки пользователю %s: %s", user_id, e,
+            extra={"sample": "expiry_notification_failed", "user_id": user_id},
+        )
+
+# SEND pre-expiry reminder — used by reminders.py; raises so the engine can record failures
+async def send_expiry_reminder(user_id: int, subscription_end: str):
+    try:
+        end = datetime.fromisoformat(subscription_end).strftime("%d.%m.%Y %H:%M")
+    except ValueError:
+        end = subscription_end
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=tr(user_id, "renew"), callback_data="buy_subscription")]
+    ])
+    await get_bot().send_message(user_id, tr(user_id, "expiry_reminder", date=end), reply_markup=kb)
 
 # helper to send invite link (admin_bot uses this pattern; keep present)
 async def send_invite_link(user_id: int, invite_link: str):
@@ -509,9 +699,12 @@ async def send_invite_link(user_id: int, invite_link: str):
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔗 Присоединиться к каналу", url=invite_link)]
         ])
-        await bot.send_message(user_id, "✅ <b>Подписка активирована!</b>\n\nНажмите кнопку ниже, чтобы присоединиться к приватному каналу:", reply_markup=kb)
+        await get_bot().send_message(user_id, "✅ <b>Подписка активирована!</b>\n\nНажмите кнопку ниже, чтобы присоединиться к приватному каналу:", reply_markup=kb)
     except Exception as e:
-        logger.warning(f"Не удалось отправить инвайт ссылку пользователю {user_id}: {e}")
+        logger.warning(
+            "Не удалось отправить инвайт ссылку пользователю %s: %s", user_id, e,
+            extra={"sample": "invite_link_failed", "user_id": user_id},
+        )
 
 # init helper
 async def init_user_bot():
@@ -520,4 +713,4 @@ async def init_user_bot():
     except Exception:
         logger.debug("init_db not available or failed")
 
-# Exported names: dp, bot, send_expiry_notification, init_user_bot are present for main.py
+# Exported names: dp, get_bot, send_expiry_notification, init_user_bot are present for main.py